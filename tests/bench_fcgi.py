@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the wphp FastCGI client, run against the stub responder
+in `fcgi_stub` so that PHP is not needed.
+
+Run it as::
+
+    python tests/bench_fcgi.py [-n REQUESTS] [-a] [-i] [SCENARIO ...]
+
+Each scenario drives `FCGIApp` (or `PHPApp`, with the stub standing in
+for ``php-cgi``) from several threads, against the stub responder or,
+for the ``server`` scenarios, wphp's own FastCGI servers
+(`wphp.fcgi_app.FCGIServer` and `AsyncFCGIServer`) serving the same
+responses from a WSGI application, and reports requests per second,
+median and 99th percentile latency, socket calls per request (a
+stand-in for syscalls, counted by wrapping the client sockets), and
+the peak RSS of the benchmark process.  Each scenario runs in a new
+process (``-i`` runs them all in this one), so the peak RSS is the
+scenario's own and not the largest of the scenarios so far.
+
+With ``-a`` memory use is measured too (which slows the requests
+down): the objects (tracked by the garbage collector) that each
+request leaves behind, the growth of the RSS over the scenario, and,
+where ``tracemalloc`` is available, the peak memory allocated.  These
+are not allocation counts: Python 2 has no way to count allocations
+(``gc.get_count()`` goes down again as objects are freed, and strings
+aren't tracked at all), so short-lived garbage doesn't show up.
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import gc
+import subprocess
+import tempfile
+import shutil
+import resource
+import getopt
+from cStringIO import StringIO
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+from wphp import fcgi_app
+from wphp.backend import proc_usage
+from fcgi_stub import stub_wrapper
+
+stub_script = os.path.join(here, 'fcgi_stub.py')
+php_files = os.path.join(here, 'php-files')
+
+scenarios = [
+    # name, app, concurrency, body size, headers, record size, upload size
+    # [, seconds the stub takes to answer]
+    ('small', 'fcgi', 1, 1024, 2, 8192, 0),
+    ('concurrent', 'fcgi', 8, 1024, 2, 8192, 0),
+    ('large-body', 'fcgi', 4, 1024*1024, 2, 65535, 0),
+    ('stream', 'fcgi_stream', 4, 1024*1024, 2, 65535, 0),
+    ('spooled', 'fcgi_spooled', 4, 1024*1024, 2, 65535, 0),
+    ('fragmented', 'fcgi', 4, 256*1024, 2, 512, 0),
+    ('many-headers', 'fcgi', 4, 1024, 100, 8192, 0),
+    ('upload', 'fcgi', 4, 0, 2, 8192, 256*1024),
+    ('server', 'fcgi_server', 8, 1024, 2, 8192, 0),
+    ('server-async', 'fcgi_server_async', 8, 1024, 2, 8192, 0),
+    ('server-large', 'fcgi_server', 4, 1024*1024, 2, 65535, 0),
+    ('server-async-large', 'fcgi_server_async', 4, 1024*1024, 2, 65535, 0),
+    ('server-upload', 'fcgi_server', 4, 0, 2, 8192, 256*1024),
+    ('php-app', 'php', 4, 1024, 2, 8192, 0),
+    # Throughput should grow with the number of threads while they
+    # wait for PHP (here 5ms a request):
+    ('php-threads-1', 'php', 1, 1024, 2, 8192, 0, 0.005),
+    ('php-threads-4', 'php', 4, 1024, 2, 8192, 0, 0.005),
+    ('php-threads-16', 'php', 16, 1024, 2, 8192, 0, 0.005),
+    ('php-gzip', 'php_gzip', 4, 256*1024, 2, 8192, 0),
+    ('php-gzip-stream', 'php_gzip_stream', 4, 256*1024, 2, 8192, 0),
+    ]
+
+def bench_header_parser(requests):
+    """
+    Parses a 50 header response, split into 64 byte records.
+    """
+    data = ''.join(['X-Header-%s: value %s\r\n' % (i, i) for i in range(50)])
+    data += '\r\n' + 'x' * 1000
+    chunks = [data[pos:pos+64] for pos in range(0, len(data), 64)]
+    for i in range(requests):
+        parser = fcgi_app.HeaderParser()
+        for chunk in chunks:
+            if parser.feed(chunk) is not None:
+                break
+
+micro_benchmarks = [
+    ('header-parser', bench_header_parser),
+    ]
+
+class SocketCounter(object):
+    """
+    Collects call counts from `CountingSocket` instances.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, counts):
+        self.lock.acquire()
+        try:
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        self.counts = {}
+
+class CountingSocket(object):
+    """
+    Wraps a socket, counting the calls that each map to a system
+    call.
+    """
+
+    counted = ['connect', 'send', 'sendall', 'recv', 'recv_into', 'close',
+               'setsockopt', 'settimeout', 'shutdown']
+
+    def __init__(self, sock, counter):
+        self._sock = sock
+        self._counter = counter
+        self._counts = {}
+
+    def __getattr__(self, attr):
+        value = getattr(self._sock, attr)
+        if attr not in self.counted:
+            return value
+        def counting(*args):
+            self._counts[attr] = self._counts.get(attr, 0) + 1
+            if attr == 'close':
+                self._counter.add(self._counts)
+                self._counts = {}
+            return value(*args)
+        return counting
+
+def current_rss():
+    """
+    Returns the RSS of this process in bytes, or None if it can't be
+    read.
+    """
+    usage = proc_usage(os.getpid())
+    if usage is None:
+        return None
+    return usage[0]
+
+class MemoryMeter(object):
+    """
+    Measures, between `start()` and `stop()`, the growth in the
+    number of objects tracked by the garbage collector (`objects`,
+    after a collection, so only objects that are kept count), the
+    growth of the RSS in bytes (`rss_growth`, or None without
+    ``/proc``), and the peak memory traced by ``tracemalloc`` if it's
+    available.
+    """
+
+    def __init__(self):
+        self.objects = 0
+        self.rss_growth = None
+        self.peak = None
+
+    def start(self):
+        self.peak = None
+        gc.collect()
+        self.start_objects = len(gc.get_objects())
+        self.start_rss = current_rss()
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+    def stop(self):
+        if tracemalloc is not None:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        gc.collect()
+        self.objects = len(gc.get_objects()) - self.start_objects
+        rss = current_rss()
+        if rss is None or self.start_rss is None:
+            self.rss_growth = None
+        else:
+            self.rss_growth = rss - self.start_rss
+
+def counting_app(app, counter):
+    """
+    Patches `app` (an `FCGIApp`) so its connections are counted.
+    """
+    get_connection = app._getConnection
+    def _getConnection(*args):
+        sock = CountingSocket(get_connection(*args), counter)
+        sock._counts['socket'] = 1
+        return sock
+    app._getConnection = _getConnection
+    return app
+
+def make_environ(body_size, header_count, record_size, upload_size, delay=0):
+    body = 'x' * upload_size
+    environ = {
+        'REQUEST_METHOD': upload_size and 'POST' or 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/test.php',
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.0',
+        'HTTP_HOST': 'localhost',
+        'HTTP_ACCEPT_ENCODING': 'gzip',
+        'HTTP_X_STUB_BODY_SIZE': str(body_size),
+        'HTTP_X_STUB_HEADERS': str(header_count),
+        'HTTP_X_STUB_RECORD_SIZE': str(record_size),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        }
+    if delay:
+        environ['HTTP_X_STUB_DELAY'] = str(delay)
+    if upload_size:
+        environ['CONTENT_LENGTH'] = str(upload_size)
+        environ['CONTENT_TYPE'] = 'application/octet-stream'
+        environ['HTTP_X_STUB_ECHO'] = '1'
+    return environ
+
+def request(app, environ):
+    """
+    Runs one request through `app`, consuming the body.  Returns the
+    number of body bytes.
+    """
+    statuses = []
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+    app_iter = app(environ, start_response)
+    size = 0
+    try:
+        for chunk in app_iter:
+            size += len(chunk)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    assert statuses and statuses[0].startswith('200'), statuses
+    return size
+
+def run_scenario(app, concurrency, requests, environ_args):
+    latencies = []
+    errors = []
+    per_thread = max(requests // concurrency, 1)
+    def worker():
+        try:
+            for i in range(per_thread):
+                environ = make_environ(*environ_args)
+                start = time.time()
+                request(app, environ)
+                latencies.append(time.time() - start)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        }
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = int(round((len(values) - 1) * pct / 100.0))
+    return values[index]
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(('127.0.0.1', port))
+        except socket.error:
+            time.sleep(0.05)
+        else:
+            sock.close()
+            return
+    raise RuntimeError('Stub responder did not start on port %s' % port)
+
+class Benchmark(object):
+
+    def __init__(self, requests=200, memory=False):
+        self.requests = requests
+        self.counter = SocketCounter()
+        if memory:
+            self.memory = MemoryMeter()
+        else:
+            self.memory = None
+        self.tmp_dir = tempfile.mkdtemp(prefix='wphp-bench-')
+        self.procs = []
+        self.apps = {}
+
+    def app(self, kind):
+        if kind not in self.apps:
+            self.apps[kind] = getattr(self, 'make_%s_app' % kind)()
+        return self.apps[kind]
+
+    def make_fcgi_app(self, stub_args=(), **kw):
+        port = free_port()
+        self.procs.append(subprocess.Popen(
+            [sys.executable, stub_script, '-b', '127.0.0.1:%s' % port]
+            + list(stub_args)))
+        wait_for_port(port)
+        app = fcgi_app.FCGIApp(connect=('127.0.0.1', port), **kw)
+        return counting_app(app, self.counter)
+
+    def make_fcgi_stream_app(self):
+        return self.make_fcgi_app(stream=True)
+
+    def make_fcgi_spooled_app(self):
+        return self.make_fcgi_app(spoolSize=64*1024)
+
+    def make_fcgi_server_app(self):
+        return self.make_fcgi_app(['-s', 'threaded'])
+
+    def make_fcgi_server_async_app(self):
+        return self.make_fcgi_app(['-s', 'async'])
+
+    def make_php_app(self, **kw):
+        from wphp import PHPApp
+        app = PHPApp(php_files, php_script=stub_wrapper(self.tmp_dir),
+                     fcgi_port=free_port(), logger=None, **kw)
+        app.create_child()
+        counting_app(app.fcgi_app, self.counter)
+        return app
+
+    def make_php_gzip_app(self):
+        return self.make_php_app(compress=True)
+
+    def make_php_gzip_stream_app(self):
+        return self.make_php_app(compress=True, stream=True)
+
+    def run(self, names=None):
+        results = []
+        for scenario in scenarios:
+            name, kind, concurrency = scenario[:3]
+            if names and name not in names:
+                continue
+            app = self.app(kind)
+            self.counter.reset()
+            if self.memory is not None:
+                self.memory.start()
+            try:
+                result = run_scenario(app, concurrency, self.requests,
+                                      scenario[3:])
+            finally:
+                if self.memory is not None:
+                    self.memory.stop()
+            result['name'] = name
+            result['calls'] = float(self.counter.total()) / result['requests']
+            result['maxrss'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+            if self.memory is not None:
+                result['objects'] = (float(self.memory.objects)
+                                     / result['requests'])
+                result['rss_growth'] = self.memory.rss_growth
+                result['peak'] = self.memory.peak
+            results.append(result)
+            self.report(result)
+        self.run_micro_benchmarks(names)
+        return results
+
+    def run_micro_benchmarks(self, names=None):
+        for name, func in micro_benchmarks:
+            if names and name not in names:
+                continue
+            start = time.time()
+            func(self.requests * 10)
+            elapsed = time.time() - start
+            print '%-18s %6d ops %9.1f ops/s' % (
+                name, self.requests * 10, self.requests * 10 / elapsed)
+
+    def report(self, result):
+        print ('%(name)-18s %(requests)6d req %(rps)9.1f req/s '
+               'p50 %(p50_ms)7.2fms p99 %(p99_ms)7.2fms '
+               '%(calls)7.1f calls/req maxrss %(maxrss)7dkB' % dict(
+                   result, p50_ms=result['p50']*1000,
+                   p99_ms=result['p99']*1000))
+        if 'objects' in result:
+            print '%18s %7.2f objects kept/req' % ('', result['objects']),
+            if result['rss_growth'] is not None:
+                print 'rss growth %7dkB' % (result['rss_growth'] // 1024),
+            if result['peak'] is not None:
+                print 'traced peak %7dkB' % (result['peak'] // 1024),
+            print
+        sys.stdout.flush()
+
+    def close(self):
+        for app in self.apps.values():
+            if hasattr(app, 'close'):
+                app.close()
+        for proc in self.procs:
+            os.kill(proc.pid, 15)
+            proc.wait()
+        shutil.rmtree(self.tmp_dir)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, names = getopt.getopt(args, 'n:ai')
+    requests = 200
+    memory = False
+    in_process = False
+    for name, value in opts:
+        if name == '-n':
+            requests = int(value)
+        elif name == '-a':
+            memory = True
+        elif name == '-i':
+            in_process = True
+    bench = Benchmark(requests, memory)
+    try:
+        if in_process:
+            bench.run(names)
+            return
+        for scenario in scenarios:
+            name = scenario[0]
+            if names and name not in names:
+                continue
+            cmd = [sys.executable, os.path.abspath(__file__), '-i',
+                   '-n', str(requests)]
+            if memory:
+                cmd.append('-a')
+            sys.stdout.flush()
+            if subprocess.call(cmd + [name]):
+                raise RuntimeError('Scenario %s failed' % name)
+        bench.run_micro_benchmarks(names)
+    finally:
+        bench.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+A pure-Python FastCGI responder, used to test and benchmark wphp
+without PHP.
+
+It speaks the responder side of the protocol using the
+`wphp.fcgi_app` record codec, and generates configurable responses.
+The response for a request is controlled by the constructor defaults,
+which can be overridden per-request with these HTTP headers:
+
+``X-Stub-Body-Size``
+    Number of body bytes to generate.
+
+``X-Stub-Headers``
+    Number of extra response headers to generate.
+
+``X-Stub-Record-Size``
+    Maximum size of each ``FCGI_STDOUT`` record; small values
+    fragment the response into many records.
+
+``X-Stub-Echo``
+    If set, the request body is echoed back instead of a generated
+    body.
+
+``X-Stub-Delay``
+    Seconds to wait before responding.
+
+``X-Stub-Flushes``
+    Number of bursts to send the body in, like calls to PHP's
+    ``flush()``.
+
+``X-Stub-Flush-Delay``
+    Seconds to wait between the bursts.
+
+``X-Stub-No-Length``
+    If set, no ``Content-Length`` header is sent.
+
+``X-Stub-Header``
+    Extra response headers, separated by ``|`` (e.g.
+    ``ETag: "1"|Cache-Control: max-age=60``).
+
+Responses include an ``X-Stub-Pid`` header with the responder's
+process ID.
+
+`stub_wsgi_app` gives the same responses as a WSGI application, to
+be served by `wphp.fcgi_app.FCGIServer` or `AsyncFCGIServer`.
+
+The module can also be run as a script with the same ``-b host:port``
+argument as ``php-cgi``, so it can be passed as the `php_script` of a
+`wphp.PHPApp`.  ``-c`` and ``-d`` arguments are accepted and ignored.
+With ``-s threaded`` or ``-s async``, `stub_wsgi_app` is served with
+wphp's own FastCGI servers instead.
+"""
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+import getopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wphp import fcgi_app
+from wphp.fcgi_app import Record, encode_pair, decode_pair
+
+class StubResponder(object):
+
+    def __init__(self, address=('127.0.0.1', 0),
+                 body_size=1024, header_count=2, record_size=8192,
+                 echo=False, max_conns=64, max_reqs=64):
+        self.address = address
+        self.body_size = body_size
+        self.header_count = header_count
+        self.record_size = record_size
+        self.echo = echo
+        self.max_conns = max_conns
+        self.max_reqs = max_reqs
+        self.sock = None
+        self.requests = 0
+        self._stopping = False
+
+    def start(self):
+        """
+        Binds the listening socket and starts accepting connections
+        in a background thread.  Returns self.
+        """
+        self.bind()
+        t = threading.Thread(target=self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return self
+
+    def bind(self):
+        """
+        Binds the listening socket.  `address` is updated with the
+        bound address (useful when binding port 0).
+        """
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+
+    def stop(self):
+        self._stopping = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+    def serve_forever(self):
+        while not self._stopping:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                if self._stopping:
+                    return
+                raise
+            t = threading.Thread(target=self.handle_connection, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def handle_connection(self, conn):
+        try:
+            try:
+                while self.handle_request(conn):
+                    pass
+            except (EOFError, socket.error):
+                # The client went away (e.g., it timed out)
+                pass
+        finally:
+            # Closing with unread data (like the empty FCGI_DATA
+            # record FCGIApp sends) would reset the connection and
+            # lose the end of the response, so drain it first.
+            try:
+                conn.shutdown(socket.SHUT_WR)
+                while conn.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            conn.close()
+
+    def handle_request(self, conn):
+        """
+        Reads and answers one request (or management record) from
+        the connection.  Returns true if the connection should be
+        kept open for another request.
+        """
+        params = []
+        stdin = []
+        keep_conn = False
+        requestId = None
+        while True:
+            rec = Record()
+            rec.read(conn)
+            if rec.type == fcgi_app.FCGI_GET_VALUES:
+                self.send_values(conn, rec)
+                return True
+            elif rec.type == fcgi_app.FCGI_BEGIN_REQUEST:
+                role, flags = struct.unpack(
+                    fcgi_app.FCGI_BeginRequestBody, rec.contentData)
+                keep_conn = bool(flags & fcgi_app.FCGI_KEEP_CONN)
+                requestId = rec.requestId
+            elif rec.type == fcgi_app.FCGI_ABORT_REQUEST:
+                self.end_request(conn, rec.requestId)
+                return keep_conn
+            elif rec.type == fcgi_app.FCGI_PARAMS:
+                params.append(rec.contentData)
+            elif rec.type == fcgi_app.FCGI_STDIN:
+                if not rec.contentData:
+                    break
+                stdin.append(rec.contentData)
+        environ = {}
+        data = ''.join(params)
+        pos = 0
+        while pos < len(data):
+            pos, (name, value) = decode_pair(data, pos)
+            environ[name] = value
+        self.requests += 1
+        self.respond(conn, requestId, environ, ''.join(stdin))
+        return keep_conn
+
+    def send_values(self, conn, rec):
+        values = {
+            fcgi_app.FCGI_MAX_CONNS: str(self.max_conns),
+            fcgi_app.FCGI_MAX_REQS: str(self.max_reqs),
+            fcgi_app.FCGI_MPXS_CONNS: '0',
+            }
+        result = []
+        pos = 0
+        while pos < rec.contentLength:
+            pos, (name, value) = decode_pair(rec.contentData, pos)
+            if name in values:
+                result.append(encode_pair(name, values[name]))
+        out = Record(fcgi_app.FCGI_GET_VALUES_RESULT)
+        out.contentData = ''.join(result)
+        out.contentLength = len(out.contentData)
+        out.write(conn)
+
+    def respond(self, conn, requestId, environ, body):
+        delay = float(environ.get('HTTP_X_STUB_DELAY') or 0)
+        if delay:
+            time.sleep(delay)
+        record_size = min(option(environ, 'RECORD_SIZE', self.record_size),
+                          65535)
+        headers, bursts, flush_delay = stub_response(
+            environ, body, self.body_size, self.header_count, self.echo)
+        data = '\r\n'.join(headers) + '\r\n\r\n' + bursts[0]
+        self.send_stdout(conn, requestId, data, record_size)
+        for burst in bursts[1:]:
+            time.sleep(flush_delay)
+            self.send_stdout(conn, requestId, burst, record_size)
+        self.end_request(conn, requestId)
+
+    def send_stdout(self, conn, requestId, data, record_size):
+        for pos in range(0, len(data), record_size):
+            rec = Record(fcgi_app.FCGI_STDOUT, requestId)
+            rec.contentData = data[pos:pos+record_size]
+            rec.contentLength = len(rec.contentData)
+            rec.write(conn)
+
+    def end_request(self, conn, requestId):
+        rec = Record(fcgi_app.FCGI_STDOUT, requestId)
+        rec.write(conn)
+        rec = Record(fcgi_app.FCGI_END_REQUEST, requestId)
+        rec.contentData = struct.pack(fcgi_app.FCGI_EndRequestBody,
+                                      0, fcgi_app.FCGI_REQUEST_COMPLETE)
+        rec.contentLength = fcgi_app.FCGI_EndRequestBody_LEN
+        rec.write(conn)
+
+def option(environ, name, default):
+    value = environ.get('HTTP_X_STUB_' + name)
+    if value is None:
+        return default
+    return int(value)
+
+def stub_response(environ, body, body_size=1024, header_count=2,
+                  echo=False):
+    """
+    Works out the response to a request with the body `body`.
+    Returns ``(headers, bursts, flush_delay)``: the header lines
+    (``Status`` first), the parts of the body to send separately,
+    and the seconds to wait between them.
+    """
+    header_count = option(environ, 'HEADERS', header_count)
+    if not (environ.get('HTTP_X_STUB_ECHO') or echo):
+        body = make_body(option(environ, 'BODY_SIZE', body_size))
+    headers = ['Status: 200 OK',
+               'Content-Type: text/plain',
+               'X-Stub-Pid: %s' % os.getpid()]
+    if not environ.get('HTTP_X_STUB_NO_LENGTH'):
+        headers.insert(2, 'Content-Length: %s' % len(body))
+    for i in range(header_count):
+        headers.append('X-Stub-%s: value %s' % (i, i))
+    if environ.get('HTTP_X_STUB_HEADER'):
+        headers.extend(environ['HTTP_X_STUB_HEADER'].split('|'))
+    flushes = max(option(environ, 'FLUSHES', 1), 1)
+    flush_delay = float(environ.get('HTTP_X_STUB_FLUSH_DELAY') or 0)
+    burst_size = max(-(-len(body) // flushes), 1)
+    bursts = [body[pos:pos+burst_size]
+              for pos in range(0, len(body), burst_size)] or ['']
+    return headers, bursts, flush_delay
+
+def stub_wsgi_app(environ, start_response):
+    """
+    A WSGI application that responds like `StubResponder`.
+    ``X-Stub-Record-Size`` is up to the server.
+    """
+    body = environ['wsgi.input'].read(
+        int(environ.get('CONTENT_LENGTH') or 0))
+    delay = float(environ.get('HTTP_X_STUB_DELAY') or 0)
+    if delay:
+        time.sleep(delay)
+    headers, bursts, flush_delay = stub_response(environ, body)
+    headers = [tuple(line.split(': ', 1)) for line in headers]
+    start_response(headers[0][1], headers[1:])
+    return _send_bursts(bursts, flush_delay)
+
+def _send_bursts(bursts, flush_delay):
+    yield bursts[0]
+    for burst in bursts[1:]:
+        time.sleep(flush_delay)
+        yield burst
+
+def make_body(size):
+    """
+    Returns `size` bytes of printable filler.
+    """
+    line = 'The quick brown fox jumps over the lazy dog.\n'
+    return (line * (size // len(line) + 1))[:size]
+
+def stub_wrapper(dir):
+    """
+    Writes a script to `dir` that runs the stub with this
+    interpreter, to be used in place of ``php-cgi``.  Returns its
+    filename.
+    """
+    fn = os.path.join(dir, 'php-cgi')
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    f = open(fn, 'w')
+    f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, script))
+    f.close()
+    os.chmod(fn, 0755)
+    return fn
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 'b:c:d:s:')
+    address = ('127.0.0.1', 9000)
+    server = None
+    for name, value in opts:
+        if name == '-b':
+            if ':' in value:
+                host, port = value.rsplit(':', 1)
+                address = (host, int(port))
+            else:
+                address = value
+        elif name == '-s':
+            server = value
+    if server == 'threaded':
+        stub = fcgi_app.FCGIServer(stub_wsgi_app, address)
+    elif server == 'async':
+        stub = fcgi_app.AsyncFCGIServer(stub_wsgi_app, address)
+    elif server is not None:
+        raise getopt.GetoptError('Unknown server %r' % server)
+    else:
+        stub = StubResponder(address)
+    stub.bind()
+    stub.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import zlib
+from cStringIO import StringIO
+from wphp.compress import CompressMiddleware, choose_encoding
+
+def make_app(body, content_type='text/html', headers=None):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', content_type)]
+                       + (headers or []))
+        return body
+    return app
+
+def call(app, accept_encoding='gzip'):
+    environ = {'REQUEST_METHOD': 'GET',
+               'HTTP_ACCEPT_ENCODING': accept_encoding,
+               'wsgi.input': StringIO('')}
+    statuses = []
+    headers = []
+    def start_response(status, response_headers, exc_info=None):
+        statuses.append(status)
+        headers.extend(response_headers)
+    body = ''.join(app(environ, start_response))
+    return dict(headers), body
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def test_choose_encoding():
+    assert choose_encoding('gzip, deflate') == 'gzip'
+    assert choose_encoding('deflate') is None
+    assert choose_encoding('gzip;q=0') is None
+    assert choose_encoding('*') in ('gzip', 'br')
+    assert choose_encoding('*, gzip;q=0, br;q=0') is None
+    assert choose_encoding('') is None
+
+def test_compress():
+    body = ['<p>Hello world</p>\n' * 50] * 20
+    app = CompressMiddleware(make_app(body))
+    headers, data = call(app)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gunzip(data) == ''.join(body)
+
+def test_write():
+    def app(environ, start_response):
+        write = start_response('200 OK', [('Content-Type', 'text/html')])
+        write('<p>written</p>\n' * 100)
+        yield '<p>returned</p>\n' * 100
+        write('<p>written later</p>\n')
+    # Compressed, and passed on uncompressed (for another type)
+    for types in None, ['application/json']:
+        headers, data = call(CompressMiddleware(app, types=types))
+        if types is None:
+            assert headers['Content-Encoding'] == 'gzip'
+            data = gunzip(data)
+        else:
+            assert 'Content-Encoding' not in headers
+        assert data == ('<p>written</p>\n' * 100 + '<p>returned</p>\n' * 100
+                        + '<p>written later</p>\n')
+
+def test_etag():
+    body = ['<p>Hello world</p>\n' * 100]
+    for etag, expected in [('"v1"', 'W/"v1"'), ('W/"v1"', 'W/"v1"')]:
+        app = CompressMiddleware(make_app(body, headers=[('ETag', etag)]))
+        headers, data = call(app)
+        assert headers['ETag'] == expected
+        headers, data = call(app, 'identity')
+        assert headers['ETag'] == etag
+
+def test_not_compressed():
+    body = ['x' * 2000]
+    for app, accept in [
+        (make_app(['small']), 'gzip'),
+        (make_app(body, content_type='image/png'), 'gzip'),
+        (make_app(body, headers=[('Content-Encoding', 'gzip')]), 'gzip'),
+        (make_app(body, headers=[('Content-Length', '10')]), 'gzip'),
+        (make_app(body), 'identity'),
+        ]:
+        headers, data = call(CompressMiddleware(app), accept)
+        assert 'Vary' not in headers
+        assert data == ''.join(app({}, lambda *args: None))
+
+def test_compress_flush():
+    body = ['<head>', '<p>Hello world</p>\n' * 50]
+    app = CompressMiddleware(make_app(body), flush=True)
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+    chunks = list(app(environ, lambda *args: None))
+    # Each chunk can be decompressed as soon as it arrives
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(chunks[0]) == '<head>'
+    assert decompressor.decompress(''.join(chunks[1:])) == body[1]
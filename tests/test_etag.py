@@ -0,0 +1,100 @@
+import time
+from wphp.etag import ETagMemoMiddleware, cache_max_age, etag_matches, \
+     forces_revalidation
+
+def make_app(headers, status='200 OK'):
+    def app(environ, start_response):
+        app.calls += 1
+        start_response(status, [('Content-Type', 'text/html')] + headers)
+        return ['body']
+    app.calls = 0
+    return app
+
+def call(app, method='GET', path='/page.php', if_none_match=None,
+         **headers):
+    environ = {'REQUEST_METHOD': method, 'HTTP_HOST': 'localhost',
+               'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': ''}
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper()] = value
+    if if_none_match:
+        environ['HTTP_IF_NONE_MATCH'] = if_none_match
+    result = []
+    def start_response(status, headers, exc_info=None):
+        result.append(status)
+        result.append(dict(headers))
+    result.append(''.join(app(environ, start_response)))
+    return result
+
+def test_memo():
+    app = make_app([('ETag', '"v1"'), ('Cache-Control', 'max-age=60')])
+    memo = ETagMemoMiddleware(app)
+    assert call(memo)[0] == '200 OK'
+    status, headers, body = call(memo, if_none_match='"v1"')
+    assert status == '304 Not Modified'
+    assert headers == {'ETag': '"v1"', 'Cache-Control': 'max-age=60'}
+    assert body == ''
+    assert call(memo, 'HEAD', if_none_match='"v0", W/"v1"')[0].startswith('304')
+    assert app.calls == 1
+    assert memo.hits == 2
+    # Other ETags and URLs still go to the app
+    assert call(memo, if_none_match='"v2"')[0] == '200 OK'
+    assert call(memo, path='/other.php', if_none_match='"v1"')[0] == '200 OK'
+    assert app.calls == 3
+    # A POST forgets the URL's ETag
+    call(memo, 'POST')
+    assert call(memo, if_none_match='"v1"')[0] == '200 OK'
+
+def test_revalidation():
+    app = make_app([('ETag', '"v1"'), ('Cache-Control', 'max-age=60')])
+    memo = ETagMemoMiddleware(app)
+    call(memo)
+    for headers in [{'cache_control': 'no-cache'},
+                    {'cache_control': 'max-age=0'},
+                    {'cache_control': 'public, Max-Age="0"'},
+                    {'pragma': 'no-cache'}]:
+        assert call(memo, if_none_match='"v1"', **headers)[0] == '200 OK'
+    assert app.calls == 5
+    assert memo.hits == 0
+    assert call(memo, if_none_match='"v1"',
+                cache_control='max-age=10')[0].startswith('304')
+    assert not forces_revalidation({'HTTP_CACHE_CONTROL': 'max-age=10',
+                                    'HTTP_PRAGMA': 'no-cache'})
+
+def test_memo_expires():
+    app = make_app([('ETag', '"v1"'), ('Cache-Control', 'public, max-age=60')])
+    memo = ETagMemoMiddleware(app, max_age=0.05)
+    call(memo)
+    assert call(memo, if_none_match='"v1"')[0].startswith('304')
+    time.sleep(0.1)
+    assert call(memo, if_none_match='"v1"')[0] == '200 OK'
+    memo = ETagMemoMiddleware(app, size=2)
+    for i in range(5):
+        call(memo, path='/%s.php' % i)
+    assert len(memo.memo) <= 2
+
+def test_not_memoized():
+    for headers in [
+        [('ETag', '"v1"')],
+        [('Cache-Control', 'max-age=60')],
+        [('ETag', '"v1"'), ('Cache-Control', 'private, max-age=60')],
+        [('ETag', '"v1"'), ('Cache-Control', 'max-age=60'),
+         ('Set-Cookie', 'a=b')],
+        [('ETag', '"v1"'), ('Cache-Control', 'max-age=60'),
+         ('Vary', 'Accept-Encoding, Cookie')],
+        ]:
+        memo = ETagMemoMiddleware(make_app(headers), max_age=60)
+        call(memo)
+        assert call(memo, if_none_match='"v1"')[0] == '200 OK', headers
+    memo = ETagMemoMiddleware(make_app(
+        [('ETag', '"v1"'), ('Cache-Control', 'max-age=60')],
+        status='404 Not Found'))
+    call(memo)
+    assert not memo.memo
+
+def test_helpers():
+    assert cache_max_age([('Cache-Control', 'max-age=30')]) == 30
+    assert cache_max_age([('Cache-Control', 'no-store')]) is None
+    assert cache_max_age([]) is None
+    assert etag_matches('"a"', '*')
+    assert etag_matches('W/"a"', '"b", "a"')
+    assert not etag_matches('"a"', '"b"')
@@ -0,0 +1,233 @@
+import time
+import random
+import socket
+from cStringIO import StringIO
+from wphp import fcgi_app
+from wphp.fcgi_app import FCGIApp, HeaderParser, Record, RecordStream
+from fcgi_stub import StubResponder, make_body
+from bench_fcgi import make_environ, request
+
+stub = StubResponder().start()
+
+def call(app, environ):
+    statuses = []
+    headers = []
+    def start_response(status, response_headers, exc_info=None):
+        statuses.append(status)
+        headers.extend(response_headers)
+    body = ''.join(app(environ, start_response))
+    return statuses[0], headers, body
+
+def test_stub():
+    app = FCGIApp(connect=stub.address)
+    status, headers, body = call(app, make_environ(5000, 3, 512, 0))
+    assert status == '200 OK'
+    assert ('x-stub-2', 'value 2') in headers
+    assert body == make_body(5000)
+    status, headers, body = call(app, make_environ(0, 0, 8192, 100000))
+    assert body == 'x' * 100000
+
+def test_benchmark_request():
+    app = FCGIApp(connect=stub.address)
+    assert request(app, make_environ(1024*1024, 2, 65535, 0)) == 1024*1024
+
+def parse_chunks(chunks):
+    parser = HeaderParser()
+    body = []
+    for chunk in chunks:
+        if parser.done:
+            body.append(chunk)
+        else:
+            rest = parser.feed(chunk)
+            if rest is not None:
+                body.append(rest)
+    if not parser.done:
+        body.append(parser.close())
+    return parser.status, parser.headers, ''.join(body)
+
+def test_header_parser():
+    assert parse_chunks(['Status: 404\nX-A: b\n\nbody']) == (
+        '404 FCGIApp', [('x-a', 'b')], 'body')
+    assert parse_chunks(['X-A:b\r', '\n\r', '\nbo', 'dy\r\n']) == (
+        '200 OK', [('x-a', 'b')], 'body\r\n')
+    assert parse_chunks(['X-A: b\r\n', 'partial']) == (
+        '200 OK', [('x-a', 'b')], 'partial')
+    try:
+        parse_chunks(['no colon\n\n'])
+    except ValueError:
+        pass
+    else:
+        assert 0, 'ValueError expected'
+
+def test_header_parser_fuzz():
+    rand = random.Random(1234)
+    for i in range(500):
+        headers = [('x-h%s' % n, 'v' * rand.randint(0, 20))
+                   for n in range(rand.randint(0, 10))]
+        body = ''.join([rand.choice('ab\r\n:') for n in range(rand.randint(0, 50))])
+        lines = ['Status: 201 Created'] + ['%s: %s' % h for h in headers]
+        data = ''.join([line + rand.choice(['\r\n', '\n']) for line in lines])
+        data += rand.choice(['\r\n', '\n']) + body
+        chunks = []
+        pos = 0
+        while pos < len(data):
+            size = rand.randint(1, 12)
+            chunks.append(data[pos:pos+size])
+            pos += size
+        assert parse_chunks(chunks) == ('201 Created', headers, body)
+
+def test_timeouts():
+    timed_out = []
+    app = FCGIApp(connect=stub.address, firstByteTimeout=0.1,
+                  onTimeout=lambda environ, kind: timed_out.append(kind))
+    environ = make_environ(100, 0, 8192, 0)
+    environ['HTTP_X_STUB_DELAY'] = '0.5'
+    status, headers, body = call(app, environ)
+    assert status == '504 Gateway Timeout'
+    assert 'first byte' in body
+    assert timed_out == ['first_byte']
+    assert app.timeouts['first_byte'] == 1
+    status, headers, body = call(app, make_environ(100, 0, 8192, 0))
+    assert status == '200 OK'
+
+    app = FCGIApp(connect=stub.address, timeout=0.2)
+    environ = make_environ(100, 0, 8192, 0)
+    environ['HTTP_X_STUB_DELAY'] = '0.5'
+    status, headers, body = call(app, environ)
+    assert status == '504 Gateway Timeout'
+    assert app.timeouts['deadline'] == 1
+    status, headers, body = call(app, make_environ(100, 0, 8192, 0))
+    assert status == '200 OK'
+
+def stream(app, environ):
+    """
+    Returns the body chunks of the response, with the time each
+    arrived.
+    """
+    start = time.time()
+    app_iter = app(environ, lambda *args: None)
+    chunks = []
+    try:
+        for chunk in app_iter:
+            chunks.append((chunk, time.time() - start))
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return chunks
+
+def flush_environ():
+    environ = make_environ(3000, 0, 100, 0)
+    environ['HTTP_X_STUB_FLUSHES'] = '3'
+    environ['HTTP_X_STUB_FLUSH_DELAY'] = '0.2'
+    return environ
+
+def test_streaming():
+    app = FCGIApp(connect=stub.address, stream=True)
+    chunks = stream(app, flush_environ())
+    assert ''.join([chunk for chunk, t in chunks]) == make_body(3000)
+    # Every 100 byte record is passed on
+    assert len(chunks) >= 30
+    assert chunks[0][1] < 0.15
+    assert chunks[-1][1] >= 0.4
+
+    app = FCGIApp(connect=stub.address, stream=True, coalesceSize=4096,
+                  coalesceDelay=0.05)
+    chunks = stream(app, flush_environ())
+    assert [len(chunk) for chunk, t in chunks] == [1000, 1000, 1000]
+    assert chunks[0][1] < 0.15
+
+    app = FCGIApp(connect=stub.address)
+    chunks = stream(app, flush_environ())
+    assert len(chunks) == 1
+    assert chunks[0][1] >= 0.4
+
+def test_streaming_timeout():
+    timed_out = []
+    app = FCGIApp(connect=stub.address, stream=True, timeout=0.3,
+                  onTimeout=lambda environ, kind: timed_out.append(kind))
+    environ = flush_environ()
+    errors = environ['wsgi.errors'] = StringIO()
+    chunks = stream(app, environ)
+    assert 1000 <= len(''.join([chunk for chunk, t in chunks])) < 3000
+    assert timed_out == ['deadline']
+    assert 'cut short' in errors.getvalue()
+
+def test_head():
+    app = FCGIApp(connect=stub.address)
+    environ = flush_environ()
+    environ['REQUEST_METHOD'] = 'HEAD'
+    environ['HTTP_X_STUB_FLUSH_DELAY'] = '1'
+    start = time.time()
+    status, headers, body = call(app, environ)
+    # The response is aborted after the headers, without waiting
+    # for the rest of the body
+    assert time.time() - start < 0.5
+    assert status == '200 OK'
+    assert ('content-length', '3000') in headers
+    assert body == ''
+
+def test_spooling():
+    app = FCGIApp(connect=stub.address, spoolSize=1000, bufferRequest=True)
+    environ = make_environ(5000, 0, 512, 0)
+    environ['HTTP_X_STUB_NO_LENGTH'] = '1'
+    headers = []
+    app_iter = app(environ, lambda status, h: headers.extend(h))
+    assert not isinstance(app_iter, list)
+    assert ''.join(app_iter) == make_body(5000)
+    app_iter.close()
+    assert ('content-length', '5000') in headers
+    status, headers, body = call(app, make_environ(0, 0, 8192, 100000))
+    assert body == 'x' * 100000
+    status, headers, body = call(app, make_environ(500, 0, 8192, 0))
+    assert body == make_body(500)
+
+def test_record_stream():
+    a, b = socket.socketpair()
+    try:
+        writer = RecordStream(a)
+        reader = RecordStream(b)
+        writer.write(fcgi_app.FCGI_STDOUT, 3, 'abc')
+        writer.write(fcgi_app.FCGI_END_REQUEST, 3)
+        assert reader.read() == (fcgi_app.FCGI_STDOUT, 3, 'abc')
+        assert reader.read() == (fcgi_app.FCGI_END_REQUEST, 3, '')
+        # Records written by RecordStream and Record read the same:
+        rec = Record(fcgi_app.FCGI_STDERR, 2)
+        rec.contentData = 'x' * 13
+        rec.contentLength = 13
+        rec.write(a)
+        assert reader.read() == (fcgi_app.FCGI_STDERR, 2, 'x' * 13)
+        writer.write(fcgi_app.FCGI_STDIN, 1, 'yz')
+        rec = Record()
+        rec.read(b)
+        assert (rec.type, rec.requestId, rec.contentData) == (
+            fcgi_app.FCGI_STDIN, 1, 'yz')
+        assert not hasattr(rec, '__dict__')
+        # Content too long for one record is split:
+        data = make_body(200000)
+        writer.write(fcgi_app.FCGI_STDOUT, 1, data)
+        received = []
+        while sum(map(len, received)) < len(data):
+            type, requestId, content = reader.read()
+            assert len(content) <= fcgi_app.FCGI_MAX_CONTENT_LEN
+            received.append(content)
+        assert len(received) == 4
+        assert ''.join(received) == data
+        a.close()
+        try:
+            reader.read()
+        except EOFError:
+            pass
+        else:
+            assert 0, 'EOFError expected'
+    finally:
+        a.close()
+        b.close()
+
+def test_streams_reused():
+    app = FCGIApp(connect=stub.address)
+    call(app, make_environ(1000, 1, 512, 0))
+    assert len(app._streams) == 1
+    stream = app._streams[0]
+    call(app, make_environ(1000, 1, 512, 0))
+    assert list(app._streams) == [stream]
+    assert stream.sock is None
@@ -0,0 +1,284 @@
+import time
+import struct
+import socket
+import threading
+from wphp import fcgi_app
+from wphp.fcgi_app import (FCGIApp, FCGIServer, AsyncFCGIServer,
+                           RecordStream, encode_pair, decode_pair)
+from fcgi_stub import stub_wsgi_app, make_body
+from bench_fcgi import make_environ, request
+
+server_classes = [FCGIServer, AsyncFCGIServer]
+
+def start(server_class, app=stub_wsgi_app, **kw):
+    return server_class(app, ('127.0.0.1', 0), **kw).start()
+
+def call(app, environ):
+    statuses = []
+    headers = []
+    def start_response(status, response_headers, exc_info=None):
+        statuses.append(status)
+        headers.extend(response_headers)
+    body = ''.join(app(environ, start_response))
+    return statuses[0], headers, body
+
+def wait_idle(server):
+    # The request is counted as finished just after FCGI_END_REQUEST
+    # has been sent
+    end = time.time() + 5
+    while server.active and time.time() < end:
+        time.sleep(0.01)
+    return server.active == 0
+
+def waiting_app(release, first='', last='done'):
+    """
+    An app that sends `first`, then waits (without blocking
+    AsyncFCGIServer) for `release` to be set.
+    """
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        yield first
+        while not release.isSet():
+            time.sleep(0.01)
+            yield ''
+        yield last
+    return app
+
+def connect(server):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    sock.connect(server.address)
+    return RecordStream(sock)
+
+def send_request(stream, requestId, environ, body='', keep_conn=True):
+    flags = keep_conn and fcgi_app.FCGI_KEEP_CONN or 0
+    if body:
+        environ = dict(environ, CONTENT_LENGTH=str(len(body)))
+    stream.write(fcgi_app.FCGI_BEGIN_REQUEST, requestId,
+                 struct.pack(fcgi_app.FCGI_BeginRequestBody,
+                             fcgi_app.FCGI_RESPONDER, flags))
+    stream.write(fcgi_app.FCGI_PARAMS, requestId, ''.join(
+        [encode_pair(name, value) for name, value in environ.items()]))
+    stream.write(fcgi_app.FCGI_PARAMS, requestId)
+    if body:
+        stream.write(fcgi_app.FCGI_STDIN, requestId, body)
+    stream.write(fcgi_app.FCGI_STDIN, requestId)
+
+def read_responses(stream, count):
+    """
+    Reads records until `count` requests have ended; returns a
+    dictionary of request ID to ``(stdout, protocolStatus)``.
+    """
+    stdout = {}
+    ended = {}
+    while len(ended) < count:
+        type, requestId, data = stream.read()
+        if type == fcgi_app.FCGI_STDOUT:
+            stdout.setdefault(requestId, []).append(data)
+        elif type == fcgi_app.FCGI_END_REQUEST:
+            appStatus, protocolStatus = struct.unpack(
+                fcgi_app.FCGI_EndRequestBody, data)
+            ended[requestId] = (''.join(stdout.get(requestId, [])),
+                                protocolStatus)
+    return ended
+
+def stub_params(**headers):
+    params = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+              'PATH_INFO': '/', 'SERVER_NAME': 'localhost',
+              'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.0'}
+    for name, value in headers.items():
+        params['HTTP_X_STUB_' + name.upper()] = str(value)
+    return params
+
+def test_fcgi_app():
+    for server_class in server_classes:
+        server = start(server_class)
+        try:
+            app = FCGIApp(connect=server.address)
+            status, headers, body = call(app, make_environ(5000, 3, 512, 0))
+            assert status == '200 OK'
+            assert ('x-stub-2', 'value 2') in headers
+            assert body == make_body(5000)
+            assert request(app, make_environ(0, 0, 8192, 300000)) == 300000
+            assert request(app, make_environ(1024*1024, 2, 8192, 0)) == \
+                   1024*1024
+            assert server.requests == 3
+            assert wait_idle(server)
+        finally:
+            server.stop()
+
+def test_keep_conn_and_multiplexing():
+    for server_class in server_classes:
+        server = start(server_class)
+        try:
+            stream = connect(server)
+            send_request(stream, 1, stub_params(body_size=100000))
+            send_request(stream, 2, stub_params(body_size=10))
+            send_request(stream, 3, stub_params(echo=1), body='hello')
+            responses = read_responses(stream, 3)
+            assert responses[1][0].endswith(make_body(100000))
+            assert responses[2][0].endswith('\r\n\r\n' + make_body(10))
+            assert responses[3][0].endswith('\r\n\r\nhello')
+            assert responses[3][0].startswith('Status: 200 OK\r\n')
+            for body, status in responses.values():
+                assert status == fcgi_app.FCGI_REQUEST_COMPLETE
+            # The connection is still open for more:
+            stream.write(fcgi_app.FCGI_GET_VALUES, 0, ''.join(
+                [encode_pair(name, '') for name in
+                 [fcgi_app.FCGI_MAX_CONNS, fcgi_app.FCGI_MAX_REQS,
+                  fcgi_app.FCGI_MPXS_CONNS, 'OTHER']]))
+            type, requestId, data = stream.read()
+            assert type == fcgi_app.FCGI_GET_VALUES_RESULT
+            values = {}
+            pos = 0
+            while pos < len(data):
+                pos, (name, value) = decode_pair(data, pos)
+                values[name] = value
+            assert values == {'FCGI_MAX_CONNS': '64', 'FCGI_MAX_REQS': '64',
+                              'FCGI_MPXS_CONNS': '1'}, values
+            # Without FCGI_KEEP_CONN the server closes the connection:
+            send_request(stream, 4, stub_params(), keep_conn=False)
+            read_responses(stream, 1)
+            try:
+                stream.read()
+            except EOFError:
+                pass
+            else:
+                assert 0, 'EOFError expected'
+            stream.sock.close()
+        finally:
+            server.stop()
+
+def test_streaming():
+    for server_class in server_classes:
+        release = threading.Event()
+        server = start(server_class, waiting_app(release, 'first', 'second'))
+        try:
+            stream = connect(server)
+            send_request(stream, 1, stub_params())
+            type, requestId, data = stream.read()
+            assert type == fcgi_app.FCGI_STDOUT
+            assert data.endswith('\r\n\r\nfirst'), data
+            release.set()
+            type, requestId, data = stream.read()
+            assert data == 'second'
+            stream.sock.close()
+        finally:
+            server.stop()
+
+def test_overloaded():
+    for server_class in server_classes:
+        release = threading.Event()
+        server = start(server_class, waiting_app(release), maxReqs=1)
+        try:
+            stream = connect(server)
+            send_request(stream, 1, stub_params())
+            send_request(stream, 2, stub_params())
+            type, requestId, data = stream.read()
+            while type != fcgi_app.FCGI_END_REQUEST:
+                type, requestId, data = stream.read()
+            assert requestId == 2
+            assert struct.unpack(fcgi_app.FCGI_EndRequestBody, data)[1] == \
+                   fcgi_app.FCGI_OVERLOADED
+            release.set()
+            responses = read_responses(stream, 1)
+            assert responses[1][0].endswith('done')
+            stream.sock.close()
+        finally:
+            server.stop()
+
+def test_errors():
+    for server_class in server_classes:
+        def app(environ, start_response):
+            environ['wsgi.errors'].write('about to fail\n')
+            raise ValueError('oops')
+        server = start(server_class, app)
+        try:
+            stream = connect(server)
+            send_request(stream, 1, stub_params())
+            stderr = []
+            stdout = []
+            while True:
+                type, requestId, data = stream.read()
+                if type == fcgi_app.FCGI_STDERR:
+                    stderr.append(data)
+                elif type == fcgi_app.FCGI_STDOUT:
+                    stdout.append(data)
+                elif type == fcgi_app.FCGI_END_REQUEST:
+                    break
+            assert ''.join(stdout).startswith(
+                'Status: 500 Internal Server Error\r\n')
+            stderr = ''.join(stderr)
+            assert stderr.startswith('about to fail\n')
+            assert 'ValueError: oops' in stderr
+            assert wait_idle(server)
+            stream.sock.close()
+        finally:
+            server.stop()
+
+def test_disconnect_during_upload():
+    for server_class in server_classes:
+        server = start(server_class, maxReqs=2)
+        try:
+            for i in range(3):
+                stream = connect(server)
+                params = dict(stub_params(echo=1), CONTENT_LENGTH='100000')
+                stream.write(fcgi_app.FCGI_BEGIN_REQUEST, 1, struct.pack(
+                    fcgi_app.FCGI_BeginRequestBody,
+                    fcgi_app.FCGI_RESPONDER, fcgi_app.FCGI_KEEP_CONN))
+                stream.write(fcgi_app.FCGI_PARAMS, 1, ''.join(
+                    [encode_pair(name, value)
+                     for name, value in params.items()]))
+                stream.write(fcgi_app.FCGI_PARAMS, 1)
+                stream.write(fcgi_app.FCGI_STDIN, 1, 'x' * 1000)
+                stream.sock.close()
+                # Each request is seen, then released when it is dropped
+                end = time.time() + 5
+                while server.requests <= i and time.time() < end:
+                    time.sleep(0.01)
+                assert server.requests == i + 1
+                assert wait_idle(server), server.active
+            stream = connect(server)
+            send_request(stream, 1, stub_params(echo=1), body='hello')
+            responses = read_responses(stream, 1)
+            assert responses[1][1] == fcgi_app.FCGI_REQUEST_COMPLETE
+            assert responses[1][0].endswith('hello')
+            stream.sock.close()
+        finally:
+            server.stop()
+
+def test_malformed_params():
+    for server_class in server_classes:
+        server = start(server_class, maxReqs=1)
+        try:
+            for i in range(2):
+                stream = connect(server)
+                stream.write(fcgi_app.FCGI_BEGIN_REQUEST, 1, struct.pack(
+                    fcgi_app.FCGI_BeginRequestBody,
+                    fcgi_app.FCGI_RESPONDER, fcgi_app.FCGI_KEEP_CONN))
+                # A name length, and nothing after it
+                stream.write(fcgi_app.FCGI_PARAMS, 1, '\x05')
+                stream.write(fcgi_app.FCGI_PARAMS, 1)
+                stream.write(fcgi_app.FCGI_STDIN, 1)
+                responses = read_responses(stream, 1)
+                assert responses[1][0].startswith(
+                    'Status: 500 Internal Server Error\r\n'), responses
+                assert responses[1][1] == fcgi_app.FCGI_REQUEST_COMPLETE
+                stream.sock.close()
+            # A malformed record drops just its connection
+            stream = connect(server)
+            stream.write(fcgi_app.FCGI_BEGIN_REQUEST, 1, 'x')
+            try:
+                stream.read()
+            except (EOFError, socket.error):
+                pass
+            else:
+                assert 0, 'EOFError expected'
+            stream.sock.close()
+            assert wait_idle(server), server.active
+            status, headers, body = call(FCGIApp(connect=server.address),
+                                         make_environ(100, 0, 8192, 0))
+            assert status == '200 OK'
+            assert body == make_body(100)
+        finally:
+            server.stop()
@@ -0,0 +1,117 @@
+import os
+import time
+import shutil
+import tempfile
+from wphp import php_ini_metadata
+from wphp.php_ini_metadata import IniMetadata
+
+def test_not_loaded_on_import():
+    assert not php_ini_metadata.options.loaded
+    metadata = php_ini_metadata.get_metadata()
+    assert metadata is php_ini_metadata.get_metadata(
+        php_ini_metadata.php_ini_location)
+    # The module-level data is read the first time it is used:
+    assert 'precision' in php_ini_metadata.options_by_name
+    assert php_ini_metadata.options_by_name.loaded
+    assert php_ini_metadata.options.loaded
+    assert php_ini_metadata.options == metadata.options
+    assert php_ini_metadata.options_by_name['precision'].default == '12'
+
+def test_default_ini():
+    metadata = IniMetadata(php_ini_metadata.php_ini_location,
+                           cache_dir=tempfile.mkdtemp())
+    try:
+        op = metadata.get('precision')
+        assert op.default == '12'
+        assert op.section == 'PHP'
+        assert 'output_handler' in metadata
+        assert metadata.get('no_such_option') is None
+        assert op in metadata.section('PHP')
+        assert metadata.section('No such section') == []
+    finally:
+        shutil.rmtree(metadata.cache_dir)
+
+def test_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ini = os.path.join(tmp_dir, 'php.ini')
+        f = open(ini, 'w')
+        f.write('[PHP]\n; The memory limit\nmemory_limit = 8M\nempty =\n')
+        f.close()
+        metadata = IniMetadata(ini, cache_dir=tmp_dir)
+        assert metadata.get('memory_limit').description == 'The memory limit'
+        assert os.path.exists(metadata.cache_filename())
+        # A new object loads from the cache, not the file:
+        cached = IniMetadata(ini, cache_dir=tmp_dir)
+        assert cached.read_cache(os.path.getmtime(ini)) is not None
+        assert cached.get('memory_limit').default == '8M'
+        assert cached.get('empty').default == ''
+        assert type(cached.get('empty').default) is str
+        # Changing the file invalidates the cache:
+        f = open(ini, 'w')
+        f.write('[PHP]\nmemory_limit = 16M\n')
+        f.close()
+        os.utime(ini, (time.time() + 10, time.time() + 10))
+        assert cached.read_cache(os.path.getmtime(ini)) is None
+        cached.load()
+        assert cached.get('memory_limit').default == '16M'
+        assert cached.get('empty') is None
+    finally:
+        shutil.rmtree(tmp_dir)
+
+class ListLogger(object):
+    def __init__(self):
+        self.messages = []
+    def warning(self, msg, *args):
+        self.messages.append(msg % args)
+
+def test_check_options():
+    metadata_list = [php_ini_metadata.get_metadata()]
+    logger = ListLogger()
+    # Newer and extension directives are fine
+    php_ini_metadata.check_options(
+        {'session.cookie_httponly': '1', 'allow_url_include': 'Off',
+         'mysqli.default_host': 'db', 'user_ini.filename': ''},
+        metadata_list, logger)
+    assert logger.messages == []
+    # Other unknown names are only warned about
+    php_ini_metadata.check_options({'newrelic.appname': 'site'},
+                                   metadata_list, logger)
+    assert logger.messages == ["Unknown PHP option 'newrelic.appname'"]
+    # But likely misspellings are errors
+    try:
+        php_ini_metadata.check_options({'upload_max_filesiz': '8M'},
+                                       metadata_list, logger)
+    except ValueError, e:
+        assert "did you mean 'upload_max_filesize'" in str(e), str(e)
+    else:
+        assert 0, 'ValueError expected'
+
+def test_private_cache_dir():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = php_ini_metadata.private_cache_dir(tmp_dir)
+        assert path == os.path.join(tmp_dir,
+                                    'wphp-ini-cache-%s' % os.getuid())
+        assert os.stat(path).st_mode & 0777 == 0700
+        assert php_ini_metadata.private_cache_dir(tmp_dir) == path
+        # A directory others can write to isn't used
+        os.chmod(path, 0777)
+        assert php_ini_metadata.private_cache_dir(tmp_dir) is None
+        os.rmdir(path)
+        # Nor is a symlink planted in its place
+        os.symlink(tmp_dir, path)
+        assert php_ini_metadata.private_cache_dir(tmp_dir) is None
+        # Without a cache directory nothing is written
+        ini = os.path.join(tmp_dir, 'php.ini')
+        f = open(ini, 'w')
+        f.write('[PHP]\nmemory_limit = 8M\n')
+        f.close()
+        metadata = IniMetadata(ini)
+        metadata.cache_dir = None
+        assert metadata.get('memory_limit').default == '8M'
+        assert metadata.cache_filename() is None
+        assert sorted(os.listdir(tmp_dir)) == [
+            'php.ini', os.path.basename(path)]
+    finally:
+        shutil.rmtree(tmp_dir)
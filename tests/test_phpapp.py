@@ -0,0 +1,537 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from wphp import PHPApp, make_app, parse_size
+from fcgi_stub import StubResponder, stub_wrapper
+from bench_fcgi import make_environ
+
+php_files = os.path.join(os.path.dirname(__file__), 'php-files')
+
+def test_options():
+    app = PHPApp(php_files, php_options={'memory_limit': '32M',
+                                         'opcache.enable': '1'})
+    assert app.php_args == ['-d', 'memory_limit=32M',
+                            '-d', 'opcache.enable=1']
+    assert app.ini_filename is None
+
+def test_bad_options():
+    try:
+        PHPApp(php_files, php_options={'memory_limt': '32M'})
+    except ValueError, e:
+        assert "did you mean 'memory_limit'" in str(e), str(e)
+    else:
+        assert 0, 'ValueError expected'
+    try:
+        PHPApp(php_files, php_options={'memory_limit': '1\nevil=1'})
+    except ValueError, e:
+        assert 'line break' in str(e)
+    else:
+        assert 0, 'ValueError expected'
+    try:
+        PHPApp(php_files, php_preset='fast')
+    except ValueError, e:
+        assert 'production' in str(e)
+    else:
+        assert 0, 'ValueError expected'
+    app = PHPApp(php_files, php_options={'my_extension.opt': '1'},
+                 validate_options=False)
+    assert app.php_args == ['-d', 'my_extension.opt=1']
+    # Nothing can add lines to the generated php.ini, even with an
+    # unknown name or without validation
+    ini = os.path.join(php_files, 'test.php')
+    for options in [
+        {'zzcustom.thing': '1\nauto_prepend_file=/tmp/evil.php'},
+        {'zzcustom.thing': '1\rauto_prepend_file=/tmp/evil.php'},
+        {'auto_prepend_file=/tmp/evil.php\nx': '1'},
+        {'x=1;': '1'},
+        {'[evil': '1'},
+        ]:
+        for validate in True, False:
+            try:
+                PHPApp(php_files, php_ini=ini, php_options=options,
+                       validate_options=validate, logger=None)
+            except ValueError, e:
+                assert 'Bad PHP options' in str(e), str(e)
+            else:
+                assert 0, 'ValueError expected for %r' % options
+
+def test_generated_ini():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ini = os.path.join(tmp_dir, 'php.ini')
+        f = open(ini, 'w')
+        f.write('[PHP]\nmy_setting = 1\n')
+        f.close()
+        app = PHPApp(php_files, php_ini=ini, php_preset='production',
+                     php_options={'my_setting': '2',
+                                  'display_errors': 'On'})
+        assert app.php_args == ['-c', app.ini_filename]
+        assert app.ini_text.startswith('[PHP]\nmy_setting = 1\n')
+        assert 'my_setting = 2\n' in app.ini_text
+        assert 'display_errors = On\n' in app.ini_text
+        assert 'opcache.enable = 1\n' in app.ini_text
+        assert os.path.dirname(app.ini_filename) == app.ini_dir
+        assert os.stat(app.ini_dir).st_mode & 0777 == 0700
+        app.write_ini()
+        assert open(app.ini_filename).read() == app.ini_text
+        assert os.listdir(app.ini_dir) == [os.path.basename(app.ini_filename)]
+        app.close()
+        assert not os.path.exists(app.ini_filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_make_app():
+    app = make_app({}, base_dir=php_files, **{
+        'option memory_limit': '16M', 'validate_options': 'false'})
+    assert app.php_options == {'memory_limit': '16M'}
+    app = make_app({}, base_dir=php_files, **{
+        'pool reports size': '2',
+        'pool reports queue_timeout': '1.5',
+        'pool reports option memory_limit': '512M',
+        'route /reports/': 'reports',
+        'route /reports/*.php': 'default'})
+    reports = app.pools['reports']
+    assert reports.size == 2
+    assert reports.queue_timeout == 1.5
+    assert reports.php_args == ['-d', 'memory_limit=512M']
+    assert [pool.name for pattern, pool in app.routes] == [
+        'default', 'reports'], app.routes
+    app = make_app({}, base_dir=php_files, **{
+        'fcgi_endpoints': '10.0.0.1:9000 /var/run/php-fpm.sock',
+        'balance': 'p2c',
+        'pool reports endpoints': '10.0.0.2:9000'})
+    assert app.default_pool.endpoints == [('10.0.0.1', 9000),
+                                          '/var/run/php-fpm.sock']
+    assert app.default_pool.balance == 'p2c'
+    assert app.pools['reports'].endpoints == [('10.0.0.2', 9000)]
+
+def test_routes():
+    app = PHPApp(php_files, pools={'reports': {}, 'api': {}},
+                 routes=[('/reports/', 'reports'), ('*/api_*.php', 'api')])
+    def route(path):
+        return app.route(os.path.join(php_files, path)).name
+    assert route('test.php') == 'default'
+    assert route('reports/big.php') == 'reports'
+    assert route('v1/api_users.php') == 'api'
+    assert route('reports/api_x.php') == 'reports'
+    try:
+        PHPApp(php_files, routes=[('/x/', 'nope')])
+    except ValueError, e:
+        assert 'nope' in str(e)
+    else:
+        assert 0, 'ValueError expected'
+    try:
+        PHPApp(php_files, pools={'x': {'sise': 2}})
+    except ValueError, e:
+        assert "'sise'" in str(e)
+    else:
+        assert 0, 'ValueError expected'
+    try:
+        PHPApp(php_files, pools={'x': {'php_options': {'memory_limt': 1}}})
+    except ValueError, e:
+        assert 'memory_limit' in str(e)
+    else:
+        assert 0, 'ValueError expected'
+
+def stub_app(**kw):
+    tmp_dir = tempfile.mkdtemp()
+    kw.setdefault('logger', None)
+    app = PHPApp(php_files, php_script=stub_wrapper(tmp_dir),
+                 search_fcgi_port_starting=20000, **kw)
+    app.tmp_dir = tmp_dir
+    return app
+
+def close_app(app):
+    app.close()
+    shutil.rmtree(app.tmp_dir)
+
+def call(app, path='/test.php', **headers):
+    environ = make_environ(100, 0, 8192, 0)
+    environ['PATH_INFO'] = path
+    for name, value in headers.items():
+        environ['HTTP_X_STUB_' + name.upper()] = str(value)
+    result = []
+    def start_response(status, headers, exc_info=None):
+        result.append(status)
+        result.append(dict(headers))
+    app_iter = app(environ, start_response)
+    try:
+        result.append(''.join(app_iter))
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return result
+
+def test_reload():
+    app = stub_app()
+    try:
+        status, headers, body = call(app)
+        assert status == '200 OK'
+        first = app.backend
+        assert headers['x-stub-pid'] == str(first.pid)
+        app.reload(wait=True)
+        assert app.backend is not first
+        assert app.backend.generation == 1
+        assert first.proc.poll() is not None
+        status, headers, body = call(app)
+        assert headers['x-stub-pid'] == str(app.backend.pid)
+    finally:
+        close_app(app)
+
+def test_reload_drains():
+    app = stub_app()
+    try:
+        call(app)
+        first = app.backend
+        slow = []
+        t = threading.Thread(target=lambda: slow.append(call(app, delay=0.5)))
+        t.start()
+        while not first.active:
+            time.sleep(0.01)
+        app.reload()
+        # New requests go to the new process right away:
+        status, headers, body = call(app)
+        assert headers['x-stub-pid'] == str(app.backend.pid)
+        assert first.proc.poll() is None
+        t.join()
+        assert slow[0][0] == '200 OK'
+        assert slow[0][1]['x-stub-pid'] == str(first.pid)
+        while app.retiring:
+            time.sleep(0.01)
+        assert first.proc.poll() is not None
+    finally:
+        close_app(app)
+
+def test_threads_with_reloads():
+    # Requests from many threads while the backend is replaced
+    # under them: none may fail or be lost
+    app = stub_app(max_requests=40)
+    try:
+        call(app)
+        results = []
+        def worker():
+            for i in range(20):
+                status, headers, body = call(app)
+                results.append((status, headers['x-stub-pid']))
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        backends = set([app.backend])
+        while [t for t in threads if t.isAlive()]:
+            app.reload(wait=True)
+            backends.add(app.backend)
+        for t in threads:
+            t.join()
+        assert len(results) == 160
+        assert [status for status, pid in results] == ['200 OK'] * 160
+        assert len(backends) > 1
+        while app.retiring:
+            time.sleep(0.01)
+        for backend in backends:
+            assert backend.active == 0, backend
+        assert app.backend.begin()
+        app.backend.end()
+    finally:
+        close_app(app)
+
+def test_environ_unchanged():
+    app = stub_app()
+    try:
+        environ = make_environ(100, 0, 8192, 0)
+        orig = environ.copy()
+        app_iter = app(environ, lambda status, headers, exc_info=None: None)
+        ''.join(app_iter)
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+        assert environ == orig
+    finally:
+        close_app(app)
+
+class FileWrapper(object):
+    def __init__(self, fileobj, block_size=8192):
+        self.fileobj = fileobj
+        self.block_size = block_size
+    def __iter__(self):
+        return iter(lambda: self.fileobj.read(self.block_size), '')
+    def close(self):
+        self.fileobj.close()
+
+def test_file_wrapper():
+    app = stub_app(spool_size=1000)
+    try:
+        environ = make_environ(5000, 0, 8192, 0)
+        environ['wsgi.file_wrapper'] = FileWrapper
+        app_iter = app(environ, lambda status, headers, exc_info=None: None)
+        # The spooled response reaches the server's file_wrapper
+        assert isinstance(app_iter, FileWrapper), app_iter
+        assert len(''.join(app_iter)) == 5000
+        app_iter.close()
+        assert app.default_pool.active == 0
+        assert app.backend.active == 0
+    finally:
+        close_app(app)
+
+def test_timeout_recycles():
+    app = stub_app(request_timeout=0.2)
+    try:
+        call(app)
+        first = app.backend
+        status, headers, body = call(app, delay=1)
+        assert status == '504 Gateway Timeout'
+        assert app.timeouts['deadline'] == 1
+        end = time.time() + 10
+        while app.backend is first and time.time() < end:
+            time.sleep(0.01)
+        assert app.backend is not first
+        status, headers, body = call(app)
+        assert status == '200 OK'
+        assert headers['x-stub-pid'] == str(app.backend.pid)
+    finally:
+        close_app(app)
+
+def wait_for_new_backend(app, backend):
+    end = time.time() + 10
+    while app.backend is backend and time.time() < end:
+        time.sleep(0.01)
+    assert app.backend is not backend
+
+def test_backend_stats():
+    app = stub_app()
+    try:
+        call(app)
+        stats = app.backend_stats()
+        assert len(stats) == 1
+        assert stats[0]['pid'] == app.backend.pid
+        assert stats[0]['requests'] == 1
+        assert stats[0]['processes'] >= 1
+        assert stats[0]['rss'] > 0
+        assert stats[0]['cpu_time'] >= 0
+    finally:
+        close_app(app)
+
+def test_recycling():
+    app = stub_app(max_requests=2)
+    try:
+        call(app)
+        first = app.backend
+        call(app)
+        wait_for_new_backend(app, first)
+        assert call(app)[0] == '200 OK'
+    finally:
+        close_app(app)
+    app = stub_app(max_rss=1024, monitor_interval=0.05)
+    try:
+        call(app)
+        wait_for_new_backend(app, app.backend)
+    finally:
+        close_app(app)
+
+def test_parse_size():
+    assert parse_size('100') == 100
+    assert parse_size('8K') == 8192
+    assert parse_size('256m') == 256*1024*1024
+
+def test_pools():
+    app = stub_app(pools={'reports': {'size': 2,
+                                      'php_options': {'memory_limit': '512M'}}},
+                   routes=[('/test2.php', 'reports')])
+    try:
+        status, headers, body = call(app)
+        assert headers['x-stub-pid'] == str(app.backend.pid)
+        assert app.pools['reports'].backend is None
+        status, headers, body = call(app, path='/test2.php')
+        assert status == '200 OK'
+        reports = app.pools['reports'].backend
+        assert headers['x-stub-pid'] == str(reports.pid)
+        assert reports.pid != app.backend.pid
+        assert reports.env['PHP_FCGI_CHILDREN'] == '2'
+        assert 'memory_limit=512M' in reports.php_args
+        assert 'memory_limit=512M' not in app.backend.php_args
+        stats = app.backend_stats()
+        assert sorted([s['pool'] for s in stats]) == ['default', 'reports']
+        app.reload(wait=True)
+        assert app.pools['reports'].backend is not reports
+        assert reports.proc.poll() is not None
+        status, headers, body = call(app, path='/test2.php')
+        assert headers['x-stub-pid'] == str(app.pools['reports'].backend.pid)
+    finally:
+        close_app(app)
+
+def test_pool_queue():
+    app = stub_app(pools={'default': {'max_concurrency': 1, 'max_queue': 1}})
+    pool = app.default_pool
+    try:
+        results = []
+        def slow():
+            results.append(call(app, delay=0.3))
+        threads = [threading.Thread(target=slow) for i in range(2)]
+        threads[0].start()
+        while not pool.active:
+            time.sleep(0.01)
+        threads[1].start()
+        while not pool.waiting:
+            time.sleep(0.01)
+        # Both the slot and the queue are full:
+        assert call(app)[0].startswith('503')
+        for t in threads:
+            t.join()
+        assert [r[0] for r in results] == ['200 OK', '200 OK']
+        stats = app.pool_stats()['default']
+        assert stats['rejected'] == 1
+        assert stats['active'] == stats['waiting'] == 0
+        pool.queue_timeout = 0.05
+        pool.max_queue = None
+        t = threading.Thread(target=slow)
+        t.start()
+        while not pool.active:
+            time.sleep(0.01)
+        assert call(app)[0].startswith('503')
+        t.join()
+        assert call(app)[0] == '200 OK'
+    finally:
+        close_app(app)
+
+def start_stubs(tmp_dir):
+    return [StubResponder().start(), StubResponder().start(),
+            StubResponder(os.path.join(tmp_dir, 'fcgi.sock')).start()]
+
+def endpoint_app(stubs, **kw):
+    endpoints = []
+    for stub in stubs:
+        if isinstance(stub.address, str):
+            endpoints.append(stub.address)
+        else:
+            endpoints.append('%s:%s' % stub.address)
+    kw.setdefault('logger', None)
+    return PHPApp(php_files, fcgi_endpoints=endpoints, **kw)
+
+def test_endpoints():
+    tmp_dir = tempfile.mkdtemp()
+    stubs = start_stubs(tmp_dir)
+    app = endpoint_app(stubs, health_check_interval=0.05,
+                       eject_backoff=0.1)
+    try:
+        # Least outstanding requests: three slow requests at once go
+        # to different endpoints
+        results = []
+        threads = []
+        for i in range(3):
+            t = threading.Thread(
+                target=lambda: results.append(call(app, delay=0.3)))
+            t.start()
+            threads.append(t)
+            while sum([b.active for b in app.default_pool.remotes]) <= i:
+                time.sleep(0.01)
+        for t in threads:
+            t.join()
+        assert [r[0] for r in results] == ['200 OK'] * 3
+        assert [stub.requests for stub in stubs] == [1, 1, 1]
+        assert app.backend is None
+        assert app.default_pool.remotes[0].capacity['FCGI_MAX_CONNS'] == '64'
+        # A stopped endpoint is ejected, and its requests retried
+        address = stubs[0].address
+        stubs[0].stop()
+        remote = app.default_pool.remotes[0]
+        # Endpoints are chosen at random, so go on until it is tried
+        for i in range(100):
+            assert call(app)[0] == '200 OK'
+            if not remote.healthy:
+                break
+        assert not remote.healthy
+        assert stubs[0].requests == 1
+        stats = app.backend_stats()
+        assert [s['healthy'] for s in stats] == [False, True, True]
+        # Once it is back, a health check reinstates it
+        stubs[0] = StubResponder(address).start()
+        end = time.time() + 10
+        while not remote.healthy and time.time() < end:
+            time.sleep(0.01)
+        assert remote.healthy
+        assert remote.failures == 0
+    finally:
+        app.close()
+        for stub in stubs:
+            stub.stop()
+        shutil.rmtree(tmp_dir)
+
+def test_buffer_uploads_retry():
+    stubs = [StubResponder().start(), StubResponder().start()]
+    # Nothing listens on the first endpoint any more
+    stubs[0].stop()
+    app = endpoint_app(stubs, buffer_uploads=True, spool_size=1000,
+                       health_check_interval=0, eject_backoff=60)
+    try:
+        # Endpoints are chosen at random, so go on until the dead one
+        # has been tried
+        for i in range(100):
+            environ = make_environ(0, 0, 8192, 5000)
+            environ['HTTP_X_STUB_ECHO'] = '1'
+            result = []
+            def start_response(status, headers, exc_info=None):
+                result.append(status)
+            app_iter = app(environ, start_response)
+            try:
+                body = ''.join(app_iter)
+            finally:
+                app_iter.close()
+            assert result == ['200 OK']
+            assert body == 'x' * 5000, len(body)
+            remote = app.default_pool.remotes[0]
+            if not remote.healthy:
+                break
+        assert not remote.healthy
+        assert stubs[1].requests == i + 1
+    finally:
+        app.close()
+        stubs[1].stop()
+
+def test_endpoints_p2c():
+    tmp_dir = tempfile.mkdtemp()
+    stubs = start_stubs(tmp_dir)
+    app = endpoint_app(stubs, balance='p2c')
+    try:
+        for i in range(30):
+            assert call(app)[0] == '200 OK'
+        assert sum([stub.requests for stub in stubs]) == 30
+        assert min([stub.requests for stub in stubs]) > 0
+        # With every endpoint down, requests get a 502
+        for stub in stubs:
+            stub.stop()
+        assert call(app)[0] == '502 Bad Gateway'
+        assert app.connect_failures == 1
+        assert not [b for b in app.default_pool.remotes if b.healthy]
+        assert app.default_pool.active == 0
+    finally:
+        app.close()
+        shutil.rmtree(tmp_dir)
+    try:
+        PHPApp(php_files, balance='random')
+    except ValueError, e:
+        assert 'p2c' in str(e)
+    else:
+        assert 0, 'ValueError expected'
+
+def test_etag_memo():
+    app = stub_app(etag_memo=True)
+    try:
+        header = 'ETag: "v1"|Cache-Control: max-age=60'
+        assert call(app, header=header)[0] == '200 OK'
+        app.close()
+        # PHP isn't needed to answer a matching conditional request
+        status, headers, body = call_conditional(app, '"v1"')
+        assert status == '304 Not Modified'
+        assert app.etag_memo.hits == 1
+    finally:
+        close_app(app)
+
+def call_conditional(app, etag):
+    environ = make_environ(100, 0, 8192, 0)
+    environ['HTTP_IF_NONE_MATCH'] = etag
+    result = []
+    def start_response(status, headers, exc_info=None):
+        result.append(status)
+        result.append(dict(headers))
+    result.append(''.join(app(environ, start_response)))
+    return result
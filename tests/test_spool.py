@@ -0,0 +1,37 @@
+from wphp.spool import SpooledBuffer, FileIter
+
+def test_in_memory():
+    buf = SpooledBuffer(100)
+    buf.write('a' * 50)
+    buf.write('b' * 50)
+    assert not buf.spilled
+    assert buf.size == 100
+    assert buf.getvalue() == 'a' * 50 + 'b' * 50
+    assert buf.reader().read() == buf.getvalue()
+    assert buf.app_iter({}) == [buf.getvalue()]
+
+def test_spilled():
+    buf = SpooledBuffer(100)
+    buf.write('a' * 60)
+    buf.write('b' * 60)
+    assert buf.spilled
+    assert not buf.chunks
+    buf.write('c')
+    assert buf.size == 121
+    assert buf.reader().read() == 'a' * 60 + 'b' * 60 + 'c'
+    app_iter = buf.app_iter({}, block_size=50)
+    assert isinstance(app_iter, FileIter)
+    assert [len(block) for block in app_iter] == [50, 50, 21]
+    app_iter.close()
+    assert app_iter.fileobj.closed
+
+def test_file_wrapper():
+    wrapped = []
+    def file_wrapper(fileobj, block_size):
+        wrapped.append(block_size)
+        return [fileobj.read()]
+    buf = SpooledBuffer(10)
+    buf.write('x' * 20)
+    assert buf.app_iter({'wsgi.file_wrapper': file_wrapper}) == ['x' * 20]
+    assert wrapped == [65536]
+    buf.close()
@@ -9,11 +9,27 @@ import atexit
 import signal
 import time
 import posixpath
-import subprocess
+import fnmatch
+import re
+import tempfile
+import shutil
+import errno
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 from paste import fileapp
 from paste.request import construct_url
-from paste.httpexceptions import HTTPMovedPermanently, HTTPNotFound
+from paste.wsgilib import add_close
+from paste.httpexceptions import HTTPMovedPermanently, HTTPNotFound, \
+     HTTPServiceUnavailable, HTTPBadGateway
+from paste.util.converters import asbool, aslist
 from wphp import fcgi_app
+from wphp import php_ini_metadata
+from wphp.compress import CompressMiddleware
+from wphp.etag import ETagMemoMiddleware
+from wphp.backend import PHPBackend, RemoteBackend, BackendPool
+from wphp.spool import spool_input
 
 here = os.path.dirname(__file__)
 default_php_ini = os.path.join(here, 'default-php.ini')
@@ -24,10 +40,43 @@ class PHPApp(object):
                  php_script='php-cgi',
                  php_ini=None,
                  php_options=None,
+                 php_preset=None,
+                 validate_options=True,
                  fcgi_port=None,
                  search_fcgi_port_starting=10000,
                  logger='wphp',
-                 log_level=None):
+                 log_level=None,
+                 compress=False,
+                 compress_min_size=1024,
+                 compress_types=None,
+                 compress_level=6,
+                 stream=False,
+                 stream_coalesce_size=0,
+                 stream_coalesce_delay=0,
+                 etag_memo=False,
+                 etag_memo_max_age=None,
+                 etag_memo_size=10000,
+                 spool_size=1024*1024,
+                 spool_dir=None,
+                 buffer_uploads=False,
+                 drain_timeout=30,
+                 reload_on_sighup=False,
+                 connect_timeout=None,
+                 send_timeout=None,
+                 first_byte_timeout=None,
+                 request_timeout=None,
+                 recycle_on_timeout=True,
+                 max_rss=None,
+                 max_requests=None,
+                 max_age=None,
+                 monitor_interval=10,
+                 pools=None,
+                 routes=None,
+                 fcgi_endpoints=None,
+                 balance='least_outstanding',
+                 health_check_interval=5,
+                 eject_backoff=1,
+                 max_eject_backoff=60):
         """
         Create a WSGI wrapper around a PHP application.
 
@@ -48,12 +97,117 @@ class PHPApp(object):
         `php_options` is a dictionary of config-name: value, of
         specific overrides for PHP options.  For instance,
         ``{'magic_quotes_gpc': 'Off'}`` will turn off magic quotes.
+        Unless `validate_options` is false, the option names are
+        checked against the directives in `php_ini` and
+        ``default-php.ini`` (and some common extension directives,
+        in `php_ini_metadata.extra_options`).  A ValueError is
+        raised for an unknown option that looks like a misspelling of
+        a known one; other unknown options are logged as warnings.
+
+        `php_preset` names a set of options from
+        `php_ini_metadata.presets` (e.g., ``'production'``, which
+        turns on the opcode and realpath caches and turns off
+        displaying errors); `php_options` override the preset.
+
+        When `php_ini` is given, it and the options are written to a
+        generated ``php.ini`` file (see `ini_text`), which is passed
+        to PHP.  It is written in a private directory (in
+        `spool_dir`, or the default temporary directory) that is
+        removed by `close()`.  Otherwise PHP's own ``php.ini`` is used, with the
+        options given on the command line.
 
         PHP is started as a long-running FastCGI process.  PHP (from
         what I can tell) only supports listening over IP sockets, so
         we must get a port for it.  You may provide a specific port
         (with `fcgi_port`) or give a starting port number (default
         10000), and the first free port will be used.
+
+        If `compress` is true, responses from PHP are gzip (or brotli)
+        compressed in Python, which leaves the PHP process free to
+        handle the next request; you should turn off
+        ``zlib.output_compression`` then.  Only responses of at least
+        `compress_min_size` bytes, with a content type starting with
+        one of `compress_types` (text and the common text-based
+        application types by default), are compressed.
+        `compress_level` is the zlib compression level.
+
+        If `stream` is true, response bodies are passed on as PHP
+        sends them, instead of after the whole response has been
+        read, so output that PHP ``flush()``es (like the ``<head>`` of
+        a long page) reaches the client right away, compressed or
+        not.  Pieces smaller than `stream_coalesce_size` bytes are
+        joined with the pieces that follow within
+        `stream_coalesce_delay` seconds (see
+        `wphp.fcgi_app.FCGIApp`).
+
+        If `etag_memo` is true, the ETags of PHP responses that may be
+        cached (with a ``Cache-Control`` max-age) are remembered, and
+        conditional requests for the same URL are answered with 304
+        Not Modified without running PHP, for the max-age (or
+        `etag_memo_max_age` seconds, if that is less), for up to
+        `etag_memo_size` URLs.  See `wphp.etag`.
+
+        Unless they are streamed, responses are buffered in memory up
+        to `spool_size` bytes, and in a temporary file (in
+        `spool_dir`) when they are bigger.  If `buffer_uploads` is
+        true, request bodies are read (and spooled the same way)
+        before they are sent to PHP, so slow uploads don't keep a PHP
+        process waiting.
+
+        `reload()` restarts PHP without dropping requests: requests in
+        progress are given `drain_timeout` seconds to finish on the
+        old PHP process.  If `reload_on_sighup` is true, a SIGHUP
+        signal triggers a reload.
+
+        `connect_timeout`, `send_timeout` (for sending the request to
+        PHP), `first_byte_timeout` (for the start of PHP's response)
+        and `request_timeout` (for the whole request) are in seconds,
+        and are all unlimited by default.  A request that times out
+        is aborted and gets a 504 Gateway Timeout response; the counts
+        are in `timeouts`.  A request that can't connect to PHP (or
+        to any of the `fcgi_endpoints`) gets a 502 Bad Gateway
+        response, counted in `connect_failures`.  Since a PHP process
+        that timed out is
+        probably stuck, it is replaced with a new one (like a reload)
+        unless `recycle_on_timeout` is false.
+
+        The PHP process is also replaced (gracefully, like a reload)
+        when it reaches `max_requests` requests, is older than
+        `max_age` seconds, or its memory use (the total RSS of the
+        PHP processes, in bytes) is over `max_rss`.  Age and memory
+        are checked every `monitor_interval` seconds, by a thread that
+        reads ``/proc``.  `backend_stats()` gives the resource usage
+        of the PHP processes.
+
+        `pools` gives some scripts PHP processes of their own, so
+        that (for instance) slow reports can't hold up the rest of
+        the application.  It is a dictionary of pool name to a
+        dictionary of settings for `wphp.backend.BackendPool`: `size`
+        (the number of PHP worker processes), `php_options` (added to
+        `php_options`), `max_concurrency`, `max_queue` and
+        `queue_timeout`.  Requests that a pool rejects get a 503
+        Service Unavailable response.  `routes` is a list of
+        ``(pattern, pool_name)``; the script path (found with
+        `find_script`, relative to `base_dir`, starting with ``/``) is
+        matched against each pattern in turn, as a prefix or, if the
+        pattern contains ``*``, ``?`` or ``[``, as a glob.  Other
+        scripts go to the ``default`` pool, which can also be given
+        settings in `pools`.  Each pool's PHP process is started when
+        it gets its first request; the timeouts and recycling limits
+        apply to every pool.
+
+        Instead of running PHP itself, the app can send requests to
+        FastCGI servers that are already running, like PHP-FPM on
+        other hosts: `fcgi_endpoints` is a list of ``host:port``
+        addresses or Unix socket filenames (pools can also be given
+        `endpoints`).  Requests are balanced over the endpoints by
+        `balance`, ``'least_outstanding'`` or ``'p2c'`` (the "power
+        of two choices").  An endpoint that refuses a connection, or
+        fails a health check (an ``FCGI_GET_VALUES`` request, every
+        `health_check_interval` seconds), is ejected for
+        `eject_backoff` seconds, doubling up to `max_eject_backoff`
+        while it keeps failing.  A request that couldn't connect to
+        an endpoint is retried on another one.
         """
         self.base_dir = base_dir
         self.fcgi_port = fcgi_port
@@ -61,8 +215,73 @@ class PHPApp(object):
         self.php_ini = php_ini
         if php_options is None:
             php_options = {}
+        if php_preset:
+            if php_preset not in php_ini_metadata.presets:
+                raise ValueError(
+                    "Unknown php_preset %r (choose from: %s)"
+                    % (php_preset,
+                       ', '.join(sorted(php_ini_metadata.presets))))
+            options = php_ini_metadata.presets[php_preset].copy()
+            options.update(php_options)
+            php_options = options
         self.php_options = php_options
+        self.validate_options = validate_options
+        self.pools = {}
+        pools = dict(pools or {})
+        pools.setdefault('default', {})
+        for name, settings in pools.items():
+            settings = dict(settings)
+            settings.setdefault('balance', balance)
+            if name == 'default' and fcgi_endpoints:
+                settings.setdefault('endpoints', fcgi_endpoints)
+            for key in settings:
+                if key not in BackendPool.settings:
+                    raise ValueError(
+                        "Unknown setting %r for pool %r (choose from: %s)"
+                        % (key, name, ', '.join(BackendPool.settings)))
+            self.pools[name] = BackendPool(name, **settings)
+        self.default_pool = self.pools['default']
+        self.default_pool.port = fcgi_port
+        self.routes = []
+        for pattern, name in routes or []:
+            if name not in self.pools:
+                raise ValueError(
+                    "Route %r is to unknown pool %r" % (pattern, name))
+            if not pattern.startswith('/'):
+                pattern = '/' + pattern
+            for char in '*?[':
+                if char in pattern:
+                    pattern = re.compile(fnmatch.translate(pattern))
+                    break
+            self.routes.append((pattern, self.pools[name]))
+        self._route_cache = {}
         self.search_fcgi_port_starting = search_fcgi_port_starting
+        self.drain_timeout = drain_timeout
+        self.fcgi_options = dict(
+            connectTimeout=connect_timeout, sendTimeout=send_timeout,
+            firstByteTimeout=first_byte_timeout, timeout=request_timeout,
+            stream=stream, coalesceSize=stream_coalesce_size,
+            coalesceDelay=stream_coalesce_delay, spoolSize=spool_size,
+            spoolDir=spool_dir)
+        self.buffer_uploads = buffer_uploads
+        self.spool_size = spool_size
+        self.spool_dir = spool_dir
+        # The private directory for generated php.ini files:
+        self.ini_dir = None
+        self.recycle_on_timeout = recycle_on_timeout
+        self.max_rss = max_rss
+        self.max_requests = max_requests
+        self.max_age = max_age
+        self.monitor_interval = monitor_interval
+        self.monitor_thread = None
+        self.health_check_interval = health_check_interval
+        self.eject_backoff = eject_backoff
+        self.max_eject_backoff = max_eject_backoff
+        self.health_thread = None
+        self.closed = False
+        self.timeouts = {'connect': 0, 'send': 0, 'first_byte': 0,
+                         'deadline': 0}
+        self.connect_failures = 0
         if log_level:
             log_level = logging._levelNames[log_level]
         if logger == 'stdout':
@@ -78,15 +297,65 @@ class PHPApp(object):
             logger.setLevel(log_level)
         
         self.logger = logger
+        self.compile_options()
         
         self.lock = threading.Lock()
-        self.child_pid = None
-        self.fcgi_app = None
+        self.reload_lock = threading.Lock()
+        if compress:
+            self.php_app = CompressMiddleware(
+                self.call_backend, min_size=compress_min_size,
+                types=compress_types, level=compress_level,
+                flush=stream)
+        else:
+            self.php_app = self.call_backend
+        if etag_memo:
+            self.etag_memo = ETagMemoMiddleware(
+                self.php_app, max_age=etag_memo_max_age, size=etag_memo_size)
+            self.php_app = self.etag_memo
+        else:
+            self.etag_memo = None
+        if reload_on_sighup:
+            self.reload_on_signal(signal.SIGHUP)
+
+    def backend(self):
+        """The current `PHPBackend` of the default pool"""
+        return self.default_pool.backend
+    backend = property(backend)
+
+    def generation(self):
+        """The generation of the default pool's PHP process"""
+        return self.default_pool.generation
+    generation = property(generation)
+
+    def retiring(self):
+        """The backends (of all pools) that are being retired"""
+        retiring = []
+        for pool in self.pools.values():
+            retiring.extend(pool.retiring)
+        return retiring
+    retiring = property(retiring)
+
+    def child_pid(self):
+        """The PID of the current PHP process"""
+        if self.backend is None:
+            return None
+        return self.backend.pid
+    child_pid = property(child_pid)
+
+    def fcgi_app(self):
+        """The `FCGIApp` for the current PHP process"""
+        if self.backend is None:
+            return None
+        return self.backend.fcgi_app
+    fcgi_app = property(fcgi_app)
 
     # These are the filenames of "index" files:
     index_names = ['index.html', 'index.htm', 'index.php']
 
     def __call__(self, environ, start_response):
+        # The variables set here are for PHP; the caller's environ is
+        # left as it was
+        environ = environ.copy()
         if 'REQUEST_URI' not in environ:
             # PHP likes to have this variable
             environ['REQUEST_URI'] = (
@@ -94,11 +363,6 @@ class PHPApp(object):
                 + environ.get('PATH_INFO', ''))
             if environ.get('QUERY_STRING'):
                 environ['REQUEST_URI'] += '?'+environ['QUERY_STRING']
-        if self.child_pid is None:
-            if environ['wsgi.multiprocess']:
-                environ['wsgi.errors'].write(
-                    "wphp doesn't support multiprocess apps very well yet")
-            self.create_child()
         path_info = environ.get('PATH_INFO', '').lstrip('/')
         full_path = os.path.join(self.base_dir, path_info)
         if (os.path.isdir(full_path)
@@ -127,12 +391,124 @@ class PHPApp(object):
         if self.logger:
             self.logger.debug(
                 'Found script at %s', script_filename)
+        pool = self.route(script_filename)
+        if not pool.started:
+            if environ['wsgi.multiprocess']:
+                environ['wsgi.errors'].write(
+                    "wphp doesn't support multiprocess apps very well yet")
+            self.create_child(pool)
+        environ['wphp.pool'] = pool.name
         if (environ['REQUEST_METHOD'] == 'POST'
             and not environ.get('CONTENT_TYPE')):
             environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
-        app_iter = self.fcgi_app(environ, start_response)
+        app_iter = self.php_app(environ, start_response)
         return app_iter
 
+    def call_backend(self, environ, start_response):
+        """
+        Sends the request to the current PHP process of its pool
+        (``environ['wphp.pool']``), keeping track of the requests in
+        progress so that reloads can wait for them.
+
+        With `buffer_uploads` the request body is spooled once, as
+        ``environ['wphp.spooled_input']``, so that a request retried
+        on another endpoint sends the same body.
+        """
+        pool = self.pools[environ.get('wphp.pool', 'default')]
+        if not pool.acquire():
+            if self.logger:
+                self.logger.warning(
+                    'Pool %s is busy; rejected request to %s'
+                    % (pool.name, environ.get('SCRIPT_NAME')))
+            exc = HTTPServiceUnavailable()
+            return exc(environ, start_response)
+        spooled = None
+        if self.buffer_uploads:
+            try:
+                spooled = spool_input(environ, self.spool_size,
+                                      self.spool_dir)
+            except:
+                pool.release()
+                raise
+            environ['wphp.spooled_input'] = spooled
+        attempts = 0
+        while True:
+            backend = pool.choose()
+            number = backend.begin()
+            if not number:
+                # The backend was retired by a reload just now
+                continue
+            if (self.max_requests and backend.managed
+                and number >= self.max_requests):
+                self.recycle_in_thread(
+                    backend, 'served %s requests' % number)
+            try:
+                app_iter = backend.fcgi_app(environ, start_response)
+            except socket.error, e:
+                backend.end()
+                attempts += 1
+                connect_error = e.args and e.args[0] in _connect_errors
+                if not backend.managed and connect_error:
+                    # Nothing was sent, so another endpoint can be tried
+                    backend.eject('could not connect: %s' % e)
+                    if attempts < len(pool.remotes):
+                        continue
+                if spooled is not None:
+                    spooled.close()
+                pool.release()
+                if not connect_error:
+                    raise
+                return self.connect_failed(backend, environ, e,
+                                           start_response)
+            except:
+                backend.end()
+                if spooled is not None:
+                    spooled.close()
+                pool.release()
+                raise
+            break
+        if spooled is not None:
+            # The body has been sent
+            spooled.close()
+        def end():
+            backend.end()
+            pool.release()
+        if not self.fcgi_options['stream']:
+            # The whole response has been read from PHP already; the
+            # app_iter is passed on untouched, so a wsgi.file_wrapper
+            # for a spooled body reaches the server
+            end()
+            return app_iter
+        return add_close(app_iter, end)
+
+    # Number of script filenames to remember the pool for:
+    route_cache_size = 10000
+
+    def route(self, script_filename):
+        """
+        Returns the `wphp.backend.BackendPool` for the script (a full
+        filename), from `routes`.
+        """
+        try:
+            return self._route_cache[script_filename]
+        except KeyError:
+            pass
+        path = os.path.relpath(script_filename, self.base_dir)
+        path = '/' + path.replace(os.path.sep, '/')
+        pool = self.default_pool
+        for pattern, route_pool in self.routes:
+            if isinstance(pattern, basestring):
+                if path.startswith(pattern):
+                    pool = route_pool
+                    break
+            elif pattern.match(path):
+                pool = route_pool
+                break
+        if len(self._route_cache) >= self.route_cache_size:
+            self._route_cache.clear()
+        self._route_cache[script_filename] = pool
+        return pool
+
     def find_script(self, base, path):
         """
         Given a path, finds the file the path points to, and the extra
@@ -168,60 +544,407 @@ class PHPApp(object):
             else:
                 return path, path_info
 
-    def create_child(self):
+    def create_child(self, pool=None):
         """
-        Creates the PHP subprocess, with some locking and whatnot, and
-        creates the WSGI application wrapper around that.
+        Creates the PHP subprocess for `pool` (the default pool if
+        not given), with some locking and whatnot, and creates the
+        WSGI application wrapper around that.
         """
-        self.lock.acquire()
+        if pool is None:
+            pool = self.default_pool
+        # reload_lock makes sure two pools don't pick the same port
+        self.reload_lock.acquire()
         try:
-            if self.child_pid:
+            if pool.started:
+                return
+            if pool.endpoints:
+                remotes = [RemoteBackend(address, logger=self.logger,
+                                         fcgi_options=self.fcgi_options,
+                                         on_timeout=self.backend_timed_out,
+                                         pool=pool,
+                                         backoff=self.eject_backoff,
+                                         max_backoff=self.max_eject_backoff)
+                           for address in pool.endpoints]
+                pool.swap(remotes=remotes)
+                self.start_health_checks()
                 return
             if self.logger:
-                self.logger.info('Spawning PHP process')
-            if self.fcgi_port is None:
-                self.fcgi_port = self.find_port()
-            self.spawn_php(self.fcgi_port)
-            self.fcgi_app = fcgi_app.FCGIApp(
-                connect=('127.0.0.1', self.fcgi_port),
-                filterEnviron=False)
+                self.logger.info('Spawning PHP process for pool %s'
+                                 % pool.name)
+            if pool.port is None:
+                pool.port = self.find_port()
+            backend = self.spawn_php(pool.port, pool)
+            pool.swap(backend)
+            if pool is self.default_pool:
+                self.fcgi_port = pool.port
+            atexit.register(self.close)
+            self.start_monitor()
+        finally:
+            self.reload_lock.release()
+
+    def spawn_php(self, port, pool=None):
+        """
+        Creates a PHP process for `pool` (the default pool if not
+        given) that listens for FastCGI requests on the given port,
+        returning its `PHPBackend`.
+        """
+        if pool is None:
+            pool = self.default_pool
+        if pool.ini_filename:
+            self.write_ini(pool)
+        backend = PHPBackend(self.php_script, pool.php_args, port,
+                             generation=pool.generation,
+                             logger=self.logger,
+                             fcgi_options=self.fcgi_options,
+                             on_timeout=self.backend_timed_out,
+                             children=pool.size,
+                             pool=pool)
+        backend.start()
+        return backend
+
+    def reload(self, wait=False):
+        """
+        Restarts PHP without interrupting requests.
+
+        `php_ini` and `php_options` are read again, and a new PHP
+        process is started (for each pool that has been started, and
+        doesn't use `fcgi_endpoints`).
+        Once it accepts connections new requests go to it, while the
+        old process is given `drain_timeout` seconds to finish its
+        requests before it is terminated.  That happens in a
+        background thread, unless `wait` is true.
+
+        If a new process fails to start, the old one keeps serving
+        requests and the error is raised.
+        """
+        self.compile_options()
+        for pool in self.pools.values():
+            if pool.endpoints:
+                continue
+            if pool.backend is not None or pool is self.default_pool:
+                self.replace_backend(pool, None, wait)
+
+    def recycle(self, backend, wait=False):
+        """
+        Replaces `backend` with a new PHP process (with the same
+        options), if it is still the current one.  The old process is
+        drained and terminated like in `reload()`.
+        """
+        self.replace_backend(backend.pool, backend, wait)
+
+    def replace_backend(self, pool, expected, wait):
+        self.reload_lock.acquire()
+        try:
+            if expected is not None and pool.backend is not expected:
+                # Already replaced
+                return
+            pool.generation += 1
+            if self.logger:
+                self.logger.info(
+                    'Starting PHP generation %s of pool %s'
+                    % (pool.generation, pool.name))
+            backend = self.spawn_php(self.find_port(), pool)
+            self.lock.acquire()
+            try:
+                old = pool.swap(backend).backend
+                if old is not None:
+                    pool.retiring.append(old)
+            finally:
+                self.lock.release()
+        finally:
+            self.reload_lock.release()
+        if old is None:
+            atexit.register(self.close)
+            self.start_monitor()
+        elif wait:
+            self.retire(old)
+        else:
+            t = threading.Thread(target=self.retire, args=(old,))
+            t.setDaemon(True)
+            t.start()
+
+    def connect_failed(self, backend, environ, error, start_response):
+        """
+        Answers a request that couldn't be sent to any backend (the
+        last one tried was `backend`) with 502 Bad Gateway.
+        """
+        self.lock.acquire()
+        try:
+            self.connect_failures += 1
         finally:
             self.lock.release()
+        if self.logger:
+            self.logger.error(
+                'Could not connect to PHP for %s (last tried %r): %s'
+                % (environ.get('SCRIPT_NAME'), backend, error))
+        exc = HTTPBadGateway()
+        return exc(environ, start_response)
 
-    def spawn_php(self, port):
+    def backend_timed_out(self, backend, environ, kind):
         """
-        Creates a PHP process that listens for FastCGI requests on the
-        given port.
+        Called when a request to `backend` times out.
         """
-        cmd = [self.php_script,
-               '-b',
-               '127.0.0.1:%s' % self.fcgi_port]
-        if self.php_ini:
-            cmd.extend([
-                '-c', self.php_ini])
-        for name, value in self.php_options.items():
-            cmd.extend([
-                '-d', '%s=%s' % (name, value)])
-        env = os.environ.copy()
-        env['PHP_FCGI_CHILDREN'] = '1'
-        proc = subprocess.Popen(cmd, env=env)
-        self.child_pid = proc.pid
+        self.lock.acquire()
+        try:
+            self.timeouts[kind] += 1
+        finally:
+            self.lock.release()
         if self.logger:
-            self.logger.info(
-                'PHP process spawned in PID %s, port %s'
-                % (self.child_pid, self.fcgi_port))
-        atexit.register(self.close)
-        # PHP doesn't start up *quite* right away, so we give it a
-        # moment to be ready to accept connections
-        while 1:
+            self.logger.warning(
+                'Request to %s timed out (%s timeout) on %r'
+                % (environ.get('SCRIPT_NAME'), kind, backend))
+        if not backend.managed:
+            if kind == 'connect':
+                backend.eject('connect timed out')
+            return
+        if self.recycle_on_timeout and kind != 'connect':
+            self.recycle_in_thread(backend, 'request timed out')
+
+    def recycle_in_thread(self, backend, reason):
+        """
+        Recycles the backend in a new thread, logging `reason`.
+        Does nothing if the backend is already being recycled.
+        """
+        if not backend.claim_recycle():
+            return
+        if self.logger:
+            self.logger.info('Recycling %r: %s' % (backend, reason))
+        t = threading.Thread(target=self._recycle, args=(backend,))
+        t.setDaemon(True)
+        t.start()
+
+    def _recycle(self, backend):
+        try:
+            self.recycle(backend)
+        except Exception, e:
+            # Let it be tried again
+            backend.recycling = False
+            if self.logger:
+                self.logger.exception('Error recycling PHP: %s' % e)
+
+    def backend_stats(self):
+        """
+        Returns a list of dictionaries with the resource usage of the
+        current PHP processes and any that are being retired (see
+        `wphp.backend.PHPBackend.sample`).
+        """
+        return [backend.sample() for backend in self.all_backends()]
+
+    def pool_stats(self):
+        """
+        Returns a dictionary of pool name to the pool's request counts
+        (see `wphp.backend.BackendPool.stats`).
+        """
+        stats = {}
+        for name, pool in self.pools.items():
+            stats[name] = pool.stats()
+        return stats
+
+    def all_backends(self):
+        """
+        Returns the current backends of all the pools, followed by the
+        backends that are being retired.
+        """
+        self.lock.acquire()
+        try:
+            backends = []
+            retiring = []
+            for name, pool in sorted(self.pools.items()):
+                state = pool.state
+                if state.backend is not None:
+                    backends.append(state.backend)
+                backends.extend(state.remotes)
+                retiring.extend(pool.retiring)
+        finally:
+            self.lock.release()
+        return backends + retiring
+
+    def start_monitor(self):
+        """
+        Starts the thread that checks `max_rss` and `max_age`, if
+        they are set.
+        """
+        if self.monitor_thread is not None or not (
+            self.max_rss or self.max_age):
+            return
+        self.monitor_thread = threading.Thread(target=self.monitor)
+        self.monitor_thread.setDaemon(True)
+        self.monitor_thread.start()
+
+    def monitor(self):
+        while not self.closed:
+            time.sleep(self.monitor_interval)
+            for pool in self.pools.values():
+                backend = pool.backend
+                if backend is None or self.closed:
+                    # Not started, or uses fcgi_endpoints
+                    continue
+                try:
+                    self.check_backend(backend)
+                except Exception, e:
+                    if self.logger:
+                        self.logger.exception(
+                            'Error checking PHP process: %s' % e)
+
+    def start_health_checks(self):
+        """
+        Starts the thread that checks the `fcgi_endpoints`.
+        """
+        if self.health_thread is not None or not self.health_check_interval:
+            return
+        self.health_thread = threading.Thread(target=self.health_checks)
+        self.health_thread.setDaemon(True)
+        self.health_thread.start()
+
+    def health_checks(self):
+        timeout = self.fcgi_options['connectTimeout'] or 1
+        while not self.closed:
+            time.sleep(self.health_check_interval)
+            for pool in self.pools.values():
+                for backend in pool.remotes:
+                    if self.closed:
+                        return
+                    try:
+                        backend.health_check(timeout)
+                    except Exception, e:
+                        if self.logger:
+                            self.logger.exception(
+                                'Error checking %r: %s' % (backend, e))
+
+    def check_backend(self, backend):
+        """
+        Samples the backend's resource usage, and recycles it if it is
+        over `max_rss` or `max_age`.
+        """
+        stats = backend.sample()
+        if (self.max_rss and stats['rss'] is not None
+            and stats['rss'] > self.max_rss):
+            self._recycle_for(backend, 'using %s bytes of memory (max_rss %s)'
+                              % (stats['rss'], self.max_rss))
+        elif self.max_age and stats['age'] > self.max_age:
+            self._recycle_for(backend, '%i seconds old (max_age %s)'
+                              % (stats['age'], self.max_age))
+
+    def _recycle_for(self, backend, reason):
+        if not backend.claim_recycle():
+            return
+        if self.logger:
+            self.logger.info('Recycling %r: %s' % (backend, reason))
+        self._recycle(backend)
+
+    def retire(self, backend):
+        backend.retire(self.drain_timeout)
+        self.lock.acquire()
+        try:
+            if backend in backend.pool.retiring:
+                backend.pool.retiring.remove(backend)
+        finally:
+            self.lock.release()
+
+    def reload_on_signal(self, signum=signal.SIGHUP):
+        """
+        Installs a signal handler that reloads PHP (in a new thread)
+        when the signal is received.  Like all signal handlers, this
+        must be called from the main thread.
+        """
+        def handler(signum, frame):
+            t = threading.Thread(target=self._reload_from_signal)
+            t.setDaemon(True)
+            t.start()
+        signal.signal(signum, handler)
+
+    def _reload_from_signal(self):
+        try:
+            self.reload()
+        except Exception, e:
+            if self.logger:
+                self.logger.exception('Error reloading PHP: %s' % e)
+
+    def compile_options(self):
+        """
+        Validates `php_options`, and computes the arguments for PHP
+        (`php_args`) and the generated ``php.ini`` (`ini_text` and
+        `ini_filename`, or None if no `php_ini` was given).  The same
+        attributes are set on each pool, for `php_options` with the
+        pool's own options added.
+        """
+        if self.validate_options:
+            metadata_list = [php_ini_metadata.get_metadata(default_php_ini)]
+            if self.php_ini and not os.path.isdir(self.php_ini):
+                metadata_list.append(php_ini_metadata.get_metadata(self.php_ini))
+            php_ini_metadata.check_options(self.php_options, metadata_list,
+                                           self.logger)
+            for pool in self.pools.values():
+                php_ini_metadata.check_options(pool.php_options, metadata_list,
+                                               self.logger)
+        base = None
+        if self.php_ini:
+            php_ini = self.php_ini
+            if os.path.isdir(php_ini):
+                # Like php -c, a directory containing php.ini
+                php_ini = os.path.join(php_ini, 'php.ini')
+            f = open(php_ini)
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect(('127.0.0.1', self.fcgi_port))
-            except socket.error, e:
+                base = f.read()
+            finally:
+                f.close()
+        self.php_args, self.ini_text, self.ini_filename = self._compile(
+            self.php_options, base)
+        for pool in self.pools.values():
+            options = self.php_options.copy()
+            options.update(pool.php_options)
+            pool.php_args, pool.ini_text, pool.ini_filename = self._compile(
+                options, base)
+
+    def _compile(self, options, base):
+        # Whatever validate_options says, an option must not be able
+        # to add lines to php.ini
+        php_ini_metadata.check_syntax(options)
+        if base is None:
+            php_args = []
+            for name, value in sorted(options.items()):
+                php_args.extend(['-d', '%s=%s' % (name, value)])
+            return php_args, None, None
+        ini_text = php_ini_metadata.format_ini(options, base=base)
+        if self.ini_dir is None:
+            self.ini_dir = tempfile.mkdtemp(prefix='wphp-ini-',
+                                            dir=self.spool_dir)
+        ini_filename = os.path.join(
+            self.ini_dir, 'php-%s.ini' % md5(ini_text).hexdigest())
+        return ['-c', ini_filename], ini_text, ini_filename
+
+    def write_ini(self, pool=None):
+        """
+        Writes the generated ``php.ini`` file (of `pool`, if given),
+        if it doesn't exist yet (the filename is based on the
+        content).  Only this process writes to `ini_dir`, and files
+        are created with ``mkstemp()`` and renamed into place.
+        """
+        if pool is None:
+            pool = self
+        if os.path.exists(pool.ini_filename):
+            return
+        fd, tmp_fn = tempfile.mkstemp(suffix='.tmp', dir=self.ini_dir)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(pool.ini_text)
+            finally:
+                f.close()
+            os.rename(tmp_fn, pool.ini_filename)
+        except:
+            try:
+                os.unlink(tmp_fn)
+            except OSError:
                 pass
-            else:
-                sock.close()
-                return
+            raise
+
+    def ini_metadata(self):
+        """
+        Returns the `php_ini_metadata.IniMetadata` for the `php_ini`
+        file, or for ``default-php.ini`` if none was given.
+        """
+        return php_ini_metadata.get_metadata(self.php_ini or default_php_ini)
 
     def find_port(self):
         """
@@ -242,17 +965,22 @@ class PHPApp(object):
 
     def close(self):
         """
-        Kills the PHP subprocess.  Registered with atexit, so the
-        subprocess is killed when this process dies.
+        Kills the PHP subprocesses, and removes the generated
+        ``php.ini`` files.  Registered with atexit, so the
+        subprocesses are killed when this process dies.
         """
         # @@: Note, in a multiprocess setup this cannot
         # be handled this way
-        if self.child_pid:
-            if self.logger:
-                self.logger.info(
-                    "Killing PHP subprocess %s"
-                    % self.child_pid)
-            os.kill(self.child_pid, signal.SIGTERM)
+        self.closed = True
+        for backend in self.all_backends():
+            backend.terminate()
+        if self.ini_dir is not None:
+            shutil.rmtree(self.ini_dir, ignore_errors=True)
+            self.ini_dir = None
+
+# Errors from connect() that mean the request wasn't sent at all:
+_connect_errors = (errno.ECONNREFUSED, errno.ENOENT, errno.EHOSTUNREACH,
+                   errno.ENETUNREACH)
 
 def make_app(global_conf, **kw):
     """
@@ -262,14 +990,82 @@ def make_app(global_conf, **kw):
         kw['fcgi_port'] = int(kw['fcgi_port'])
     if 'search_fcgi_port_starting' in kw:
         kw['search_fcgi_port_starting'] = int(kw['search_fcgi_port_starting'])
+    for name in ['compress', 'stream', 'etag_memo', 'buffer_uploads']:
+        if name in kw:
+            kw[name] = asbool(kw[name])
+    for name in ['compress_min_size', 'compress_level',
+                 'stream_coalesce_size', 'etag_memo_size']:
+        if name in kw:
+            kw[name] = int(kw[name])
+    if 'compress_types' in kw:
+        kw['compress_types'] = aslist(kw['compress_types'])
+    for name in ['max_rss', 'spool_size']:
+        if name in kw:
+            kw[name] = parse_size(kw[name])
+    if 'max_requests' in kw:
+        kw['max_requests'] = int(kw['max_requests'])
+    if 'fcgi_endpoints' in kw:
+        kw['fcgi_endpoints'] = aslist(kw['fcgi_endpoints'])
+    for name in ['drain_timeout', 'connect_timeout', 'send_timeout',
+                 'first_byte_timeout', 'request_timeout', 'max_age',
+                 'monitor_interval', 'health_check_interval',
+                 'eject_backoff', 'max_eject_backoff',
+                 'stream_coalesce_delay', 'etag_memo_max_age']:
+        if name in kw:
+            kw[name] = float(kw[name])
+    if 'recycle_on_timeout' in kw:
+        kw['recycle_on_timeout'] = asbool(kw['recycle_on_timeout'])
+    if 'reload_on_sighup' in kw:
+        kw['reload_on_sighup'] = asbool(kw['reload_on_sighup'])
+    if 'validate_options' in kw:
+        kw['validate_options'] = asbool(kw['validate_options'])
     kw.setdefault('php_options', {})
+    pools = {}
+    routes = []
     for name, value in kw.items():
         if name.startswith('option '):
             optname = name[len('option '):].strip()
             kw['php_options'][optname] = value
             del kw[name]
+        elif name.startswith('pool '):
+            # pool NAME SETTING = value, or pool NAME option OPTION = value
+            pool_name, setting = name[len('pool '):].strip().split(None, 1)
+            settings = pools.setdefault(pool_name, {})
+            if setting.startswith('option '):
+                optname = setting[len('option '):].strip()
+                settings.setdefault('php_options', {})[optname] = value
+            elif setting == 'queue_timeout':
+                settings[setting] = float(value)
+            elif setting == 'endpoints':
+                settings[setting] = aslist(value)
+            elif setting == 'balance':
+                settings[setting] = value.strip()
+            else:
+                settings[setting] = int(value)
+            del kw[name]
+        elif name.startswith('route '):
+            routes.append((name[len('route '):].strip(), value.strip()))
+            del kw[name]
+    if pools:
+        kw['pools'] = pools
+    if routes:
+        # The order of the config is lost, so the most specific
+        # (longest) patterns are tried first
+        routes.sort(key=lambda route: -len(route[0]))
+        kw['routes'] = routes
     if 'base_dir' not in kw:
         raise ValueError(
             "base_dir option is required")
     return PHPApp(**kw)
 
+
+def parse_size(value):
+    """
+    Parses a size in bytes, with an optional K, M or G suffix (like
+    in ``php.ini``).
+    """
+    value = str(value).strip()
+    multipliers = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+    if value and value[-1].lower() in multipliers:
+        return int(value[:-1]) * multipliers[value[-1].lower()]
+    return int(value)
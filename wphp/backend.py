@@ -0,0 +1,662 @@
+"""
+Management of the PHP FastCGI processes that `wphp.PHPApp` sends
+requests to: processes it runs itself (`PHPBackend`), or FastCGI
+servers elsewhere (`RemoteBackend`), grouped in `BackendPool`s.
+"""
+import os
+import time
+import signal
+import socket
+import random
+import itertools
+import threading
+import collections
+import subprocess
+from wphp import fcgi_app
+
+class Backend(object):
+    """
+    The request accounting shared by `PHPBackend` and
+    `RemoteBackend`: the number of `active` requests, and whether
+    the backend is being retired or recycled.  `managed` is true if
+    wphp runs the FastCGI server, and so can replace it.
+
+    `begin()` and `end()` are called for every request, so they
+    don't take any locks: requests in progress are kept in a deque
+    (whose ``append()`` and ``pop()`` are atomic) and counted with
+    `itertools.count`.
+    """
+
+    managed = True
+
+    def __init__(self, logger=None, on_timeout=None, pool=None):
+        self.logger = logger
+        self.on_timeout = on_timeout
+        self.pool = pool
+        self.lock = threading.Lock()
+        self._active = collections.deque()
+        self._requests = itertools.count(1)
+        self.requests = 0
+        self.retiring = False
+        self.recycling = False
+        self.last_stats = None
+
+    def active(self):
+        """The number of requests in progress"""
+        return len(self._active)
+    active = property(active)
+
+    def timed_out(self, environ, kind):
+        if self.on_timeout is not None:
+            self.on_timeout(self, environ, kind)
+
+    def begin(self):
+        """
+        Called when a request is sent to this backend.  Returns the
+        number of the request (counting from 1), or 0 if the backend
+        is being retired, and so can't take requests.  (`requests` may
+        briefly lag behind while other threads call this.)
+        """
+        # The request is counted before retiring is checked, so that
+        # drain() either sees it or it sees retiring
+        self._active.append(None)
+        if self.retiring:
+            self._active.pop()
+            return 0
+        number = self._requests.next()
+        if number > self.requests:
+            self.requests = number
+        return number
+
+    def end(self):
+        """
+        Called when a request to this backend is finished.
+        """
+        self._active.pop()
+
+    def claim_recycle(self):
+        """
+        Returns true the first time it is called, so that only one
+        thread replaces this backend.
+        """
+        self.lock.acquire()
+        try:
+            if self.recycling:
+                return False
+            self.recycling = True
+            return True
+        finally:
+            self.lock.release()
+
+    def drain(self, timeout):
+        """
+        Stops accepting requests, and waits up to `timeout` seconds
+        for the requests in progress to finish.  Returns true if they
+        all did.
+        """
+        end = time.time() + timeout
+        self.retiring = True
+        # end() doesn't take a lock to notify us, so poll
+        while self._active:
+            if time.time() >= end:
+                return False
+            time.sleep(0.01)
+        return True
+
+class PHPBackend(Backend):
+    """
+    One ``php-cgi`` process, listening for FastCGI requests on a
+    local port, with a count of the requests it is handling.
+
+    `children` is the number of PHP worker processes (PHP's
+    ``PHP_FCGI_CHILDREN``).  `fcgi_options` are passed on to the
+    `wphp.fcgi_app.FCGIApp`, and `on_timeout` is called with
+    ``(backend, environ, kind)`` when a request times out.  `pool` is
+    the `BackendPool` the backend belongs to, if any.
+
+    Backends belong to a `generation`; when `wphp.PHPApp` is
+    reloaded a new generation is started and the old one is
+    drained and terminated.
+    """
+
+    def __init__(self, php_script, php_args, port, generation=0,
+                 logger=None, env=None, fcgi_options=None, on_timeout=None,
+                 children=1, pool=None):
+        Backend.__init__(self, logger=logger, on_timeout=on_timeout,
+                         pool=pool)
+        self.php_script = php_script
+        self.php_args = php_args
+        self.port = port
+        self.generation = generation
+        if env is None:
+            env = os.environ.copy()
+            env['PHP_FCGI_CHILDREN'] = str(children)
+        self.env = env
+        self.proc = None
+        self.fcgi_app = fcgi_app.FCGIApp(
+            connect=('127.0.0.1', port),
+            filterEnviron=False,
+            onTimeout=self.timed_out,
+            **(fcgi_options or {}))
+        self.started = None
+
+    def __repr__(self):
+        if self.pool is not None:
+            return '<PHPBackend pool %s generation %s port %s pid %s>' % (
+                self.pool.name, self.generation, self.port, self.pid)
+        return '<PHPBackend generation %s port %s pid %s>' % (
+            self.generation, self.port, self.pid)
+
+    def pid(self):
+        if self.proc is None:
+            return None
+        return self.proc.pid
+    pid = property(pid)
+
+    def start(self, timeout=30):
+        """
+        Spawns the PHP process, and waits for it to accept
+        connections.
+        """
+        cmd = [self.php_script,
+               '-b',
+               '127.0.0.1:%s' % self.port]
+        cmd.extend(self.php_args)
+        self.proc = subprocess.Popen(cmd, env=self.env)
+        self.started = time.time()
+        if self.logger:
+            self.logger.info(
+                'PHP process spawned in PID %s, port %s'
+                % (self.proc.pid, self.port))
+        self.wait_ready(timeout)
+
+    def wait_ready(self, timeout):
+        # PHP doesn't start up *quite* right away, so we give it a
+        # moment to be ready to accept connections
+        end = time.time() + timeout
+        while 1:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect(('127.0.0.1', self.port))
+            except socket.error, e:
+                sock.close()
+                if self.proc.poll() is not None:
+                    raise RuntimeError(
+                        'PHP process %s exited with code %s on startup'
+                        % (self.proc.pid, self.proc.returncode))
+                if time.time() > end:
+                    self.terminate()
+                    raise RuntimeError(
+                        'PHP process %s did not accept connections on '
+                        'port %s within %s seconds'
+                        % (self.proc.pid, self.port, timeout))
+                time.sleep(0.01)
+            else:
+                sock.close()
+                return
+
+    def sample(self):
+        """
+        Reads the resource usage of the PHP process and its children
+        (the workers) from ``/proc``, returning a dictionary that is
+        also kept in `last_stats`.  `rss` (bytes) and `cpu_time`
+        (user and system seconds) are totals for all the processes,
+        or None if ``/proc`` isn't available.
+        """
+        stats = {
+            'pool': None,
+            'pid': self.pid,
+            'port': self.port,
+            'generation': self.generation,
+            'requests': self.requests,
+            'active': self.active,
+            'retiring': self.retiring,
+            'age': 0,
+            'processes': 0,
+            'rss': None,
+            'cpu_time': None,
+            }
+        if self.pool is not None:
+            stats['pool'] = self.pool.name
+        if self.started is not None:
+            stats['age'] = time.time() - self.started
+        if self.pid is not None and self.proc.poll() is None:
+            pids = [self.pid] + child_pids(self.pid)
+            usage = [proc_usage(pid) for pid in pids]
+            usage = [u for u in usage if u is not None]
+            if usage:
+                stats['processes'] = len(usage)
+                stats['rss'] = sum([rss for rss, cpu in usage])
+                stats['cpu_time'] = sum([cpu for rss, cpu in usage])
+        self.last_stats = stats
+        return stats
+
+    def terminate(self, timeout=5):
+        """
+        Stops the PHP process with SIGTERM, or SIGKILL if it hasn't
+        exited after `timeout` seconds.
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        if self.logger:
+            self.logger.info(
+                "Killing PHP subprocess %s" % self.proc.pid)
+        try:
+            os.kill(self.proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        end = time.time() + timeout
+        while self.proc.poll() is None:
+            if time.time() > end:
+                if self.logger:
+                    self.logger.warning(
+                        "PHP subprocess %s didn't exit; sending SIGKILL"
+                        % self.proc.pid)
+                try:
+                    os.kill(self.proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                self.proc.wait()
+                break
+            time.sleep(0.01)
+
+    def retire(self, drain_timeout):
+        """
+        Waits for requests in progress to finish (for up to
+        `drain_timeout` seconds) then terminates the process.
+        """
+        if not self.drain(drain_timeout) and self.logger:
+            self.logger.warning(
+                'Gave up waiting for %s request(s) on %r after %s seconds'
+                % (self.active, self, drain_timeout))
+        self.terminate()
+
+class RemoteBackend(Backend):
+    """
+    A FastCGI server that wphp doesn't run, like PHP-FPM on another
+    host, at `address` (a ``(host, port)`` tuple, or the filename of a
+    Unix socket).
+
+    An endpoint that fails is ejected (`healthy` is false) for
+    `backoff` seconds, doubling with each failure in a row up to
+    `max_backoff`; after that `health_check()` tries it again.
+    """
+
+    managed = False
+    generation = 0
+    pid = None
+
+    def __init__(self, address, logger=None, fcgi_options=None,
+                 on_timeout=None, pool=None, backoff=1, max_backoff=60):
+        Backend.__init__(self, logger=logger, on_timeout=on_timeout,
+                         pool=pool)
+        self.address = address
+        self.fcgi_app = fcgi_app.FCGIApp(
+            connect=address,
+            filterEnviron=False,
+            onTimeout=self.timed_out,
+            **(fcgi_options or {}))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.started = time.time()
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = None
+        # The FCGI_GET_VALUES answer from the last health check:
+        self.capacity = {}
+
+    def __repr__(self):
+        return '<RemoteBackend %s>' % format_address(self.address)
+
+    def eject(self, reason):
+        """
+        Marks the endpoint as failed, so requests go to other
+        endpoints until it passes a health check.
+        """
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            delay = min(self.backoff * 2 ** (self.failures - 1),
+                        self.max_backoff)
+            self.ejected_until = time.time() + delay
+            self.healthy = False
+        finally:
+            self.lock.release()
+        if self.logger:
+            self.logger.warning('Ejected %r for %s seconds: %s'
+                                % (self, delay, reason))
+
+    def reinstate(self):
+        self.lock.acquire()
+        try:
+            self.healthy = True
+            self.failures = 0
+            self.ejected_until = None
+        finally:
+            self.lock.release()
+        if self.logger:
+            self.logger.info('Reinstated %r' % self)
+
+    def check(self, timeout=1):
+        """
+        Asks the server for its limits with ``FCGI_GET_VALUES``,
+        keeping them in `capacity`.  Returns true if it answered.
+        """
+        try:
+            sock = self.fcgi_app._getConnection(timeout)
+            try:
+                values = self.fcgi_app._fcgiGetValues(
+                    sock, [fcgi_app.FCGI_MAX_CONNS, fcgi_app.FCGI_MAX_REQS,
+                           fcgi_app.FCGI_MPXS_CONNS])
+            finally:
+                sock.close()
+        except (socket.error, EOFError):
+            return False
+        self.capacity = values
+        return True
+
+    def health_check(self, timeout=1):
+        """
+        Checks a healthy endpoint, ejecting it if it fails, or an
+        ejected one whose backoff has passed, reinstating it if it
+        passes.
+        """
+        if not self.healthy and time.time() < self.ejected_until:
+            return
+        if self.check(timeout):
+            if not self.healthy:
+                self.reinstate()
+        else:
+            self.eject('health check failed')
+
+    def sample(self):
+        stats = {
+            'pool': None,
+            'address': format_address(self.address),
+            'pid': None,
+            'generation': self.generation,
+            'requests': self.requests,
+            'active': self.active,
+            'retiring': self.retiring,
+            'healthy': self.healthy,
+            'failures': self.failures,
+            'age': time.time() - self.started,
+            'processes': 0,
+            'rss': None,
+            'cpu_time': None,
+            }
+        if self.pool is not None:
+            stats['pool'] = self.pool.name
+        self.last_stats = stats
+        return stats
+
+    def terminate(self, timeout=5):
+        # The server isn't ours to stop
+        pass
+
+    def retire(self, drain_timeout):
+        self.drain(drain_timeout)
+
+def parse_address(address):
+    """
+    Parses a FastCGI address: ``host:port``, or the filename of a Unix
+    socket.  ``(host, port)`` tuples are returned as they are.
+    """
+    if not isinstance(address, basestring):
+        return tuple(address)
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+def format_address(address):
+    if isinstance(address, basestring):
+        return address
+    return '%s:%s' % address
+
+class PoolState(object):
+    """
+    The backends a `BackendPool` sends requests to: its current
+    `backend`, or its `remotes`.  A PoolState isn't changed once it
+    is made; `BackendPool.swap()` replaces it as a whole, so a
+    request that reads ``pool.state`` once sees a consistent set of
+    backends without taking a lock.
+    """
+
+    def __init__(self, backend=None, remotes=()):
+        self.backend = backend
+        self.remotes = tuple(remotes)
+        self.started = backend is not None or bool(self.remotes)
+
+class BackendPool(object):
+    """
+    A named group of PHP processes, with their own options, that
+    `wphp.PHPApp` routes some of its requests to.  The pool has one
+    current `PHPBackend` (with `size` worker processes), and the
+    backends of earlier generations that are being retired.
+
+    If `endpoints` (a list of addresses for `parse_address()`) is
+    given, no PHP processes are started; requests are balanced over
+    those FastCGI servers (see `RemoteBackend`) instead.  `balance`
+    is ``'least_outstanding'`` (send each request to the endpoint
+    with the fewest requests in progress) or ``'p2c'`` (pick two
+    endpoints at random, and use the less busy one).
+
+    At most `max_concurrency` requests (unlimited if None) are sent
+    to the pool at a time.  Other requests wait, in a queue of at
+    most `max_queue` requests (unlimited if None), for up to
+    `queue_timeout` seconds (forever if None).  Requests that don't
+    fit in the queue, or wait too long, are rejected.
+
+    `php_options` are added to the options of the app.  `port` is the
+    port for the first PHP process; later ones get a free port.
+    """
+
+    # The keyword arguments that can be given in PHPApp's pools
+    settings = ['size', 'php_options', 'max_concurrency', 'max_queue',
+                'queue_timeout', 'endpoints', 'balance']
+
+    balance_methods = ['least_outstanding', 'p2c']
+
+    def __init__(self, name, size=1, php_options=None, max_concurrency=None,
+                 max_queue=None, queue_timeout=None, port=None,
+                 endpoints=None, balance='least_outstanding'):
+        if balance not in self.balance_methods:
+            raise ValueError(
+                "Unknown balance method %r for pool %r (choose from: %s)"
+                % (balance, name, ', '.join(self.balance_methods)))
+        self.name = name
+        self.size = size
+        if php_options is None:
+            php_options = {}
+        self.php_options = php_options
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.port = port
+        self.endpoints = [parse_address(address)
+                          for address in endpoints or []]
+        self.balance = balance
+        self.state = PoolState()
+        self.retiring = []
+        self.generation = 0
+        # Set by PHPApp.compile_options():
+        self.php_args = []
+        self.ini_text = self.ini_filename = None
+        self.lock = threading.Lock()
+        self.slot_free = threading.Condition(self.lock)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def __repr__(self):
+        return '<BackendPool %s size %s>' % (self.name, self.size)
+
+    def backend(self):
+        """The current `PHPBackend`"""
+        return self.state.backend
+    backend = property(backend)
+
+    def remotes(self):
+        """The `RemoteBackend`s, when there are endpoints"""
+        return self.state.remotes
+    remotes = property(remotes)
+
+    def started(self):
+        """Has the pool got backends to send requests to?"""
+        return self.state.started
+    started = property(started)
+
+    def swap(self, backend=None, remotes=()):
+        """
+        Makes new requests go to `backend` (or `remotes`), returning
+        the `PoolState` with the backends they went to before.
+        """
+        old = self.state
+        self.state = PoolState(backend, remotes)
+        return old
+
+    def choose(self):
+        """
+        Returns the backend for the next request.  With endpoints,
+        an ejected endpoint is only chosen if they all are.
+        """
+        state = self.state
+        if not state.remotes:
+            return state.backend
+        healthy = [backend for backend in state.remotes if backend.healthy]
+        if not healthy:
+            healthy = state.remotes
+        if self.balance == 'p2c' and len(healthy) > 2:
+            first, second = random.sample(healthy, 2)
+            if second.active < first.active:
+                return second
+            return first
+        least = min([backend.active for backend in healthy])
+        return random.choice([backend for backend in healthy
+                              if backend.active == least])
+
+    def acquire(self):
+        """
+        Waits for a free slot for a request, returning false if the
+        request is rejected.  `release()` must be called when a
+        request that got a slot is finished.
+        """
+        if self.max_concurrency is None:
+            return True
+        self.lock.acquire()
+        try:
+            if self.active >= self.max_concurrency:
+                if self.max_queue is not None and self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    return False
+                if self.queue_timeout is not None:
+                    end = time.time() + self.queue_timeout
+                self.waiting += 1
+                try:
+                    while self.active >= self.max_concurrency:
+                        if self.queue_timeout is None:
+                            self.slot_free.wait()
+                            continue
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        self.slot_free.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self):
+        if self.max_concurrency is None:
+            return
+        self.lock.acquire()
+        try:
+            self.active -= 1
+            self.slot_free.notify()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """
+        Returns a dictionary with the pool's settings and the number
+        of requests that are `active`, `waiting` or were `rejected`
+        (only counted when `max_concurrency` is set).
+        """
+        return {
+            'name': self.name,
+            'size': self.size,
+            'generation': self.generation,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            }
+
+if hasattr(os, 'sysconf'):
+    _clock_ticks = os.sysconf('SC_CLK_TCK')
+    _page_size = os.sysconf('SC_PAGE_SIZE')
+else:
+    _clock_ticks = _page_size = None
+
+def _proc_stat(pid):
+    """
+    Returns the fields of ``/proc/pid/stat`` after the command name
+    (so the first one is the state, field 3 in proc(5)), or None.
+    """
+    try:
+        f = open('/proc/%s/stat' % pid)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    # The command name is in parenthesis, and may contain spaces
+    return data[data.rindex(')')+2:].split()
+
+def proc_usage(pid):
+    """
+    Returns ``(rss_bytes, cpu_seconds)`` for a process, or None if
+    it can't be read from ``/proc``.
+    """
+    fields = _proc_stat(pid)
+    if fields is None or _clock_ticks is None:
+        return None
+    utime, stime = int(fields[11]), int(fields[12])
+    rss = int(fields[21])
+    return rss * _page_size, float(utime + stime) / _clock_ticks
+
+def child_pids(pid):
+    """
+    Returns the PIDs of the children of a process.
+    """
+    children = []
+    task_dir = '/proc/%s/task' % pid
+    try:
+        tasks = os.listdir(task_dir)
+    except OSError:
+        return children
+    try:
+        for task in tasks:
+            f = open(os.path.join(task_dir, task, 'children'))
+            try:
+                children.extend([int(child) for child in f.read().split()])
+            finally:
+                f.close()
+        return children
+    except (IOError, OSError):
+        # Older kernels don't have the children file; look at every
+        # process's parent instead
+        children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        fields = _proc_stat(name)
+        if fields is not None and int(fields[1]) == pid:
+            children.append(int(name))
+    return children
@@ -0,0 +1,256 @@
+"""
+Compression of PHP responses in Python, so the PHP workers don't
+have to spend time on it (instead of PHP's
+``zlib.output_compression``).
+
+Responses are compressed as a stream, with gzip, or with brotli if
+the `brotli <https://pypi.python.org/pypi/Brotli>`_ module is
+installed and the client prefers it.
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+default_types = [
+    'text/',
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+    ]
+
+class CompressMiddleware(object):
+
+    def __init__(self, app, min_size=1024, types=None, level=6,
+                 flush=False):
+        """
+        Compresses the responses of `app`.
+
+        Responses are only compressed if their ``Content-Type`` starts
+        with one of `types`, they are at least `min_size` bytes, and
+        they don't already have a ``Content-Encoding``.  A strong
+        ``ETag`` on a compressed response is made weak (as nginx
+        does), as the bytes are no longer those it was given for.
+
+        `level` is the compression level (1-9), also used as brotli's
+        quality.
+
+        If `flush` is true, each chunk from `app` is flushed out of
+        the compressor when it is compressed, so a streamed response
+        keeps its flush boundaries (at some cost in compression).
+        Responses without a ``Content-Length`` are then compressed
+        without waiting for `min_size` bytes.
+        """
+        self.app = app
+        self.min_size = min_size
+        if types is None:
+            types = default_types
+        self.types = tuple(types)
+        self.level = level
+        self.flush = flush
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.app(environ, start_response)
+        captured = []
+        # Data given to the write() callable, which goes in the body
+        # ahead of what the app_iter gives next
+        written = []
+        def replace_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return written.append
+        app_iter = self.app(environ, replace_start_response)
+        return self._respond(app_iter, captured, written, encoding,
+                             start_response)
+
+    def _respond(self, app_iter, captured, written, encoding,
+                 start_response):
+        # This is a generator so that start_response is called lazily,
+        # once enough of the body has been seen to decide whether to
+        # compress it.
+        try:
+            chunks = with_written(app_iter, written)
+            buffered = []
+            size = 0
+            if not captured:
+                # The app calls start_response lazily
+                for chunk in chunks:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                    break
+            status, headers, exc_info = captured
+            compress = self.compressible(status, headers)
+            content_length = header_value(headers, 'content-length')
+            if compress and content_length is not None:
+                compress = int(content_length) >= self.min_size
+            elif compress and not self.flush:
+                # Read ahead until we know the body is big enough
+                for chunk in chunks:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                    if size >= self.min_size:
+                        break
+                else:
+                    compress = False
+            if not compress:
+                start_response(status, headers, exc_info)
+                for chunk in buffered:
+                    yield chunk
+                for chunk in chunks:
+                    yield chunk
+                return
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            etag = header_value(headers, 'etag')
+            if etag is not None and not etag.startswith('W/'):
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'etag']
+                headers.append(('ETag', 'W/' + etag))
+            vary = header_value(headers, 'vary')
+            if vary is None:
+                headers.append(('Vary', 'Accept-Encoding'))
+            elif 'accept-encoding' not in vary.lower():
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'vary']
+                headers.append(('Vary', vary + ', Accept-Encoding'))
+            start_response(status, headers, exc_info)
+            compressor = make_compressor(encoding, self.level)
+            if self.flush:
+                compress_chunk = compressor.compress_flush
+            else:
+                compress_chunk = compressor.compress
+            if buffered:
+                chunks = chain(buffered, chunks)
+            for chunk in chunks:
+                data = compress_chunk(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def compressible(self, status, headers):
+        """
+        Is a response with this status and these headers a candidate
+        for compression?
+        """
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        if header_value(headers, 'content-encoding') is not None:
+            return False
+        if 'no-transform' in (header_value(headers, 'cache-control') or ''):
+            return False
+        content_type = header_value(headers, 'content-type')
+        if not content_type:
+            return False
+        return content_type.lower().startswith(self.types)
+
+def header_value(headers, name):
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+def with_written(app_iter, written):
+    """
+    Yields the chunks of `app_iter`, each after any data given to
+    the write() callable (collected in the list `written`) before it.
+    """
+    for chunk in app_iter:
+        if written:
+            data = ''.join(written)
+            del written[:]
+            yield data
+        yield chunk
+    if written:
+        data = ''.join(written)
+        del written[:]
+        yield data
+
+def chain(*iterables):
+    for iterable in iterables:
+        for item in iterable:
+            yield item
+
+def choose_encoding(accept_encoding):
+    """
+    Picks the encoding to use from an ``Accept-Encoding`` header,
+    or None if the response shouldn't be compressed.
+    """
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    wildcard = accepted.get('*', 0.0)
+    best = None
+    best_q = 0.0
+    # Listed in order of preference, for ties
+    for coding in ['br', 'gzip']:
+        if coding == 'br' and brotli is None:
+            continue
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+class GzipCompressor(object):
+
+    def __init__(self, level):
+        # wbits of 16+MAX_WBITS produces the gzip container format
+        self.compressobj = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressobj.compress(data)
+
+    def compress_flush(self, data):
+        return (self.compressobj.compress(data)
+                + self.compressobj.flush(zlib.Z_SYNC_FLUSH))
+
+    def flush(self):
+        return self.compressobj.flush()
+
+class BrotliCompressor(object):
+
+    def __init__(self, level):
+        # Brotli's quality goes to 11; zlib's levels fall in the
+        # fast end of that range, which suits dynamic pages
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def compress_flush(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def flush(self):
+        return self.compressor.finish()
+
+def make_compressor(encoding, level):
+    if encoding == 'br':
+        return BrotliCompressor(level)
+    return GzipCompressor(level)
@@ -0,0 +1,169 @@
+"""
+Answers conditional requests (``If-None-Match``) from a memo of the
+ETags that PHP has sent, without running PHP.
+
+Only responses that say they may be cached are remembered: ``200 OK``
+(or ``304 Not Modified``) responses to ``GET`` with an ``ETag`` and a ``Cache-Control``
+``max-age``, and without ``no-cache``, ``no-store``, ``private``,
+``Set-Cookie`` or a ``Vary`` on anything but ``Accept-Encoding``.  A
+client that sends one of those ETags back within max-age gets a
+``304 Not Modified``, as it would from an HTTP cache.  Requests with
+``Cache-Control: no-cache`` or ``max-age=0`` (or ``Pragma: no-cache``)
+always go to PHP, as they would through a cache.  Other methods
+(``POST`` etc.) on a URL forget its ETag.
+"""
+import time
+import threading
+from wphp.compress import header_value
+
+class ETagMemoMiddleware(object):
+
+    def __init__(self, app, max_age=None, size=10000):
+        """
+        Remembers the ETags of the responses of `app`.
+
+        ETags are remembered for the response's max-age, or at most
+        `max_age` seconds if that is given, and for at most `size`
+        URLs.  `hits` counts the requests that were answered from
+        the memo.
+        """
+        self.app = app
+        self.max_age = max_age
+        self.size = size
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        key = memo_key(environ)
+        if method not in ('GET', 'HEAD'):
+            self.memo.pop(key, None)
+            return self.app(environ, start_response)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and not forces_revalidation(environ):
+            entry = self.memo.get(key)
+            if entry is not None:
+                etag, expires, headers = entry
+                if expires < time.time():
+                    self.memo.pop(key, None)
+                elif etag_matches(etag, if_none_match):
+                    self.lock.acquire()
+                    try:
+                        self.hits += 1
+                    finally:
+                        self.lock.release()
+                    start_response('304 Not Modified', headers)
+                    return []
+        if method != 'GET':
+            return self.app(environ, start_response)
+        def replace_start_response(status, headers, exc_info=None):
+            self.remember(key, status, headers)
+            return start_response(status, headers, exc_info)
+        return self.app(environ, replace_start_response)
+
+    def remember(self, key, status, headers):
+        """
+        Remembers the ETag of a response, if it can be cached.
+        """
+        etag = header_value(headers, 'etag')
+        max_age = cache_max_age(headers)
+        if (status[:3] not in ('200', '304') or etag is None
+            or not max_age or max_age < 0):
+            # A newer response replaces whatever was remembered
+            self.memo.pop(key, None)
+            return
+        if self.max_age is not None:
+            max_age = min(max_age, self.max_age)
+        self.lock.acquire()
+        try:
+            if len(self.memo) >= self.size and key not in self.memo:
+                self.purge()
+            replay = [(name, value) for name, value in headers
+                      if name.lower() in replay_headers]
+            self.memo[key] = (etag, time.time() + max_age, replay)
+        finally:
+            self.lock.release()
+
+    def purge(self):
+        # Called with the lock held
+        now = time.time()
+        for key, (etag, expires, headers) in self.memo.items():
+            if expires < now:
+                self.memo.pop(key, None)
+        if len(self.memo) >= self.size:
+            self.memo.clear()
+
+# Headers that are sent again with a 304 (RFC 7232 section 4.1):
+replay_headers = ['etag', 'cache-control', 'expires', 'vary',
+                  'content-location']
+
+def memo_key(environ):
+    return (environ.get('HTTP_HOST', ''),
+            environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''))
+
+def forces_revalidation(environ):
+    """
+    Does the request ask for a response from the origin (PHP) rather
+    than from a cache?
+    """
+    cache_control = environ.get('HTTP_CACHE_CONTROL')
+    if cache_control:
+        for directive in cache_control.split(','):
+            directive = directive.strip().lower()
+            if directive == 'no-cache':
+                return True
+            if (directive.startswith('max-age=')
+                and directive[len('max-age='):].strip('"') == '0'):
+                return True
+    elif 'no-cache' in environ.get('HTTP_PRAGMA', '').lower():
+        # Pragma is only used when there is no Cache-Control
+        return True
+    return False
+
+def cache_max_age(headers):
+    """
+    Returns the max-age of a response in seconds, or None if it has
+    no max-age or can't be shared.
+    """
+    if header_value(headers, 'set-cookie') is not None:
+        return None
+    vary = header_value(headers, 'vary')
+    if vary:
+        for field in vary.split(','):
+            if field.strip().lower() != 'accept-encoding':
+                return None
+    cache_control = header_value(headers, 'cache-control')
+    if not cache_control:
+        return None
+    max_age = None
+    for directive in cache_control.split(','):
+        directive = directive.strip().lower()
+        if directive in ('no-cache', 'no-store', 'private'):
+            return None
+        if directive.startswith('max-age='):
+            try:
+                max_age = int(directive[len('max-age='):].strip('"'))
+            except ValueError:
+                return None
+    return max_age
+
+def etag_matches(etag, if_none_match):
+    """
+    Does an ``If-None-Match`` header match the ETag?  This is the
+    weak comparison, which If-None-Match uses.
+    """
+    if if_none_match.strip() == '*':
+        return True
+    etag = strip_weak(etag)
+    for candidate in if_none_match.split(','):
+        if strip_weak(candidate) == etag:
+            return True
+    return False
+
+def strip_weak(etag):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag
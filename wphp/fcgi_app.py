@@ -27,12 +27,18 @@
 __author__ = 'Allan Saddi <allan@saddi.com>'
 __version__ = '$Revision: 2107 $'
 
+import os
 import select
 import struct
 import socket
 import errno
+import time
+import threading
+import traceback
+import collections
+from wphp.spool import SpooledBuffer, spool_input
 
-__all__ = ['FCGIApp']
+__all__ = ['FCGIApp', 'HeaderParser', 'FCGIServer', 'AsyncFCGIServer']
 
 # Constants from the spec.
 FCGI_LISTENSOCK_FILENO = 0
@@ -76,7 +82,18 @@ FCGI_BeginRequestBody = '!HB5x'
 FCGI_EndRequestBody = '!LB3x'
 FCGI_UnknownTypeBody = '!B7x'
 
+_headerStruct = struct.Struct(FCGI_Header)
+
+# The longest content a record can have
+FCGI_MAX_CONTENT_LEN = 0xffff
+
+# Padding (to a multiple of 8 bytes), by length
+_padding = ['\x00' * length for length in range(8)]
+
 FCGI_BeginRequestBody_LEN = struct.calcsize(FCGI_BeginRequestBody)
+
+# The body of every FCGI_BEGIN_REQUEST that FCGIApp sends
+_beginRequestBody = struct.pack(FCGI_BeginRequestBody, FCGI_RESPONDER, 0)
 FCGI_EndRequestBody_LEN = struct.calcsize(FCGI_EndRequestBody)
 FCGI_UnknownTypeBody_LEN = struct.calcsize(FCGI_UnknownTypeBody)
 
@@ -150,8 +167,12 @@ class Record(object):
     """
     A FastCGI Record.
 
-    Used for encoding/decoding records.
+    Used for encoding/decoding records.  (`RecordStream` does the
+    same without making an object for each record.)
     """
+    __slots__ = ['version', 'type', 'requestId', 'contentLength',
+                 'paddingLength', 'contentData']
+
     def __init__(self, type=FCGI_UNKNOWN_TYPE, requestId=FCGI_NULL_REQUEST_ID):
         self.version = FCGI_VERSION_1
         self.type = type
@@ -172,7 +193,9 @@ class Record(object):
                 data = sock.recv(length)
             except socket.error, e:
                 if e[0] == errno.EAGAIN:
-                    select.select([sock], [], [])
+                    if not select.select([sock], [], [],
+                                         sock.gettimeout() or None)[0]:
+                        raise socket.timeout('timed out')
                     continue
                 else:
                     raise
@@ -189,6 +212,8 @@ class Record(object):
         """Read and decode a Record from a socket."""
         try:
             header, length = self._recvall(sock, FCGI_HEADER_LEN)
+        except socket.timeout:
+            raise
         except:
             raise EOFError
 
@@ -207,6 +232,8 @@ class Record(object):
             try:
                 self.contentData, length = self._recvall(sock,
                                                          self.contentLength)
+            except socket.timeout:
+                raise
             except:
                 raise EOFError
 
@@ -216,6 +243,8 @@ class Record(object):
         if self.paddingLength:
             try:
                 self._recvall(sock, self.paddingLength)
+            except socket.timeout:
+                raise
             except:
                 raise EOFError
 
@@ -229,7 +258,9 @@ class Record(object):
                 sent = sock.send(data)
             except socket.error, e:
                 if e[0] == errno.EAGAIN:
-                    select.select([], [sock], [])
+                    if not select.select([], [sock], [],
+                                         sock.gettimeout() or None)[1]:
+                        raise socket.timeout('timed out')
                     continue
                 else:
                     raise
@@ -255,9 +286,249 @@ class Record(object):
         if self.paddingLength:
             self._sendall(sock, '\x00'*self.paddingLength)
 
+class RecordStream(object):
+    """
+    Reads and writes the records on a connection (`sock`) as
+    tuples, instead of making a `Record` for each one.  The buffers
+    for record headers, content and output are allocated once and
+    reused, so reading a record allocates little more than the
+    string for its content, and writing one is a single send().
+    `FCGIApp` keeps the streams of finished requests to reuse their
+    buffers for the next ones.
+
+    Records are read one at a time, without reading ahead, so
+    select() on the socket still tells whether another record has
+    arrived.
+    """
+
+    __slots__ = ['sock', 'header', 'headerView', 'scratch', 'scratchView',
+                 'output', 'outputView']
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.header = bytearray(FCGI_HEADER_LEN)
+        self.headerView = memoryview(self.header)
+        # Content and padding are read together
+        self.scratch = bytearray(FCGI_MAX_CONTENT_LEN + 0xff)
+        self.scratchView = memoryview(self.scratch)
+        self.output = bytearray(FCGI_HEADER_LEN + FCGI_MAX_CONTENT_LEN + 7)
+        self.outputView = memoryview(self.output)
+
+    def _recvInto(self, view, length):
+        """
+        Receives exactly `length` bytes into the start of `view`.
+        Like `Record.read()`, errors other than timeouts (and the
+        connection closing early) raise EOFError.
+        """
+        sock = self.sock
+        received = 0
+        while received < length:
+            try:
+                if received:
+                    n = sock.recv_into(view[received:], length - received)
+                else:
+                    n = sock.recv_into(view, length)
+            except socket.timeout:
+                raise
+            except socket.error, e:
+                if e[0] == errno.EAGAIN:
+                    if not select.select([sock], [], [],
+                                         sock.gettimeout() or None)[0]:
+                        raise socket.timeout('timed out')
+                    continue
+                raise EOFError
+            if not n:
+                raise EOFError
+            received += n
+
+    def read(self):
+        """
+        Reads a record, returning ``(type, requestId, contentData)``.
+        """
+        self._recvInto(self.headerView, FCGI_HEADER_LEN)
+        version, type, requestId, contentLength, paddingLength = \
+                 _headerStruct.unpack_from(self.header)
+        if not (contentLength or paddingLength):
+            return type, requestId, ''
+        self._recvInto(self.scratchView, contentLength + paddingLength)
+        return type, requestId, self.scratchView[:contentLength].tobytes()
+
+    def write(self, type, requestId, data=''):
+        """
+        Writes `data` as a record (or several, if it is longer than a
+        record can be).
+        """
+        pos = 0
+        while True:
+            length = min(len(data) - pos, FCGI_MAX_CONTENT_LEN)
+            paddingLength = -length & 7
+            _headerStruct.pack_into(self.output, 0, FCGI_VERSION_1, type,
+                                    requestId, length, paddingLength)
+            end = FCGI_HEADER_LEN + length
+            if length:
+                self.output[FCGI_HEADER_LEN:end] = data[pos:pos+length]
+            if paddingLength:
+                self.output[end:end+paddingLength] = _padding[paddingLength]
+            Record._sendall(self.sock, self.outputView[:end+paddingLength])
+            pos += length
+            if pos >= len(data):
+                break
+
+class HeaderParser(object):
+    """
+    Incrementally parses the CGI response headers at the start of the
+    FCGI_STDOUT stream.
+
+    Chunks are passed to `feed()` as they arrive; lines may end in
+    CRLF or LF, and may be split across chunks.  Once the blank line
+    ending the headers is seen, `done` is set and `feed()` returns
+    the body bytes that followed it in the same chunk.  Later chunks
+    are body and should not be fed to the parser.
+    """
+
+    def __init__(self):
+        self.status = '200 OK'
+        self.headers = []
+        self.done = False
+        self._partial = []
+
+    def feed(self, data):
+        """
+        Parses a chunk of output.  Returns None while the headers
+        are incomplete, and the start of the body (possibly empty)
+        when they are complete.
+        """
+        pos = 0
+        while True:
+            eolpos = data.find('\n', pos)
+            if eolpos < 0:
+                if pos < len(data):
+                    self._partial.append(data[pos:])
+                return None
+            if self._partial:
+                self._partial.append(data[pos:eolpos])
+                line = ''.join(self._partial)
+                self._partial = []
+            else:
+                line = data[pos:eolpos]
+            pos = eolpos + 1
+            if line.endswith('\r'):
+                line = line[:-1]
+
+            # Empty line signifies end of headers
+            if not line:
+                self.done = True
+                return data[pos:]
+            self._parse_line(line)
+
+    def _parse_line(self, line):
+        try:
+            header, value = line.split(':', 1)
+        except ValueError:
+            raise ValueError('Malformed response header: %r' % line)
+        header = header.strip().lower()
+        value = value.strip()
+
+        if header == 'status':
+            # Special handling of Status header
+            self.status = value
+            if value.find(' ') < 0:
+                # Append a dummy reason phrase if one was not provided
+                self.status += ' FCGIApp'
+        else:
+            self.headers.append((header, value))
+
+    def close(self):
+        """
+        Called at the end of the output if the headers were never
+        terminated; returns the unterminated last line, which is
+        treated as body.
+        """
+        self.done = True
+        rest = ''.join(self._partial)
+        self._partial = []
+        return rest
+
+class _Timer(object):
+    """
+    Computes socket timeouts for the phases of a request, given the
+    deadline for the whole request.  `kind` is the limit that applies
+    to the current phase: the phase's name, or ``'deadline'``.
+    """
+
+    def __init__(self, timeout):
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+        self.kind = None
+
+    def timeout(self, kind, timeout):
+        """
+        Returns the socket timeout for a phase: its own `timeout`, or
+        the time left before the deadline if that is sooner.
+        """
+        self.kind = kind
+        if self.deadline is None:
+            return timeout
+        remaining = self.deadline - time.time()
+        if timeout is None or remaining < timeout:
+            self.kind = 'deadline'
+            if remaining <= 0:
+                raise socket.timeout('deadline passed')
+            return remaining
+        return timeout
+
+def _setTimeout(sock, timeout):
+    # Changing the timeout is a system call (to make the socket
+    # (non-)blocking), so it's skipped when nothing changes
+    if timeout is not None or sock.gettimeout() is not None:
+        sock.settimeout(timeout)
+
 class FCGIApp(object):
     def __init__(self, command=None, connect=None, host=None, port=None,
-                 filterEnviron=True):
+                 filterEnviron=True, connectTimeout=None, sendTimeout=None,
+                 firstByteTimeout=None, timeout=None, onTimeout=None,
+                 stream=False, coalesceSize=0, coalesceDelay=0,
+                 spoolSize=1024*1024, spoolDir=None, bufferRequest=False):
+        """
+        `connectTimeout`, `sendTimeout` (for sending the request) and
+        `firstByteTimeout` (for the first record of the response)
+        limit the time for each phase of a request, and `timeout` is
+        a deadline for the whole request, all in seconds.  When one
+        expires the request is aborted and a 504 Gateway Timeout
+        response is returned; `timeouts` counts how often each kind
+        of timeout has happened.  `onTimeout`, if given, is called
+        with ``(environ, kind)`` after a timeout, where kind is one of
+        ``'connect'``, ``'send'``, ``'first_byte'`` or
+        ``'deadline'``.
+
+        Normally the response is read completely before it is
+        returned.  If `stream` is true, the response is returned as
+        soon as its headers have been read, and the body is passed on
+        as the ``FCGI_STDOUT`` records arrive, so the output of PHP's
+        ``flush()`` reaches the client right away.  Records are sent
+        on one at a time, unless they are smaller than `coalesceSize`
+        bytes: then they are joined with the records that follow, up
+        to `coalesceSize` bytes, for as long as more records are
+        already waiting, or arrive within `coalesceDelay` seconds.
+        The end of a burst of records (like a ``flush()``) is always
+        passed on.  If the request times out while the body is being
+        streamed, the body is cut short.
+
+        When the response is read completely, it is kept in memory
+        up to `spoolSize` bytes, and in a temporary file (in
+        `spoolDir`) beyond that, which is passed to the server's
+        ``wsgi.file_wrapper``.  A ``Content-Length`` header is added
+        if the application didn't send one.  If `bufferRequest` is
+        true, the request body is read (and spooled the same way)
+        before connecting to the application, so a slow upload
+        doesn't hold up an application process.
+
+        For ``HEAD`` requests only the headers are read; the request
+        is then aborted, rather than waiting for the application to
+        finish.
+        """
         if host is not None:
             assert port is not None
             connect=(host, port)
@@ -269,6 +540,22 @@ class FCGIApp(object):
         self._connect = connect
 
         self._filterEnviron = filterEnviron
+
+        self._connectTimeout = connectTimeout
+        self._sendTimeout = sendTimeout
+        self._firstByteTimeout = firstByteTimeout
+        self._timeout = timeout
+        self._onTimeout = onTimeout
+        self._stream = stream
+        self._coalesceSize = coalesceSize
+        self._coalesceDelay = coalesceDelay
+        self._spoolSize = spoolSize
+        self._spoolDir = spoolDir
+        self._bufferRequest = bufferRequest
+        self.timeouts = {'connect': 0, 'send': 0, 'first_byte': 0,
+                         'deadline': 0}
+        # The RecordStreams of finished requests, for their buffers
+        self._streams = collections.deque()
         
         #sock = self._getConnection()
         #print self._fcgiGetValues(sock, ['FCGI_MAX_CONNS', 'FCGI_MAX_REQS', 'FCGI_MPXS_CONNS'])
@@ -280,17 +567,102 @@ class FCGIApp(object):
         # transport socket, perform the request, then discard the socket.
         # This is, I believe, how mod_fastcgi does things...
 
-        sock = self._getConnection()
-
         # Since this is going to be the only request on this connection,
         # set the request ID to 1.
         requestId = 1
 
+        # A body spooled by the caller (``wphp.spooled_input``) is
+        # read from the start, so the request can be retried; it
+        # stays open for the caller to close.
+        spooled = environ.get('wphp.spooled_input')
+        buf = None
+        if spooled is not None:
+            input = spooled.reader()
+        elif self._bufferRequest:
+            buf = spool_input(environ, self._spoolSize, self._spoolDir)
+            input = buf.reader()
+        else:
+            input = environ['wsgi.input']
+
+        timer = _Timer(self._timeout)
+        stream = None
+        try:
+            try:
+                stream = self._getStream(self._getConnection(
+                    timer.timeout('connect', self._connectTimeout)))
+
+                _setTimeout(stream.sock,
+                            timer.timeout('send', self._sendTimeout))
+                self._sendRequest(stream, requestId, environ, input)
+            finally:
+                if buf is not None:
+                    buf.close()
+
+            _setTimeout(stream.sock,
+                        timer.timeout('first_byte', self._firstByteTimeout))
+            if environ.get('REQUEST_METHOD') == 'HEAD':
+                status, headers, body, ended = self._readHeaders(
+                    stream, environ, timer)
+                if not ended:
+                    # The body isn't wanted, so don't wait for it
+                    self._abortRequest(stream, requestId)
+                self._closeStream(stream)
+                start_response(status, headers)
+                return []
+            if self._stream:
+                status, headers, body, ended = self._readHeaders(
+                    stream, environ, timer)
+            else:
+                status, headers, result = self._readResponse(
+                    stream, environ, timer)
+        except socket.timeout:
+            return self._timedOut(stream, requestId, environ, start_response,
+                                  timer.kind)
+
+        if self._stream:
+            start_response(status, headers)
+            return self._streamBody(stream, requestId, environ, timer,
+                                    body, ended)
+
+        # Done with this transport socket, close it. (FCGI_KEEP_CONN was not
+        # set in the FCGI_BEGIN_REQUEST record we sent above. So the
+        # application is expected to do the same.)
+        self._closeStream(stream)
+
+        # Set WSGI status, headers, and return result.
+        if (status[:3] not in ('204', '304') and status[:1] != '1'
+            and 'content-length' not in [name for name, value in headers]):
+            headers.append(('content-length', str(result.size)))
+        start_response(status, headers)
+        return result.app_iter(environ)
+
+    # Streams kept for reuse, at most:
+    _maxIdleStreams = 16
+
+    def _getStream(self, sock):
+        """
+        Returns a `RecordStream` for a new connection, reusing the
+        buffers of an earlier one if there is one.
+        """
+        try:
+            stream = self._streams.pop()
+        except IndexError:
+            stream = RecordStream()
+        stream.sock = sock
+        return stream
+
+    def _closeStream(self, stream):
+        """
+        Closes the stream's connection, keeping the stream to reuse.
+        """
+        stream.sock.close()
+        stream.sock = None
+        if len(self._streams) < self._maxIdleStreams:
+            self._streams.append(stream)
+
+    def _sendRequest(self, stream, requestId, environ, input):
         # Begin the request
-        rec = Record(FCGI_BEGIN_REQUEST, requestId)
-        rec.contentData = struct.pack(FCGI_BeginRequestBody, FCGI_RESPONDER, 0)
-        rec.contentLength = FCGI_BeginRequestBody_LEN
-        rec.write(sock)
+        stream.write(FCGI_BEGIN_REQUEST, requestId, _beginRequestBody)
 
         # Filter WSGI environ and send it as FCGI_PARAMS
         if self._filterEnviron:
@@ -298,91 +670,191 @@ class FCGIApp(object):
         else:
             params = self._lightFilterEnviron(environ)
         # TODO: Anything not from environ that needs to be sent also?
-        self._fcgiParams(sock, requestId, params)
-        self._fcgiParams(sock, requestId, {})
+        self._fcgiParams(stream, requestId, params)
+        self._fcgiParams(stream, requestId, {})
 
         # Transfer wsgi.input to FCGI_STDIN
         content_length = int(environ.get('CONTENT_LENGTH') or 0)
         while True:
             chunk_size = min(content_length, 4096)
-            s = environ['wsgi.input'].read(chunk_size)
+            s = input.read(chunk_size)
             content_length -= len(s)
-            rec = Record(FCGI_STDIN, requestId)
-            rec.contentData = s
-            rec.contentLength = len(s)
-            rec.write(sock)
+            stream.write(FCGI_STDIN, requestId, s)
 
             if not s: break
 
         # Empty FCGI_DATA stream
-        rec = Record(FCGI_DATA, requestId)
-        rec.write(sock)
+        stream.write(FCGI_DATA, requestId)
 
+    def _readResponse(self, stream, environ, timer):
+        """
+        Reads the response, returning ``(status, headers, body)``,
+        where body is a `SpooledBuffer`.  The socket's timeout should
+        be set for the first record; later records are read with the
+        time left on the `timer`.
+        """
+        result = SpooledBuffer(self._spoolSize, self._spoolDir)
+        try:
+            return self._readResponseInto(stream, environ, timer, result)
+        except:
+            result.close()
+            raise
+
+    def _readResponseInto(self, stream, environ, timer, result):
         # Main loop. Process FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST
-        # records from the application.
-        result = []
+        # records from the application.  Response headers are parsed
+        # as they arrive; everything after them is body.
+        parser = HeaderParser()
+        first = True
         while True:
-            inrec = Record()
-            inrec.read(sock)
-            if inrec.type == FCGI_STDOUT:
-                if inrec.contentData:
-                    result.append(inrec.contentData)
+            if not first:
+                _setTimeout(stream.sock, timer.timeout('deadline', None))
+            type, requestId, data = stream.read()
+            first = False
+            if type == FCGI_STDOUT:
+                if data:
+                    if parser.done:
+                        result.write(data)
+                    else:
+                        body = parser.feed(data)
+                        if body:
+                            result.write(body)
                 else:
                     # TODO: Should probably be pedantic and no longer
                     # accept FCGI_STDOUT records?
                     pass
-            elif inrec.type == FCGI_STDERR:
+            elif type == FCGI_STDERR:
                 # Simply forward to wsgi.errors
-                environ['wsgi.errors'].write(inrec.contentData)
-            elif inrec.type == FCGI_END_REQUEST:
+                environ['wsgi.errors'].write(data)
+            elif type == FCGI_END_REQUEST:
                 # TODO: Process appStatus/protocolStatus fields?
                 break
 
-        # Done with this transport socket, close it. (FCGI_KEEP_CONN was not
-        # set in the FCGI_BEGIN_REQUEST record we sent above. So the
-        # application is expected to do the same.)
-        sock.close()
-
-        result = ''.join(result)
+        if not parser.done:
+            result.write(parser.close())
+        return parser.status, parser.headers, result
 
-        # Parse response headers from FCGI_STDOUT
-        status = '200 OK'
-        headers = []
-        pos = 0
+    def _readStdout(self, stream, environ):
+        """
+        Reads records up to the next non-empty ``FCGI_STDOUT``
+        record, returning its data, or None at the end of the
+        response.
+        """
         while True:
-            eolpos = result.find('\n', pos)
-            if eolpos < 0: break
-            line = result[pos:eolpos-1]
-            pos = eolpos + 1
-
-            # strip in case of CR. NB: This will also strip other
-            # whitespace...
-            line = line.strip()
-            
-            # Empty line signifies end of headers
-            if not line: break
-
-            # TODO: Better error handling
-            header, value = line.split(':', 1)
-            header = header.strip().lower()
-            value = value.strip()
-
-            if header == 'status':
-                # Special handling of Status header
-                status = value
-                if status.find(' ') < 0:
-                    # Append a dummy reason phrase if one was not provided
-                    status += ' FCGIApp'
-            else:
-                headers.append((header, value))
-
-        result = result[pos:]
-
-        # Set WSGI status, headers, and return result.
-        start_response(status, headers)
-        return [result]
+            type, requestId, data = stream.read()
+            if type == FCGI_STDOUT:
+                if data:
+                    return data
+            elif type == FCGI_STDERR:
+                environ['wsgi.errors'].write(data)
+            elif type == FCGI_END_REQUEST:
+                return None
+
+    def _readHeaders(self, stream, environ, timer):
+        """
+        Reads the response up to the end of the headers, returning
+        ``(status, headers, body, ended)``, where body is the data
+        read after the headers, and ended is true if that was the end
+        of the response.
+        """
+        parser = HeaderParser()
+        first = True
+        while True:
+            if not first:
+                _setTimeout(stream.sock, timer.timeout('deadline', None))
+            first = False
+            data = self._readStdout(stream, environ)
+            if data is None:
+                return parser.status, parser.headers, parser.close(), True
+            body = parser.feed(data)
+            if body is not None:
+                return parser.status, parser.headers, body, False
+
+    def _streamBody(self, stream, requestId, environ, timer, body, ended):
+        """
+        Yields the rest of the body as it arrives (see `stream`), and
+        closes the socket at the end.
+        """
+        sock = stream.sock
+        pending = []
+        size = 0
+        since = time.time()
+        if body:
+            pending.append(body)
+            size = len(body)
+        try:
+            try:
+                while not ended:
+                    if pending:
+                        if size >= self._coalesceSize:
+                            yield ''.join(pending)
+                            pending = []
+                            size = 0
+                            continue
+                        wait = max(since + self._coalesceDelay - time.time(), 0)
+                        if not select.select([sock], [], [], wait)[0]:
+                            # The end of a burst, e.g. a flush() in PHP
+                            yield ''.join(pending)
+                            pending = []
+                            size = 0
+                            continue
+                    _setTimeout(sock, timer.timeout('deadline', None))
+                    data = self._readStdout(stream, environ)
+                    if data is None:
+                        ended = True
+                    else:
+                        if not pending:
+                            since = time.time()
+                        pending.append(data)
+                        size += len(data)
+            except socket.timeout:
+                self._abort(stream, requestId, environ, timer.kind)
+                stream = None
+                environ['wsgi.errors'].write(
+                    'FastCGI response cut short (%s timeout)\n' % timer.kind)
+            if pending:
+                yield ''.join(pending)
+        finally:
+            if stream is not None:
+                self._closeStream(stream)
+
+    def _abort(self, stream, requestId, environ, kind):
+        """
+        Aborts a request that timed out, and counts the timeout.
+        """
+        self.timeouts[kind] += 1
+        if stream is not None:
+            if kind != 'connect':
+                self._abortRequest(stream, requestId)
+            self._closeStream(stream)
+        if self._onTimeout is not None:
+            self._onTimeout(environ, kind)
+
+    def _abortRequest(self, stream, requestId):
+        """
+        Sends ``FCGI_ABORT_REQUEST``; errors are ignored, as the
+        connection is closed next anyway.
+        """
+        try:
+            stream.sock.settimeout(1)
+            stream.write(FCGI_ABORT_REQUEST, requestId)
+        except socket.error:
+            pass
 
-    def _getConnection(self):
+    def _timedOut(self, stream, requestId, environ, start_response, kind):
+        """
+        Aborts a request that timed out, and responds with 504
+        Gateway Timeout.
+        """
+        self._abort(stream, requestId, environ, kind)
+        body = 'The FastCGI application did not respond in time (%s timeout)' % (
+            kind.replace('_', ' '))
+        start_response('504 Gateway Timeout',
+                       [('content-type', 'text/plain'),
+                        ('content-length', str(len(body)))])
+        return [body]
+
+    def _getConnection(self, timeout=None):
         if self._connect is not None:
             # The simple case. Create a socket and connect to the
             # application.
@@ -390,7 +862,13 @@ class FCGIApp(object):
                 sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             else:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(self._connect)
+            if timeout is not None:
+                sock.settimeout(timeout)
+            try:
+                sock.connect(self._connect)
+            except:
+                sock.close()
+                raise
             return sock
 
         # To be done when I have more time...
@@ -418,15 +896,11 @@ class FCGIApp(object):
                 result[name] = value
         return result
 
-    def _fcgiParams(self, sock, requestId, params):
-        rec = Record(FCGI_PARAMS, requestId)
+    def _fcgiParams(self, stream, requestId, params):
         data = []
         for name,value in params.items():
             data.append(encode_pair(name, value))
-        data = ''.join(data)
-        rec.contentData = data
-        rec.contentLength = len(data)
-        rec.write(sock)
+        stream.write(FCGI_PARAMS, requestId, ''.join(data))
 
     _environPrefixes = ['SERVER_', 'HTTP_', 'REQUEST_', 'REMOTE_', 'PATH_',
                         'CONTENT_']
@@ -453,6 +927,707 @@ class FCGIApp(object):
                 result[n] = environ[n]
         return result
 
+def encode_record(type, requestId, data=''):
+    """
+    Encodes `data` as a record (or several, if it is longer than a
+    record can be).
+
+    The encoded string is returned.
+    """
+    records = []
+    pos = 0
+    while True:
+        length = min(len(data) - pos, FCGI_MAX_CONTENT_LEN)
+        paddingLength = -length & 7
+        records.append(_headerStruct.pack(FCGI_VERSION_1, type, requestId,
+                                          length, paddingLength))
+        records.append(data[pos:pos+length])
+        records.append(_padding[paddingLength])
+        pos += length
+        if pos >= len(data):
+            break
+    return ''.join(records)
+
+def decode_record(s, pos=0):
+    """
+    Decodes a record.
+
+    None is returned if `s` doesn't hold all of the record yet;
+    otherwise the position after the record, and ``(type, requestId,
+    contentData)``.
+    """
+    if len(s) - pos < FCGI_HEADER_LEN:
+        return None
+    version, type, requestId, contentLength, paddingLength = \
+             _headerStruct.unpack_from(s, pos)
+    start = pos + FCGI_HEADER_LEN
+    end = start + contentLength
+    if len(s) < end + paddingLength:
+        return None
+    return (end + paddingLength, (type, requestId, s[start:end]))
+
+class _ServerRequest(object):
+    """
+    A request that a FastCGI server is receiving or answering.
+    """
+
+    __slots__ = ['requestId', 'keepConn', 'params', 'stdin', 'running',
+                 'aborted']
+
+    def __init__(self, requestId, keepConn, stdin):
+        self.requestId = requestId
+        self.keepConn = keepConn
+        self.params = []
+        self.stdin = stdin
+        self.running = False
+        self.aborted = False
+
+class _ErrorStream(object):
+    """
+    ``wsgi.errors`` for a request: sends what is written as
+    ``FCGI_STDERR`` records.
+    """
+
+    def __init__(self, conn, requestId):
+        self._conn = conn
+        self._requestId = requestId
+
+    def write(self, data):
+        if data:
+            try:
+                self._conn.write(FCGI_STDERR, self._requestId, data)
+            except socket.error:
+                pass
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+def _cgiHeaders(status, headers):
+    lines = ['Status: %s' % status]
+    for name, value in headers:
+        lines.append('%s: %s' % (name, value))
+    lines.append('\r\n')
+    return '\r\n'.join(lines)
+
+class BaseFCGIServer(object):
+    """
+    The responder side of FastCGI, serving the WSGI `application`:
+    what `FCGIServer` and `AsyncFCGIServer` have in common.
+
+    The server listens on `bindAddress` (a ``(host, port)`` tuple, or
+    the filename of a Unix socket).  At most `maxConns` connections
+    are accepted, and `maxReqs` (by default `maxConns`) requests are
+    handled at a time; further requests are refused with
+    ``FCGI_OVERLOADED``.  Those limits are what ``FCGI_GET_VALUES``
+    answers.  Connections are kept open after a request if the front
+    end asks for it (``FCGI_KEEP_CONN``), and several requests can be
+    sent at once on a connection unless `multiplexed` is false.
+
+    A request's body is read (into memory, or a temporary file in
+    `spoolDir` if it is over `spoolSize` bytes) before the
+    application is called.  The response is streamed: each string
+    the application yields is sent on as it is produced.
+    """
+
+    multithread = False
+
+    def __init__(self, application, bindAddress=('127.0.0.1', 9000),
+                 maxConns=64, maxReqs=None, multiplexed=True,
+                 spoolSize=1024*1024, spoolDir=None):
+        self.application = application
+        self.address = bindAddress
+        self.maxConns = maxConns
+        if maxReqs is None:
+            maxReqs = maxConns
+        self.maxReqs = maxReqs
+        self.multiplexed = multiplexed
+        self._spoolSize = spoolSize
+        self._spoolDir = spoolDir
+        self.sock = None
+        # Requests served, and in progress:
+        self.requests = 0
+        self.active = 0
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def bind(self):
+        """
+        Binds the listening socket.  `address` is updated with the
+        bound address (useful when binding port 0).
+        """
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+
+    def start(self):
+        """
+        Binds the listening socket and serves in a background
+        thread.  Returns self.
+        """
+        self.bind()
+        t = threading.Thread(target=self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return self
+
+    def stop(self):
+        self._stopping = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+    def values(self):
+        """
+        Returns the answers to ``FCGI_GET_VALUES``.
+        """
+        return {
+            FCGI_MAX_CONNS: str(self.maxConns),
+            FCGI_MAX_REQS: str(self.maxReqs),
+            FCGI_MPXS_CONNS: self.multiplexed and '1' or '0',
+            }
+
+    def _valuesResult(self, data):
+        values = self.values()
+        result = []
+        pos = 0
+        while pos < len(data):
+            pos, (name, value) = decode_pair(data, pos)
+            if name in values:
+                result.append(encode_pair(name, values[name]))
+        return ''.join(result)
+
+    def _reserve(self):
+        """
+        Counts a new request, returning false if there are already
+        `maxReqs` requests in progress.
+        """
+        self._lock.acquire()
+        try:
+            if self.active >= self.maxReqs:
+                return False
+            self.active += 1
+            self.requests += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _release(self):
+        self._lock.acquire()
+        try:
+            self.active -= 1
+        finally:
+            self._lock.release()
+
+    def _handleRecord(self, conn, type, requestId, data):
+        """
+        Handles a record received on `conn`.  Returns the request
+        once all of it has arrived (its ``FCGI_STDIN`` stream has
+        ended), for the application to be run.
+        """
+        if type == FCGI_GET_VALUES:
+            conn.write(FCGI_GET_VALUES_RESULT, FCGI_NULL_REQUEST_ID,
+                       self._valuesResult(data))
+            return None
+        if requestId == FCGI_NULL_REQUEST_ID:
+            conn.write(FCGI_UNKNOWN_TYPE, FCGI_NULL_REQUEST_ID,
+                       struct.pack(FCGI_UnknownTypeBody, type))
+            return None
+        if type == FCGI_BEGIN_REQUEST:
+            role, flags = struct.unpack(FCGI_BeginRequestBody, data)
+            keepConn = bool(flags & FCGI_KEEP_CONN)
+            if role != FCGI_RESPONDER:
+                status = FCGI_UNKNOWN_ROLE
+            elif conn.requests and not self.multiplexed:
+                status = FCGI_CANT_MPX_CONN
+            elif not self._reserve():
+                status = FCGI_OVERLOADED
+            else:
+                conn.requests[requestId] = _ServerRequest(
+                    requestId, keepConn,
+                    SpooledBuffer(self._spoolSize, self._spoolDir))
+                return None
+            conn.write(FCGI_END_REQUEST, requestId,
+                       struct.pack(FCGI_EndRequestBody, 0, status))
+            if not keepConn:
+                self._closeConnection(conn)
+            return None
+        request = conn.requests.get(requestId)
+        if request is None:
+            return None
+        if type == FCGI_ABORT_REQUEST:
+            request.aborted = True
+            if not request.running:
+                self._endRequest(conn, request)
+        elif request.running:
+            pass
+        elif type == FCGI_PARAMS:
+            if data:
+                request.params.append(data)
+        elif type == FCGI_STDIN:
+            if not data:
+                request.running = True
+                return request
+            request.stdin.write(data)
+        return None
+
+    def _endRequest(self, conn, request):
+        """
+        Sends ``FCGI_END_REQUEST`` and forgets the request.
+        """
+        try:
+            try:
+                conn.write(FCGI_END_REQUEST, request.requestId,
+                           struct.pack(FCGI_EndRequestBody, 0,
+                                       FCGI_REQUEST_COMPLETE))
+                if not request.keepConn:
+                    self._closeConnection(conn)
+            except socket.error:
+                pass
+        finally:
+            if conn.requests.get(request.requestId) is request:
+                del conn.requests[request.requestId]
+            request.stdin.close()
+            self._release()
+
+    def _environ(self, conn, request, errors):
+        environ = {}
+        data = ''.join(request.params)
+        pos = 0
+        while pos < len(data):
+            pos, (name, value) = decode_pair(data, pos)
+            environ[name] = value
+        for name in ['SCRIPT_NAME', 'PATH_INFO', 'QUERY_STRING']:
+            environ.setdefault(name, '')
+        if environ.get('HTTPS', 'off').lower() in ('on', '1'):
+            environ['wsgi.url_scheme'] = 'https'
+        else:
+            environ['wsgi.url_scheme'] = 'http'
+        environ['wsgi.version'] = (1, 0)
+        environ['wsgi.input'] = request.stdin.reader()
+        environ['wsgi.errors'] = errors
+        environ['wsgi.multithread'] = self.multithread
+        environ['wsgi.multiprocess'] = False
+        environ['wsgi.run_once'] = False
+        return environ
+
+    def _respond(self, conn, request):
+        """
+        Runs the application for `request`, yielding the output for
+        its ``FCGI_STDOUT`` stream: the headers with the first body
+        data, then the rest of the body as it is produced.  Empty
+        strings from the application are passed on too (so
+        `AsyncFCGIServer` can serve other requests meanwhile), and
+        must not be sent, as an empty record ends the stream.  A
+        request whose parameters can't be decoded gets a 500 response
+        too.
+        """
+        errors = _ErrorStream(conn, request.requestId)
+        # [status, headers] once start_response() is called:
+        response = []
+        # Data given to write():
+        written = []
+        sent = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if sent:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif response:
+                raise AssertionError('start_response() was already called')
+            response[:] = [status, headers]
+            return written.append
+        def output(data):
+            if written:
+                data = ''.join(written) + data
+                del written[:]
+            if data and not sent:
+                data = _cgiHeaders(*response) + data
+                sent.append(True)
+            return data
+        try:
+            environ = self._environ(conn, request, errors)
+            appIter = self.application(environ, start_response)
+            try:
+                for data in appIter:
+                    yield output(data)
+                data = output('')
+                if not sent:
+                    data = _cgiHeaders(*response)
+                    sent.append(True)
+                if data:
+                    yield data
+            finally:
+                if hasattr(appIter, 'close'):
+                    appIter.close()
+        except Exception:
+            errors.write(traceback.format_exc())
+            if not sent:
+                sent.append(True)
+                yield _cgiHeaders('500 Internal Server Error',
+                                  [('Content-Type', 'text/plain')]) + \
+                      'Internal Server Error\n'
+
+    def _closeConnection(self, conn):
+        """
+        Closes the connection once what has been written is sent.
+        """
+        raise NotImplementedError
+
+class _ThreadedConnection(object):
+    """
+    A connection to `FCGIServer`.  Records are read by the
+    connection's thread, and written by the threads of its requests.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.stream = RecordStream(sock)
+        self.lock = threading.Lock()
+        self.requests = {}
+        # Set when nothing more will be read:
+        self.done = False
+        self.closed = False
+
+    def write(self, type, requestId, data=''):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise socket.error(errno.EBADF, 'Connection closed')
+            self.stream.write(type, requestId, data)
+        finally:
+            self.lock.release()
+
+    def closeIfDone(self):
+        """
+        Closes the socket once reading has stopped and no request is
+        left to answer.
+        """
+        self.lock.acquire()
+        try:
+            if self.done and not self.requests and not self.closed:
+                self.closed = True
+                self.sock.close()
+        finally:
+            self.lock.release()
+
+class FCGIServer(BaseFCGIServer):
+    """
+    A FastCGI server (see `BaseFCGIServer`) that reads each
+    connection in a thread of its own, and runs each request in a
+    new thread, so that requests multiplexed on a connection are
+    handled at the same time.
+    """
+
+    multithread = True
+
+    def __init__(self, application, bindAddress=('127.0.0.1', 9000),
+                 maxConns=64, maxReqs=None, multiplexed=True,
+                 spoolSize=1024*1024, spoolDir=None):
+        BaseFCGIServer.__init__(
+            self, application, bindAddress=bindAddress, maxConns=maxConns,
+            maxReqs=maxReqs, multiplexed=multiplexed, spoolSize=spoolSize,
+            spoolDir=spoolDir)
+        self.connections = 0
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        while not self._stopping:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error, e:
+                if self._stopping:
+                    return
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self._lock.acquire()
+            try:
+                accept = self.connections < self.maxConns
+                if accept:
+                    self.connections += 1
+            finally:
+                self._lock.release()
+            if not accept:
+                sock.close()
+                continue
+            t = threading.Thread(target=self._handleConnection, args=(sock,))
+            t.setDaemon(True)
+            t.start()
+
+    def _handleConnection(self, sock):
+        conn = _ThreadedConnection(sock)
+        try:
+            try:
+                while True:
+                    type, requestId, data = conn.stream.read()
+                    request = self._handleRecord(conn, type, requestId, data)
+                    if request is not None:
+                        t = threading.Thread(target=self._runRequest,
+                                             args=(conn, request))
+                        t.setDaemon(True)
+                        t.start()
+            except (EOFError, socket.error):
+                # The front end closed the connection
+                pass
+            except Exception:
+                # A malformed record: give up on the connection
+                traceback.print_exc()
+        finally:
+            # Requests that hadn't been read completely (e.g. an
+            # upload the front end gave up on) will never run
+            for request in conn.requests.values():
+                if not request.running:
+                    del conn.requests[request.requestId]
+                    request.stdin.close()
+                    self._release()
+            self._lock.acquire()
+            try:
+                self.connections -= 1
+            finally:
+                self._lock.release()
+            conn.lock.acquire()
+            try:
+                conn.done = True
+            finally:
+                conn.lock.release()
+            conn.closeIfDone()
+
+    def _runRequest(self, conn, request):
+        output = self._respond(conn, request)
+        try:
+            try:
+                for data in output:
+                    if request.aborted:
+                        break
+                    if data:
+                        conn.write(FCGI_STDOUT, request.requestId, data)
+                conn.write(FCGI_STDOUT, request.requestId)
+            finally:
+                output.close()
+        except socket.error:
+            # The front end has gone away
+            pass
+        except Exception:
+            # The request must still end, and free its slot
+            traceback.print_exc()
+        self._endRequest(conn, request)
+        conn.closeIfDone()
+
+    def _closeConnection(self, conn):
+        # The connection's thread reads on until the front end closes
+        # its end too; closing now, with records (like the empty
+        # FCGI_DATA that FCGIApp sends) unread, would reset the
+        # connection and could lose the end of the response.
+        conn.sock.shutdown(socket.SHUT_WR)
+
+class _AsyncConnection(object):
+    """
+    A connection to `AsyncFCGIServer`, with its unread input,
+    unsent output, and the responses being produced.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.requests = {}
+        self.input = ''
+        self.output = []
+        self.outputSize = 0
+        # (request, output) for the responses in progress:
+        self.running = []
+        # Shut down once the output has been sent:
+        self.closing = False
+        self.shutDown = False
+
+    def write(self, type, requestId, data=''):
+        data = encode_record(type, requestId, data)
+        self.output.append(data)
+        self.outputSize += len(data)
+
+class AsyncFCGIServer(BaseFCGIServer):
+    """
+    A FastCGI server (see `BaseFCGIServer`) that handles all its
+    connections in one thread, with select().
+
+    The application is called in that thread too, so it should not
+    block; the responses of requests in progress are produced in
+    turns, one string at a time, while the front end keeps up with
+    them (has less than `highWater` bytes to read).
+    """
+
+    highWater = 65536
+
+    def serve_forever(self, pollInterval=0.5):
+        if self.sock is None:
+            self.bind()
+        self.sock.setblocking(0)
+        self._connections = connections = {}
+        while not self._stopping:
+            busy = False
+            for conn in connections.values():
+                if conn.running and conn.outputSize < self.highWater:
+                    self._advance(conn)
+                    if conn.running and conn.outputSize < self.highWater:
+                        busy = True
+            readers = [self.sock] + connections.keys()
+            writers = [sock for sock, conn in connections.items()
+                       if conn.output]
+            try:
+                readable, writable, errors = select.select(
+                    readers, writers, [], busy and 0 or pollInterval)
+            except (select.error, socket.error), e:
+                if self._stopping:
+                    break
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in writable:
+                conn = connections.get(sock)
+                if conn is not None:
+                    self._send(conn)
+            for sock in readable:
+                if sock is self.sock:
+                    self._accept()
+                    continue
+                conn = connections.get(sock)
+                if conn is not None:
+                    self._receive(conn)
+        for conn in connections.values():
+            self._drop(conn)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error, e:
+                if e.args and e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                if self._stopping:
+                    return
+                raise
+            if len(self._connections) >= self.maxConns:
+                sock.close()
+                continue
+            sock.setblocking(0)
+            self._connections[sock] = _AsyncConnection(sock)
+
+    def _receive(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error, e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self._drop(conn)
+            return
+        if not data:
+            # The front end closed the connection
+            self._drop(conn)
+            return
+        if conn.shutDown:
+            return
+        conn.input += data
+        pos = 0
+        while True:
+            result = decode_record(conn.input, pos)
+            if result is None:
+                break
+            pos, (type, requestId, content) = result
+            try:
+                request = self._handleRecord(conn, type, requestId, content)
+            except Exception:
+                # A malformed record: give up on the connection
+                traceback.print_exc()
+                self._drop(conn)
+                return
+            if request is not None:
+                conn.running.append((request, self._respond(conn, request)))
+        conn.input = conn.input[pos:]
+
+    def _advance(self, conn):
+        """
+        Takes the next string from each response in progress.
+        """
+        for request, output in list(conn.running):
+            try:
+                if request.aborted:
+                    output.close()
+                    raise StopIteration
+                data = output.next()
+            except Exception, e:
+                if not isinstance(e, StopIteration):
+                    # The request must still end, and free its slot
+                    traceback.print_exc()
+                conn.running.remove((request, output))
+                conn.write(FCGI_STDOUT, request.requestId)
+                self._endRequest(conn, request)
+            else:
+                if data:
+                    conn.write(FCGI_STDOUT, request.requestId, data)
+
+    def _send(self, conn):
+        if len(conn.output) > 1:
+            conn.output = [''.join(conn.output)]
+        try:
+            sent = conn.sock.send(conn.output[0])
+        except socket.error, e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self._drop(conn)
+            return
+        conn.outputSize -= sent
+        if sent < len(conn.output[0]):
+            conn.output[0] = conn.output[0][sent:]
+            return
+        conn.output = []
+        if conn.closing:
+            self._shutDown(conn)
+
+    def _shutDown(self, conn):
+        # As in FCGIServer, read on until the front end closes too
+        if conn.shutDown:
+            return
+        conn.shutDown = True
+        try:
+            conn.sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            self._drop(conn)
+
+    def _drop(self, conn):
+        """
+        Closes a connection, and abandons its requests.
+        """
+        self._connections.pop(conn.sock, None)
+        for request, output in conn.running:
+            output.close()
+        conn.running = []
+        for request in conn.requests.values():
+            request.stdin.close()
+            self._release()
+        conn.requests = {}
+        conn.output = []
+        conn.sock.close()
+
+    def _closeConnection(self, conn):
+        conn.closing = True
+        if not conn.output:
+            self._shutDown(conn)
+
 if __name__ == '__main__':
     from flup.server.ajp import WSGIServer
     app = FCGIApp(connect=('localhost', 4242))
@@ -1,15 +1,30 @@
 """
-Parses default-php.ini for variables, and gives metadata.
+Parses ``php.ini`` files for variables, and gives metadata.
 
-Not really used in any interesting way currently.
+Files are parsed lazily, the first time their options are asked for,
+and the parsed options are cached (as JSON, in a directory of the
+user's own in the temporary directory) keyed by the file's
+modification time, so later processes don't have to parse the file
+again.  Use `get_metadata()` to get the
+metadata for a file; `default-php.ini` is used if no file is given.
 """
 import os
+import stat
+import difflib
+import threading
+import tempfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 php_ini_location = os.path.join(os.path.dirname(__file__),
                                 'default-php.ini')
 
-f = open(php_ini_location)
-
 class Option(object):
 
     def __init__(self, name, section, default, description):
@@ -18,15 +33,212 @@ class Option(object):
         self.description = description
         self.section = section
 
-options = []
-options_by_name = {}
+    def __repr__(self):
+        return '<Option %s=%r in [%s]>' % (
+            self.name, self.default, self.section)
 
 show_ignored = False
 
-def read_data():
+def private_cache_dir(base=None):
+    """
+    Returns a directory for caches that only this user can write to
+    (``wphp-ini-cache-<uid>`` in `base`, or the temporary directory),
+    creating it if needed, or None if there isn't one that can be
+    trusted (for instance, if another user made it first).
+    """
+    if not hasattr(os, 'getuid'):
+        return None
+    if base is None:
+        base = tempfile.gettempdir()
+    path = os.path.join(base, 'wphp-ini-cache-%s' % os.getuid())
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or st.st_mode & 077):
+        return None
+    return path
+
+# Bump this when the parser or the cached format changes:
+cache_version = 1
+
+class IniMetadata(object):
+    """
+    The options of one ``php.ini`` file.  The file isn't read until
+    one of the attributes is used.
+
+    `options` is a list of all the options, in the order they appear
+    in the file.  `options_by_name` is a dictionary of the same
+    options (when a directive appears several times, like
+    ``extension``, the last one is used), and `sections` is a
+    dictionary of section name to the options in that section.
+    """
+
+    def __init__(self, filename, cache_dir=None):
+        self.filename = os.path.abspath(filename)
+        if cache_dir is None:
+            # None if there is no safe place; then nothing is cached
+            cache_dir = private_cache_dir()
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._loaded_mtime = None
+        self._options = None
+
+    def __repr__(self):
+        return '<IniMetadata for %s>' % self.filename
+
+    def get(self, name, default=None):
+        """
+        Returns the `Option` with the given name, or `default`.
+        """
+        return self.options_by_name.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.options_by_name
+
+    def section(self, name):
+        """
+        Returns the options in the named section (an empty list if
+        there is no such section).
+        """
+        return self.sections.get(name, [])
+
+    def options(self):
+        if self._options is None:
+            self.load()
+        return self._options
+    options = property(options)
+
+    def options_by_name(self):
+        if self._options is None:
+            self.load()
+        return self._options_by_name
+    options_by_name = property(options_by_name)
+
+    def sections(self):
+        if self._options is None:
+            self.load()
+        return self._sections
+    sections = property(sections)
+
+    def load(self):
+        """
+        Loads the options, from the cache or by parsing the file.
+        This is done automatically the first time the options are
+        used; call it again to pick up changes to the file.
+        """
+        mtime = os.path.getmtime(self.filename)
+        if self._options is not None and self._loaded_mtime == mtime:
+            return
+        self._lock.acquire()
+        try:
+            if self._options is not None and self._loaded_mtime == mtime:
+                return
+            options = self.read_cache(mtime)
+            if options is None:
+                f = open(self.filename)
+                try:
+                    options = parse(f)
+                finally:
+                    f.close()
+                self.write_cache(mtime, options)
+            options_by_name = {}
+            sections = {}
+            for op in options:
+                options_by_name[op.name] = op
+                sections.setdefault(op.section, []).append(op)
+            self._options_by_name = options_by_name
+            self._sections = sections
+            self._options = options
+            self._loaded_mtime = mtime
+        finally:
+            self._lock.release()
+
+    def cache_filename(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(
+            self.cache_dir,
+            'wphp-ini-%s.json' % md5(self.filename).hexdigest())
+
+    def read_cache(self, mtime):
+        """
+        Returns the cached options, or None if there is no cache for
+        this version of the file.
+        """
+        fn = self.cache_filename()
+        if fn is None:
+            return None
+        try:
+            f = open(fn, 'rb')
+            try:
+                data = json.load(f, encoding='latin-1')
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if (not isinstance(data, dict)
+            or data.get('version') != cache_version
+            or data.get('filename') != self.filename
+            or data.get('mtime') != mtime):
+            return None
+        # JSON gives unicode strings; latin-1 gets back the original
+        # bytes
+        options = []
+        for values in data['options']:
+            for i, value in enumerate(values):
+                if value is not None:
+                    values[i] = value.encode('latin-1')
+            options.append(Option(*values))
+        return options
+
+    def write_cache(self, mtime, options):
+        """
+        Writes the cache for the file.  Failures are ignored, as the
+        cache is only an optimization.
+        """
+        fn = self.cache_filename()
+        if fn is None:
+            return
+        data = {
+            'version': cache_version,
+            'filename': self.filename,
+            'mtime': mtime,
+            'options': [[op.name, op.section, op.default, op.description]
+                        for op in options],
+            }
+        try:
+            fd, tmp_fn = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        except (IOError, OSError):
+            return
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                json.dump(data, f, encoding='latin-1')
+            finally:
+                f.close()
+            os.rename(tmp_fn, fn)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_fn)
+            except OSError:
+                pass
+
+def parse(lines):
+    """
+    Parses the lines of a ``php.ini`` file, returning a list of
+    `Option` objects.  Comments immediately before a directive are
+    used as its description.
+    """
+    options = []
     last_description = []
     last_section = None
-    for line in f:
+    for line in lines:
         line = line.strip()
         if not line:
             if show_ignored and last_description:
@@ -47,22 +259,428 @@ def read_data():
             if last_description or line:
                 last_description.append(line)
             continue
+        if '=' not in line:
+            # Not a directive we understand
+            last_description = []
+            continue
         name, value = line.split('=', 1)
         name = name.strip()
         value = value.strip()
         op = Option(name, last_section, value, '\n'.join(last_description))
         last_description = []
         options.append(op)
-        options_by_name[op.name] = op
+    return options
+
+# Directives that aren't in default-php.ini (they come from
+# extensions or newer versions of PHP), but are still valid options:
+extra_options = [
+    # Core
+    'allow_url_include',
+    'max_file_uploads',
+    'max_input_nesting_level',
+    'max_input_time',
+    'enable_post_data_reading',
+    'request_order',
+    'user_ini.filename',
+    'user_ini.cache_ttl',
+    'exit_on_timeout',
+    'hard_timeout',
+    'sys_temp_dir',
+    'input_encoding',
+    'internal_encoding',
+    'output_encoding',
+    'serialize_precision',
+    'unserialize_max_depth',
+    'error_log_mode',
+    'log_errors_max_len',
+    'syslog.facility',
+    'syslog.filter',
+    'syslog.ident',
+    'mail.add_x_header',
+    'mail.log',
+    'mail.mixed_lf_and_crlf',
+    'assert.active',
+    'assert.bail',
+    'assert.callback',
+    'assert.exception',
+    'assert.warning',
+    'zend.multibyte',
+    'zend.script_encoding',
+    'zend.detect_unicode',
+    'zend.signal_check',
+    'zend.exception_ignore_args',
+    'zend.exception_string_param_max_len',
+    'zend.max_allowed_stack_size',
+    'zend.reserved_stack_size',
+    'fiber.stack_size',
+    'cgi.discard_path',
+    'cgi.nph',
+    'cgi.rfc2616_headers',
+    'cgi.check_shebang_line',
+    'fastcgi.impersonate',
+    'fastcgi.error_header',
+    'pcre.backtrack_limit',
+    'pcre.recursion_limit',
+    'pcre.jit',
+    'zlib.output_compression_level',
+    'date.default_latitude',
+    'date.default_longitude',
+    'date.sunrise_zenith',
+    'date.sunset_zenith',
+    'ffi.enable',
+    'ffi.preload',
+    # Sessions
+    'session.cookie_httponly',
+    'session.cookie_samesite',
+    'session.use_strict_mode',
+    'session.use_only_cookies',
+    'session.lazy_write',
+    'session.sid_length',
+    'session.sid_bits_per_character',
+    'session.trans_sid_tags',
+    'session.trans_sid_hosts',
+    'session.hash_function',
+    'session.hash_bits_per_character',
+    'session.upload_progress.enabled',
+    'session.upload_progress.cleanup',
+    'session.upload_progress.prefix',
+    'session.upload_progress.name',
+    'session.upload_progress.freq',
+    'session.upload_progress.min_freq',
+    # Databases
+    'mysqli.allow_local_infile',
+    'mysqli.local_infile_directory',
+    'mysqli.allow_persistent',
+    'mysqli.max_persistent',
+    'mysqli.max_links',
+    'mysqli.default_port',
+    'mysqli.default_socket',
+    'mysqli.default_host',
+    'mysqli.default_user',
+    'mysqli.default_pw',
+    'mysqli.reconnect',
+    'mysqli.rollback_on_cached_plink',
+    'mysqlnd.collect_statistics',
+    'mysqlnd.collect_memory_statistics',
+    'mysqlnd.debug',
+    'mysqlnd.log_mask',
+    'mysqlnd.mempool_default_size',
+    'mysqlnd.net_cmd_buffer_size',
+    'mysqlnd.net_read_buffer_size',
+    'mysqlnd.net_read_timeout',
+    'mysqlnd.sha256_server_public_key',
+    'pdo_mysql.default_socket',
+    'pdo_mysql.debug',
+    'pdo_odbc.connection_pooling',
+    'pdo_odbc.db2_instance_name',
+    'sqlite3.extension_dir',
+    'sqlite3.defensive',
+    'pgsql.allow_persistent',
+    'pgsql.auto_reset_persistent',
+    'pgsql.max_persistent',
+    'pgsql.max_links',
+    'pgsql.ignore_notice',
+    'pgsql.log_notice',
+    # Other bundled extensions
+    'mbstring.language',
+    'mbstring.internal_encoding',
+    'mbstring.http_input',
+    'mbstring.http_output',
+    'mbstring.http_output_conv_mimetypes',
+    'mbstring.encoding_translation',
+    'mbstring.detect_order',
+    'mbstring.substitute_character',
+    'mbstring.func_overload',
+    'mbstring.strict_detection',
+    'mbstring.regex_retry_limit',
+    'mbstring.regex_stack_limit',
+    'iconv.input_encoding',
+    'iconv.internal_encoding',
+    'iconv.output_encoding',
+    'intl.default_locale',
+    'intl.error_level',
+    'intl.use_exceptions',
+    'curl.cainfo',
+    'openssl.cafile',
+    'openssl.capath',
+    'filter.default',
+    'filter.default_flags',
+    'phar.readonly',
+    'phar.require_hash',
+    'phar.cache_list',
+    'soap.wsdl_cache_enabled',
+    'soap.wsdl_cache_dir',
+    'soap.wsdl_cache_ttl',
+    'soap.wsdl_cache',
+    'soap.wsdl_cache_limit',
+    'ldap.max_links',
+    'bcmath.scale',
+    'gd.jpeg_ignore_warning',
+    'exif.encode_unicode',
+    'exif.decode_unicode_motorola',
+    'exif.decode_unicode_intel',
+    'exif.encode_jis',
+    'exif.decode_jis_motorola',
+    'exif.decode_jis_intel',
+    'tidy.clean_output',
+    'tidy.default_config',
+    'zend_extension',
+    # OPcache and APCu
+    'opcache.enable',
+    'opcache.enable_cli',
+    'opcache.memory_consumption',
+    'opcache.interned_strings_buffer',
+    'opcache.max_accelerated_files',
+    'opcache.max_wasted_percentage',
+    'opcache.validate_timestamps',
+    'opcache.revalidate_freq',
+    'opcache.revalidate_path',
+    'opcache.save_comments',
+    'opcache.fast_shutdown',
+    'opcache.enable_file_override',
+    'opcache.file_cache',
+    'opcache.huge_code_pages',
+    'opcache.preload',
+    'opcache.jit',
+    'opcache.jit_buffer_size',
+    'opcache.jit_debug',
+    'opcache.use_cwd',
+    'opcache.blacklist_filename',
+    'opcache.max_file_size',
+    'opcache.consistency_checks',
+    'opcache.force_restart_timeout',
+    'opcache.error_log',
+    'opcache.log_verbosity_level',
+    'opcache.preferred_memory_model',
+    'opcache.protect_memory',
+    'opcache.restrict_api',
+    'opcache.mmap_base',
+    'opcache.file_cache_only',
+    'opcache.file_cache_consistency_checks',
+    'opcache.file_update_protection',
+    'opcache.optimization_level',
+    'opcache.lockfile_path',
+    'opcache.validate_permission',
+    'opcache.validate_root',
+    'opcache.preload_user',
+    'opcache.record_warnings',
+    'apc.enabled',
+    'apc.enable_cli',
+    'apc.shm_size',
+    'apc.shm_segments',
+    'apc.entries_hint',
+    'apc.gc_ttl',
+    'apc.mmap_file_mask',
+    'apc.slam_defense',
+    'apc.serializer',
+    'apc.use_request_time',
+    'apc.stat',
+    'apc.ttl',
+    # Others
+    'realpath_cache_size',
+    'realpath_cache_ttl',
+    'max_input_vars',
+    'date.timezone',
+    'session.save_path',
+    'error_log',
+    'cgi.fix_pathinfo',
+    'cgi.force_redirect',
+    'fastcgi.logging',
+    'zend.enable_gc',
+    'zend.assertions',
+    ]
+
+# Sets of options that can be applied with PHPApp's php_preset
+presets = {
+    'production': {
+        'display_errors': 'Off',
+        'log_errors': 'On',
+        'expose_php': 'Off',
+        'output_buffering': '4096',
+        # wphp can compress responses outside of PHP
+        'zlib.output_compression': 'Off',
+        'realpath_cache_size': '4096K',
+        'realpath_cache_ttl': '600',
+        'opcache.enable': '1',
+        'opcache.memory_consumption': '128',
+        'opcache.interned_strings_buffer': '8',
+        'opcache.max_accelerated_files': '10000',
+        'opcache.validate_timestamps': '0',
+        },
+    }
+
+# How similar (see difflib) an unknown option name must be to a known
+# one to be taken as a misspelling of it:
+misspelling_cutoff = 0.8
+
+def check_syntax(options):
+    """
+    Checks that each option in the `options` dictionary can be
+    written as one ``php.ini`` line (or ``-d`` argument): names must
+    not be empty or contain line breaks, NULs, ``=``, ``;`` or ``[``,
+    and values must not contain line breaks or NULs.  Raises
+    ValueError if not.  This is needed for safety, so unlike
+    `check_options` it can't be turned off.
+    """
+    errors = []
+    for name, value in sorted(options.items()):
+        name = str(name)
+        value = str(value)
+        if not name.strip():
+            errors.append('empty option name')
+            continue
+        for char in '\r\n\0=;[':
+            if char in name:
+                errors.append('option name %r contains %r' % (name, char))
+                break
+        for char in '\r\n\0':
+            if char in value:
+                errors.append('value of option %r contains a line break '
+                              'or NUL' % name)
+                break
+    if errors:
+        raise ValueError('Bad PHP options: %s' % '; '.join(errors))
+
+def check_options(options, metadata_list, logger=None):
+    """
+    Checks the `options` dictionary against the directives in the
+    `IniMetadata` objects in `metadata_list` and in `extra_options`.
+    Raises ValueError if an unknown name looks like a misspelling of
+    a known one.  Other unknown names (perhaps from an extension or a
+    newer PHP) are only logged as warnings to `logger`.  (See
+    `check_syntax` for names and values that can't be written
+    safely.)
+    """
+    known = {}
+    for name in extra_options:
+        known[name] = None
+    for metadata in metadata_list:
+        known.update(metadata.options_by_name)
+    errors = []
+    for name, value in sorted(options.items()):
+        if name not in known:
+            close = difflib.get_close_matches(
+                name, known.keys(), 1, misspelling_cutoff)
+            if close:
+                errors.append('unknown option %r (did you mean %r?)'
+                              % (name, close[0]))
+            elif logger:
+                logger.warning('Unknown PHP option %r', name)
+    if errors:
+        raise ValueError('Bad PHP options: %s' % '; '.join(errors))
+
+def format_ini(options, base=None):
+    """
+    Returns the text of a ``php.ini`` file setting `options` (a
+    dictionary), after the text of `base` if given.  Options are
+    written in sorted order, so the files can be compared.  Raises
+    ValueError for options `check_syntax` rejects.
+    """
+    check_syntax(options)
+    lines = []
+    if base:
+        lines.append(base.rstrip('\n'))
+        lines.append('')
+    lines.append('; Options set by wphp:')
+    lines.append('[PHP]')
+    for name, value in sorted(options.items()):
+        lines.append('%s = %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+_metadata = {}
+_metadata_lock = threading.Lock()
+
+def get_metadata(filename=None):
+    """
+    Returns the (shared) `IniMetadata` for the given file, or for
+    ``default-php.ini``.
+    """
+    if filename is None:
+        filename = php_ini_location
+    filename = os.path.abspath(filename)
+    _metadata_lock.acquire()
+    try:
+        if filename not in _metadata:
+            _metadata[filename] = IniMetadata(filename)
+        return _metadata[filename]
+    finally:
+        _metadata_lock.release()
+
+class _LazyData(object):
+    """
+    Mixin for the module-level `options` and `options_by_name`,
+    which call `read_data()` the first time they are read.
+    """
+    loaded = False
+
+    def _load(self):
+        if not self.loaded:
+            _data_lock.acquire()
+            try:
+                if not self.loaded:
+                    read_data()
+            finally:
+                _data_lock.release()
+
+def _lazy_method(base_method):
+    def method(self, *args, **kw):
+        self._load()
+        return base_method(self, *args, **kw)
+    method.__name__ = base_method.__name__
+    return method
+
+def _lazy_methods(cls, base, names):
+    for name in names:
+        setattr(cls, name, _lazy_method(getattr(base, name)))
+
+class _LazyList(_LazyData, list):
+    pass
+
+_lazy_methods(_LazyList, list, [
+    '__len__', '__iter__', '__reversed__', '__contains__', '__getitem__',
+    '__getslice__', '__eq__', '__ne__', '__repr__', 'index', 'count'])
+
+class _LazyDict(_LazyData, dict):
+    pass
+
+_lazy_methods(_LazyDict, dict, [
+    '__len__', '__iter__', '__contains__', '__getitem__', '__eq__',
+    '__ne__', '__repr__', 'get', 'has_key', 'keys', 'values', 'items',
+    'iterkeys', 'itervalues', 'iteritems', 'copy'])
+
+_data_lock = threading.Lock()
+
+# These are filled in by read_data(), the first time they are used:
+options = _LazyList()
+options_by_name = _LazyDict()
+
+def read_data():
+    """
+    Fills in (or refreshes) the module-level `options` and
+    `options_by_name` from ``default-php.ini``.
+    """
+    metadata = get_metadata()
+    options[:] = metadata.options
+    options_by_name.clear()
+    options_by_name.update(metadata.options_by_name)
+    options.loaded = options_by_name.loaded = True
 
 if __name__ == '__main__':
     import sys
     last_section = None
     if '-v' in sys.argv[1:]:
         show_ignored = True
-    read_data()
+    args = [arg for arg in sys.argv[1:] if arg != '-v']
+    if args:
+        metadata = IniMetadata(args[0])
+    else:
+        metadata = get_metadata()
+    if show_ignored:
+        f = open(metadata.filename)
+        parse(f)
+        f.close()
 
-    for op in options:
+    for op in metadata.options:
         if last_section != op.section:
             print '\n\n[%s]\n' % op.section
             last_section = op.section
@@ -71,6 +689,3 @@ if __name__ == '__main__':
             print '\n'.join(
                 ['  '+l for l in op.description.splitlines()])
             print
-
-else:
-    read_data()
@@ -0,0 +1,115 @@
+"""
+Buffers for request and response bodies that are kept in memory while
+they are small, and spill to a temporary file when they get big, so a
+few huge responses or uploads can't use up the memory of the process.
+"""
+import tempfile
+from cStringIO import StringIO
+
+class SpooledBuffer(object):
+    """
+    Collects data with `write()`.  Up to `max_memory` bytes are kept
+    in memory; after that everything is moved to a temporary file (in
+    `dir`, or the default temporary directory).
+    """
+
+    def __init__(self, max_memory=1024*1024, dir=None):
+        self.max_memory = max_memory
+        self.dir = dir
+        self.size = 0
+        self.chunks = []
+        self.file = None
+
+    def spilled(self):
+        """Has the data been moved to a file?"""
+        return self.file is not None
+    spilled = property(spilled)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.chunks.append(data)
+        if self.size > self.max_memory:
+            self.file = tempfile.TemporaryFile(prefix='wphp-spool-',
+                                               dir=self.dir)
+            for chunk in self.chunks:
+                self.file.write(chunk)
+            self.chunks = []
+
+    def getvalue(self):
+        """
+        Returns all the data as a string (only for data in memory).
+        """
+        assert self.file is None, 'Data has been spilled to a file'
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return ''.join(self.chunks)
+
+    def reader(self):
+        """
+        Returns a file-like object to read the data from the start.
+        """
+        if self.file is None:
+            return StringIO(self.getvalue())
+        self.file.flush()
+        self.file.seek(0)
+        return self.file
+
+    def app_iter(self, environ, block_size=65536):
+        """
+        Returns a WSGI app_iter for the data: a list if it is in
+        memory, or the file, with the server's ``wsgi.file_wrapper``
+        if it has one.  The app_iter closes the buffer.
+        """
+        if self.file is None:
+            return [self.getvalue()]
+        fileobj = self.reader()
+        self.file = None
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](fileobj, block_size)
+        return FileIter(fileobj, block_size)
+
+    def close(self):
+        self.chunks = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def spool_input(environ, max_memory=1024*1024, dir=None):
+    """
+    Reads the request body (up to ``CONTENT_LENGTH``) from
+    ``wsgi.input`` into a new `SpooledBuffer`.
+    """
+    buf = SpooledBuffer(max_memory, dir)
+    content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    input = environ['wsgi.input']
+    while content_length:
+        s = input.read(min(content_length, 65536))
+        if not s:
+            break
+        buf.write(s)
+        content_length -= len(s)
+    return buf
+
+class FileIter(object):
+    """
+    Iterates over a file in blocks, closing it when closed.
+    """
+
+    def __init__(self, fileobj, block_size=65536):
+        self.fileobj = fileobj
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.fileobj.read(self.block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        self.fileobj.close()